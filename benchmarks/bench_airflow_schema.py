@@ -0,0 +1,69 @@
+# coding: utf-8
+"""
+microbenchmark of converting airflow dag params to helpdesk params
+
+    python benchmarks/bench_airflow_schema.py --params 50 200 1000
+"""
+
+import os
+import sys
+import json
+import timeit
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from helpdesk.libs.cache import LRUCache  # NOQA
+from helpdesk.models.provider import airflow as airflow_provider  # NOQA
+from helpdesk.models.provider.airflow import AirflowProvider  # NOQA
+
+
+def make_dag_params(n):
+    params = {}
+    for i in range(n):
+        extra = {"immutable": i % 7 == 0, "json_schema": {"minLength": 1, "maxLength": 64}}
+        params[f"param_{i}"] = {
+            "description": f"param {i}",
+            "schema": {
+                "type": ["null", "string"] if i % 3 else "array",
+                "enum": [f"option_{j}" for j in range(10)] if i % 5 == 0 else None,
+                "value": f"default_{i}",
+                "description_md": f"param {i} of the dag\n```helpdesk{json.dumps(extra)}```",
+            },
+        }
+        if params[f"param_{i}"]["schema"]["enum"] is None:
+            del params[f"param_{i}"]["schema"]["enum"]
+    return params
+
+
+def bench(n, number):
+    params = make_dag_params(n)
+
+    def cold():
+        airflow_provider._param_conversions = LRUCache()
+        AirflowProvider.airflow_schema_to_helpdesk(params)
+
+    def memoized():
+        AirflowProvider.airflow_schema_to_helpdesk(params)
+
+    cold_seconds = min(timeit.repeat(cold, number=number, repeat=3)) / number
+    memoized()
+    memoized_seconds = min(timeit.repeat(memoized, number=number, repeat=3)) / number
+    print(
+        f"{n:>6} params  cold {cold_seconds * 1000:8.3f} ms  "
+        f"memoized {memoized_seconds * 1000:8.3f} ms  "
+        f"x{cold_seconds / memoized_seconds:.1f}"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--params", type=int, nargs="+", default=[10, 100, 500])
+    parser.add_argument("--number", type=int, default=20)
+    args = parser.parse_args()
+    for n in args.params:
+        bench(n, args.number)
+
+
+if __name__ == "__main__":
+    main()
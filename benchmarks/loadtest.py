@@ -0,0 +1,336 @@
+# coding: utf-8
+"""
+end to end load test of submit -> approve (execute) -> result -> result_log,
+against the app in process, a fake airflow server and a scratch database
+
+    python benchmarks/loadtest.py --tickets 500 --concurrency 20
+    python benchmarks/loadtest.py --database-url mysql://root@127.0.0.1/helpdesk_loadtest \
+        --latency 0.05 --tasks 200 --log-lines 20000 --json loadtest.json
+
+reports p50/p95/p99 latency, throughput and db queries per request of each route.
+one process is one gunicorn worker, compare runs with different --concurrency
+to size `workers` in contrib/docker/gunicorn_conf.py.
+tables are created if missing and never dropped, do not point it to a real database.
+"""
+
+import os
+import sys
+import json
+import time
+import types
+import socket
+import asyncio
+import logging
+import argparse
+import tempfile
+import threading
+import contextvars
+import importlib.util
+from functools import wraps
+from urllib.parse import unquote
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+ROUTES = ("submit", "approve", "result", "result_log")
+USER = "loadtest"
+
+# db queries of the request being served, shared with the tasks it spawns
+_queries = contextvars.ContextVar("queries", default=None)
+
+
+def count_queries():
+    from databases import Database
+
+    def counted(method):
+        @wraps(method)
+        async def _(*args, **kwargs):
+            counter = _queries.get()
+            if counter is not None:
+                counter[0] += 1
+            return await method(*args, **kwargs)
+
+        return _
+
+    for name in ("execute", "execute_many", "fetch_all", "fetch_one", "fetch_val"):
+        setattr(Database, name, counted(getattr(Database, name)))
+
+
+def percentile(values, p):
+    """nearest rank percentile of sorted `values`"""
+    if not values:
+        return 0
+    rank = max(int(round(p / 100 * len(values) + 0.5)) - 1, 0)
+    return values[min(rank, len(values) - 1)]
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_fake_airflow(fake, port):
+    """serve the fake over a socket, the sync airflow client is urllib3"""
+    import uvicorn
+
+    server = uvicorn.Server(
+        uvicorn.Config(fake, host="127.0.0.1", port=port, log_level="warning", lifespan="off")
+    )
+    thread = threading.Thread(target=server.run, name="fake-airflow", daemon=True)
+    thread.start()
+    while not server.started:
+        time.sleep(0.01)
+    return server, thread
+
+
+def load_fake_airflow():
+    """load the fake by path, importing anything from helpdesk creates the app with its settings"""
+    path = os.path.join(ROOT, "helpdesk", "tests", "fake_airflow.py")
+    spec = importlib.util.spec_from_file_location("fake_airflow", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def configure(args, airflow_url, dag_ids):
+    """
+    settings are read at import time, override local_config before helpdesk is imported,
+    the other settings of local_config are kept
+    """
+    try:
+        import local_config
+
+        settings = {k: v for k, v in vars(local_config).items() if not k.startswith("_")}
+    except ImportError:
+        settings = {}
+    settings.update(
+        DATABASE_URL=args.database_url,
+        AIRFLOW_SERVER_URL=airflow_url,
+        TRUSTED_HOSTS=["loadtest"],
+        NOTIFICATION_METHODS=[],
+        AIRFLOW_TASK_LOG_CACHE_DIR="",
+        ACTION_TREE_CONFIG=[
+            "功能导航",
+            [["load test", [[dag_id, dag_id, "airflow", dag_id] for dag_id in dag_ids]]],
+        ],
+    )
+    module = types.ModuleType("local_config")
+    module.__dict__.update(settings)
+    sys.modules["local_config"] = module
+
+
+async def create_policies(dag_ids):
+    from helpdesk.libs.db import engine
+    from helpdesk.models.db import Base
+    from helpdesk.models.user import User
+    from helpdesk.views.api import policy
+    from helpdesk.views.api.schemas import (
+        ApproverType,
+        Node,
+        NodeDefinition,
+        NodeType,
+        PolicyFlowReq,
+        TicketPolicyReq,
+    )
+
+    Base.metadata.create_all(bind=engine)
+    admin = User(name=USER, email=f"{USER}@example.com", roles=["admin"])
+    flow = await policy.create_policy(
+        flow_data=PolicyFlowReq(
+            name=f"loadtest_{int(time.time())}",
+            display="load test",
+            definition=NodeDefinition(
+                nodes=[
+                    Node(
+                        name="approval",
+                        approvers=USER,
+                        approver_type=ApproverType.PEOPLE,
+                        node_type=NodeType.APPROVAL,
+                    )
+                ]
+            ),
+        ),
+        current_user=admin,
+    )
+    for dag_id in dag_ids:
+        await policy.add_associate(
+            params=TicketPolicyReq(
+                ticket_name=dag_id, policy_id=flow.id, link_condition='["=", 1, 1]'
+            )
+        )
+
+
+class Stats:
+    def __init__(self):
+        self.latencies = {route: [] for route in ROUTES}
+        self.queries = {route: [] for route in ROUTES}
+        self.errors = {route: 0 for route in ROUTES}
+
+    async def request(self, route, client, method, url, **kwargs):
+        counter = [0]
+        token = _queries.set(counter)
+        started = time.perf_counter()
+        try:
+            resp = await client.request(method, url, **kwargs)
+        finally:
+            _queries.reset(token)
+        self.latencies[route].append(time.perf_counter() - started)
+        self.queries[route].append(counter[0])
+        if resp.status_code != 200:
+            self.errors[route] += 1
+            raise RuntimeError(f"{route} {resp.status_code}: {resp.text[:200]}")
+        return resp
+
+    def report(self, elapsed, flows, failed):
+        rows = {}
+        for route in ROUTES:
+            latencies = sorted(self.latencies[route])
+            queries = self.queries[route]
+            rows[route] = dict(
+                requests=len(latencies),
+                errors=self.errors[route],
+                p50_ms=percentile(latencies, 50) * 1000,
+                p95_ms=percentile(latencies, 95) * 1000,
+                p99_ms=percentile(latencies, 99) * 1000,
+                max_ms=(latencies[-1] if latencies else 0) * 1000,
+                rps=len(latencies) / elapsed if elapsed else 0,
+                queries_avg=sum(queries) / len(queries) if queries else 0,
+                queries_max=max(queries) if queries else 0,
+            )
+        return dict(
+            elapsed_seconds=elapsed,
+            flows=flows,
+            failed_flows=failed,
+            flows_per_second=flows / elapsed if elapsed else 0,
+            routes=rows,
+        )
+
+
+async def flow(stats, client, dag_id, params):
+    resp = await stats.request("submit", client, "POST", f"/api/action/{dag_id}", json=params)
+    ticket_id = resp.json()["ticket"]["id"]
+    await stats.request("approve", client, "POST", f"/api/ticket/{ticket_id}/approve", json={})
+    resp = await stats.request("result", client, "GET", f"/api/ticket/{ticket_id}/result")
+    query_string = resp.json()["result"]["tasks"][0]["result"]
+    query_string = next(iter(query_string.values()))["stdout"]["query_string"]
+    exec_output_id = unquote(query_string.split("=", 1)[1])
+    await stats.request(
+        "result_log",
+        client,
+        "GET",
+        f"/api/ticket/{ticket_id}/result_log",
+        params={"exec_output_id": exec_output_id},
+    )
+
+
+async def run(args, fake):
+    import httpx
+    from helpdesk import app
+    from helpdesk.libs.airflow import close_async_http_clients
+    from helpdesk.libs.dependency import get_current_user
+    from helpdesk.models.user import User
+
+    # the app logs every request at INFO
+    logging.getLogger().setLevel(args.log_level.upper())
+    # in a task of its own, its db connection is bound to the context and would be shared
+    # by all the requests, under uvicorn every request has its own
+    await asyncio.create_task(create_policies(fake.dag_ids))
+    count_queries()
+    app.dependency_overrides[get_current_user] = lambda: User(
+        name=USER, email=f"{USER}@example.com", roles=["admin"]
+    )
+    params = {f"param_{i}": f"value_{i}" for i in range(args.params)}
+    stats = Stats()
+    semaphore = asyncio.Semaphore(args.concurrency)
+    failed = 0
+
+    async def one(i):
+        nonlocal failed
+        async with semaphore:
+            try:
+                await flow(stats, client, fake.dag_ids[i % len(fake.dag_ids)], params)
+            except Exception as e:
+                failed += 1
+                if failed <= 5:
+                    print(f"flow {i} failed: {e}", file=sys.stderr)
+
+    async with httpx.AsyncClient(
+        transport=httpx.ASGITransport(app=app), base_url="http://loadtest", timeout=None
+    ) as client:
+        started = time.perf_counter()
+        await asyncio.gather(*(one(i) for i in range(args.tickets)))
+        elapsed = time.perf_counter() - started
+    await close_async_http_clients()
+    return stats.report(elapsed, args.tickets, failed)
+
+
+def print_report(report):
+    print(
+        f"{report['flows']} flows in {report['elapsed_seconds']:.2f}s, "
+        f"{report['flows_per_second']:.1f} flows/s, {report['failed_flows']} failed"
+    )
+    print(
+        f"{'route':<12}{'reqs':>7}{'errs':>6}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}"
+        f"{'max ms':>9}{'req/s':>8}{'queries':>9}{'max q':>7}"
+    )
+    for route, row in report["routes"].items():
+        print(
+            f"{route:<12}{row['requests']:>7}{row['errors']:>6}{row['p50_ms']:>9.1f}"
+            f"{row['p95_ms']:>9.1f}{row['p99_ms']:>9.1f}{row['max_ms']:>9.1f}"
+            f"{row['rps']:>8.1f}{row['queries_avg']:>9.1f}{row['queries_max']:>7}"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__.split("\n\n")[0], formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--tickets", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--database-url", default=None, help="default a temporary sqlite db")
+    parser.add_argument("--dags", type=int, default=5)
+    parser.add_argument("--params", type=int, default=5)
+    parser.add_argument("--tasks", type=int, default=10)
+    parser.add_argument("--log-lines", type=int, default=1000)
+    parser.add_argument("--latency", type=float, default=0.0, help="airflow latency seconds")
+    parser.add_argument("--jitter", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--log-level", default="warning")
+    parser.add_argument("--json", help="also write the report to this file")
+    args = parser.parse_args()
+
+    scratch_db = None
+    if args.database_url is None:
+        fd, scratch_db = tempfile.mkstemp(prefix="helpdesk_loadtest_", suffix=".db")
+        os.close(fd)
+        args.database_url = f"sqlite:///{scratch_db}"
+
+    fake = load_fake_airflow().FakeAirflow(
+        dags=args.dags,
+        params=args.params,
+        tasks=args.tasks,
+        log_lines=args.log_lines,
+        latency=args.latency,
+        jitter=args.jitter,
+        error_rate=args.error_rate,
+    )
+    port = free_port()
+    server, thread = start_fake_airflow(fake, port)
+    configure(args, f"http://127.0.0.1:{port}", fake.dag_ids)
+    try:
+        report = asyncio.run(run(args, fake))
+    finally:
+        server.should_exit = True
+        thread.join(5)
+        if scratch_db:
+            os.remove(scratch_db)
+    report["airflow_requests"] = dict(fake.requests)
+    print_report(report)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
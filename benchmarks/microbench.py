@@ -0,0 +1,265 @@
+# coding: utf-8
+"""
+microbenchmarks of pure python hot paths on synthetic inputs of several sizes
+
+    python benchmarks/microbench.py --save baseline.json
+    # after a change
+    python benchmarks/microbench.py --compare baseline.json
+    python benchmarks/microbench.py --filter rule --compare baseline.json
+
+time is per call, the median of `--repeat` rounds. with `--compare` a case more than
+`--threshold` slower than the baseline is a regression and the exit code is 1.
+baselines depend on the machine, compare runs of the same host only.
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import timeit
+import argparse
+import platform
+import statistics
+import subprocess
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from airflow_client.client.models.dag_run_response import DAGRunResponse  # NOQA
+from airflow_client.client.models.task_instance_collection_response import (  # NOQA
+    TaskInstanceCollectionResponse,
+)
+
+from helpdesk.libs.cache import LRUCache  # NOQA
+from helpdesk.libs.rest import dictify, json_unpack  # NOQA
+from helpdesk.models.db.param_rule import ParamRule  # NOQA
+from helpdesk.models.db.policy import TicketPolicy  # NOQA
+from helpdesk.models.db.ticket import Ticket  # NOQA
+from helpdesk.models.provider import airflow as airflow_provider  # NOQA
+from helpdesk.models.provider.airflow import AirflowProvider  # NOQA
+from helpdesk.tests.fake_airflow import FakeAirflow  # NOQA
+
+BENCHMARKS = {}
+
+
+def benchmark(name, sizes):
+    """register `setup(size)`, it returns the function to time"""
+
+    def _(setup):
+        BENCHMARKS[name] = (setup, sizes)
+        return setup
+
+    return _
+
+
+def make_ticket(rnd, i):
+    annotation = {"policy": "default", "approval_log": [], "current_node": "approval"}
+    stage = rnd.randrange(6)
+    if stage == 1:
+        annotation["closed"] = True
+    elif stage >= 2:
+        annotation.update(execution_submitted=True, execution_creation_success=stage != 2)
+        if stage >= 4:
+            annotation["execution_status"] = rnd.choice(["running", "success", "failed"])
+    return Ticket(
+        id=i,
+        title=f"ticket {i}",
+        provider_type="airflow",
+        provider_object=f"dag_{i % 20}",
+        params={f"param_{j}": f"value_{j}" for j in range(10)},
+        extra_params={},
+        submitter=f"user_{i % 50}",
+        reason="load test",
+        is_approved=rnd.choice([None, True, False]),
+        annotation=annotation,
+        created_at=datetime(2024, 1, 1) + timedelta(minutes=i),
+    )
+
+
+@benchmark("ticket_status", sizes=(100, 1000, 10000))
+def bench_ticket_status(size):
+    rnd = random.Random(size)
+    tickets = [make_ticket(rnd, i) for i in range(size)]
+    return lambda: [t.status for t in tickets]
+
+
+@benchmark("json_unpack_tickets", sizes=(10, 100, 1000))
+def bench_json_unpack(size):
+    rnd = random.Random(size)
+    tickets = [make_ticket(rnd, i) for i in range(size)]
+    return lambda: json_unpack(tickets)
+
+
+@benchmark("dictify_ticket", sizes=(100, 1000))
+def bench_dictify(size):
+    rnd = random.Random(size)
+    tickets = [make_ticket(rnd, i) for i in range(size)]
+    # dictify updates __dict__ with the properties, give it a fresh one every call
+    return lambda: [dictify(Ticket(**t._fields())) for t in tickets]
+
+
+def make_rule(conditions):
+    """`conditions` conditions on ticket params joined by `and`, as stored in the db"""
+    ops = [
+        lambda j: ["=", f"param_{j}", f"value_{j}"],
+        lambda j: ["in", f"param_{j}", f"value_{j}", "other"],
+        lambda j: ["regex", f"param_{j}", "^value_\\d+$"],
+        lambda j: ["contains", f"param_{j}", "value"],
+    ]
+    rule = ops[0](0)
+    for j in range(1, conditions):
+        rule = ["and", ops[j % len(ops)](j % 10), rule]
+    return json.dumps(rule)
+
+
+@benchmark("param_rule_match", sizes=(1, 10, 50))
+def bench_param_rule_match(size):
+    rules = [ParamRule(rule=make_rule(size)) for _ in range(10)]
+    context = {f"param_{j}": f"value_{j}" for j in range(10)}
+    return lambda: [r.match(context) for r in rules]
+
+
+@benchmark("ticket_policy_match", sizes=(1, 10, 50))
+def bench_ticket_policy_match(size):
+    policies = [TicketPolicy(link_condition=make_rule(size)) for _ in range(10)]
+    context = {f"param_{j}": f"value_{j}" for j in range(10)}
+    return lambda: [p.match(context) for p in policies]
+
+
+@benchmark("airflow_schema_to_helpdesk", sizes=(10, 100, 500))
+def bench_airflow_schema(size):
+    details = FakeAirflow(params=size)._dag("dag_0", details=True)
+
+    def run():
+        # cold conversion, the memoized one is a dict lookup
+        airflow_provider._param_conversions = LRUCache()
+        AirflowProvider.airflow_schema_to_helpdesk(details["params"])
+
+    return run
+
+
+def make_dag_run(tasks):
+    fake = FakeAirflow(tasks=tasks, run_seconds=60)
+    dag_run_id = "manual__2024-01-01T00:00:00+00:00"
+    # half way, tasks are finished, running and not started
+    fake.dag_runs[("dag_0", dag_run_id)] = (time.time() - 30, {})
+    progress = fake._run_progress("dag_0", dag_run_id)
+    dag_run = DAGRunResponse.from_dict(fake._dag_run("dag_0", dag_run_id))
+    task_instances = TaskInstanceCollectionResponse.from_dict(
+        {
+            "task_instances": [
+                fake._task_instance("dag_0", dag_run_id, i, progress) for i in range(tasks)
+            ],
+            "total_entries": tasks,
+        }
+    )
+    return dag_run, task_instances
+
+
+@benchmark("build_result_from_dag_exec", sizes=(10, 100, 1000))
+def bench_build_result(size):
+    provider = AirflowProvider()
+    dag_run, task_instances = make_dag_run(size)
+    return lambda: provider._build_result_from_dag_exec(dag_run, task_instances)
+
+
+@benchmark("build_task_log", sizes=(1000, 10000, 100000))
+def bench_build_task_log(size):
+    provider = AirflowProvider()
+    content = list(FakeAirflow(log_line_size=120)._log_events(size))
+    for e in content[99::100]:
+        e["error_detail"] = [{"exc_type": "ValueError", "exc_value": "boom"}]
+    data = {"content": content}
+    return lambda: provider._build_task_log("dag_0|run|task_0|1", data)
+
+
+def run_case(func, repeat):
+    timer = timeit.Timer(func)
+    # enough calls per round to take 0.2s
+    number, _ = timer.autorange()
+    times = [t / number for t in timer.repeat(repeat=repeat, number=number)]
+    return dict(median=statistics.median(times), min=min(times), number=number)
+
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).stdout.strip()
+    except OSError:
+        return ""
+
+
+def format_time(seconds):
+    for unit, scale in (("s", 1), ("ms", 1e-3), ("us", 1e-6)):
+        if seconds >= scale:
+            return f"{seconds / scale:8.2f} {unit}"
+    return f"{seconds / 1e-9:8.2f} ns"
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__.split("\n\n")[0], formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--filter", help="only run benchmarks whose name contains this")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--save", help="save results as a baseline to this file")
+    parser.add_argument("--compare", help="compare with the baseline in this file")
+    parser.add_argument("--threshold", type=float, default=0.2)
+    parser.add_argument("--list", action="store_true", help="list benchmarks and exit")
+    args = parser.parse_args()
+
+    if args.list:
+        for name, (_, sizes) in BENCHMARKS.items():
+            print(name, *sizes)
+        return
+
+    baseline = {}
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)["results"]
+
+    results = {}
+    regressions = []
+    for name, (setup, sizes) in BENCHMARKS.items():
+        if args.filter and args.filter not in name:
+            continue
+        for size in sizes:
+            key = f"{name}[{size}]"
+            result = results[key] = run_case(setup(size), args.repeat)
+            line = f"{key:<36}{format_time(result['median'])}  min {format_time(result['min'])}"
+            base = baseline.get(key)
+            if base:
+                ratio = result["median"] / base["median"]
+                line += f"  base {format_time(base['median'])}  x{ratio:.2f}"
+                if ratio > 1 + args.threshold:
+                    line += "  REGRESSION"
+                    regressions.append(key)
+                elif ratio < 1 - args.threshold:
+                    line += "  faster"
+            print(line, flush=True)
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(
+                dict(
+                    created_at=datetime.now().isoformat(),
+                    revision=git_revision(),
+                    python=platform.python_version(),
+                    machine=platform.node(),
+                    results=results,
+                ),
+                f,
+                indent=2,
+            )
+    if regressions:
+        print(f"{len(regressions)} regressions: {', '.join(regressions)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,8 @@
 # coding: utf-8
 
+import asyncio
 import logging
+from contextlib import asynccontextmanager
 
 import uvicorn
 import sentry_sdk
@@ -15,7 +17,9 @@ from starlette.middleware.trustedhost import TrustedHostMiddleware
 
 from fastapi import FastAPI
 
+from helpdesk.libs.airflow import close_async_http_clients
 from helpdesk.libs.auth import BearerAuthMiddleware
+from helpdesk.libs.background import PeriodicTask
 from helpdesk.config import (
     DEBUG,
     SESSION_SECRET_KEY,
@@ -24,9 +28,18 @@ from helpdesk.config import (
     TRUSTED_HOSTS,
     ALLOW_ORIGINS_REG,
     ALLOW_ORIGINS,
+    RUN_BACKGROUND_TASKS,
+    EXECUTION_RECONCILE_INTERVAL_SECONDS,
+    TICKET_STATUS_BACKFILL_INTERVAL_SECONDS,
+    TICKET_SEARCH_BACKFILL_INTERVAL_SECONDS,
+    TICKET_SEARCH_BACKFILL_JITTER_SECONDS,
+    TICKET_PARAM_BACKFILL_INTERVAL_SECONDS,
+    ACTION_TREE_REFRESH_INTERVAL_SECONDS,
 )
 from helpdesk.views.api import router as api_bp
 from helpdesk.views.auth import router as auth_bp
+from helpdesk.models.db.ticket import Ticket
+from helpdesk.models.action_tree import refresh_action_tree
 
 
 def create_app():
@@ -61,7 +74,61 @@ def create_app():
         Middleware(SentryMiddleware),
     ]
 
-    app = FastAPI(debug=DEBUG, middleware=enabled_middlewares)
+    # the action tree and the search index check are in memory of every worker
+    background_tasks = [
+        PeriodicTask(
+            "action-tree-refresher",
+            refresh_action_tree,
+            interval=ACTION_TREE_REFRESH_INTERVAL_SECONDS,
+        ),
+        PeriodicTask(
+            "ticket-search-index-check",
+            Ticket.check_search_index,
+            interval=TICKET_SEARCH_BACKFILL_INTERVAL_SECONDS,
+            jitter=TICKET_SEARCH_BACKFILL_JITTER_SECONDS,
+        ),
+    ]
+    if RUN_BACKGROUND_TASKS:
+        background_tasks += [
+            PeriodicTask(
+                "execution-reconciler",
+                Ticket.reconcile_executions,
+                interval=EXECUTION_RECONCILE_INTERVAL_SECONDS,
+                initial_delay=EXECUTION_RECONCILE_INTERVAL_SECONDS,
+            ),
+            PeriodicTask(
+                "ticket-status-backfill",
+                Ticket.backfill_status,
+                interval=TICKET_STATUS_BACKFILL_INTERVAL_SECONDS,
+            ),
+            PeriodicTask(
+                "ticket-search-backfill",
+                Ticket.backfill_search_index,
+                interval=TICKET_SEARCH_BACKFILL_INTERVAL_SECONDS,
+            ),
+            PeriodicTask(
+                "ticket-param-backfill",
+                Ticket.backfill_param_index,
+                interval=TICKET_PARAM_BACKFILL_INTERVAL_SECONDS,
+            ),
+        ]
+
+    @asynccontextmanager
+    async def lifespan(app):
+        resolve_packs = None
+        if ACTION_TREE_REFRESH_INTERVAL_SECONDS <= 0:
+            # packs are never refreshed, but still resolved once
+            resolve_packs = asyncio.create_task(refresh_action_tree(), name="action-tree-resolve")
+        for task in background_tasks:
+            task.start()
+        yield
+        if resolve_packs is not None:
+            resolve_packs.cancel()
+        for task in background_tasks:
+            await task.stop()
+        await close_async_http_clients()
+
+    app = FastAPI(debug=DEBUG, middleware=enabled_middlewares, lifespan=lifespan)
     app.include_router(api_bp, prefix="/api")
     app.include_router(auth_bp, prefix="/auth")
 
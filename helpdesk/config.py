@@ -53,8 +53,21 @@ AUTHORIZED_EMAIL_DOMAINS = ["@example.com"]
 
 AUTO_APPROVAL_TARGET_OBJECTS = []
 TICKETS_PER_PAGE = 50
+# ticket list totals without `with_total` are counted at most once per this many seconds
+# for the same filter, per process
+TICKET_COUNT_CACHE_SECONDS = 60
+TICKET_COUNT_CACHE_SIZE = 1024
 
 ACTION_TREE_CONFIG = ["功能导航", []]
+# packs in the action tree are resolved in background, run in every worker,
+# packs are resolved once at start and never refreshed if interval is 0
+ACTION_TREE_REFRESH_INTERVAL_SECONDS = 300
+# action schemas older than ttl are still served while being reloaded in background
+ACTION_SCHEMA_CACHE_TTL_SECONDS = 60
+ACTION_SCHEMA_CACHE_SIZE = 1024
+# schemas of actions in a pack are loaded with this many threads after the pack is resolved,
+# set to 0 to load them lazily
+ACTION_SCHEMA_PREFETCH_CONCURRENCY = 8
 
 ADMIN_POLICY = 1
 DEPARTMENT_OWNERS = {"test_department": "department_user"}
@@ -64,9 +77,81 @@ SYSTEM_PASSWORD = "password"
 
 AIRFLOW_SERVER_URL = "https://airflow.example.com"
 AIRFLOW_JWT_EXPIRATION_SECONDS=86400
+# the jwt is refreshed in background once it is this close to expiry
+AIRFLOW_JWT_REFRESH_MARGIN_SECONDS = 300
 AIRFLOW_USERNAME = ""
 AIRFLOW_PASSWORD = ""
 AIRFLOW_DEFAULT_DAG_TAG = "helpdesk"
+# pool of the shared async http client, per worker process
+AIRFLOW_HTTP_MAX_CONNECTIONS = 100
+AIRFLOW_HTTP_TIMEOUT_SECONDS = 30
+# dag structure never changes for a dag version, cache it per worker,
+# set a dir to also keep it on local disk across restarts
+AIRFLOW_DAG_GRAPH_CACHE_SIZE = 512
+AIRFLOW_DAG_GRAPH_CACHE_DIR = ""
+# formatted logs of finished task tries, shared by workers on the host, empty dir to disable
+AIRFLOW_TASK_LOG_CACHE_DIR = ""
+AIRFLOW_TASK_LOG_CACHE_MAX_BYTES = 1024 * 1024 * 1024
+# airflow continuation tokens of the last tails of running task logs, per process
+AIRFLOW_TASK_LOG_TAIL_CACHE_SIZE = 1024
+# log search of /result_log scans the log as a stream and returns at most max matches
+LOG_SEARCH_MAX_MATCHES = 1000
+LOG_SEARCH_MAX_CONTEXT = 20
+# total time budget of the concurrent airflow requests behind a ticket result
+AIRFLOW_RESULT_TIMEOUT_SECONDS = 10
+
+# ticket result events poll the execution every interval, shared by all viewers of it
+EXECUTION_WATCH_INTERVAL_SECONDS = 3
+EXECUTION_WATCH_KEEPALIVE_SECONDS = 15
+# events queued for a viewer, a slower one gets a snapshot in place of the queued events
+EXECUTION_WATCH_QUEUE_SIZE = 100
+
+# versions of served ticket results kept per worker, to answer /result?since=<version> with deltas
+EXEC_RESULT_VERSIONS_CACHE_SIZE = 4096
+
+# circuit breakers of remote endpoints like airflow.dag_details, "default" applies to every endpoint.
+# a breaker opens after failure_threshold consecutive failures and fails calls fast,
+# after recovery_timeout seconds half_open_max_calls probes are let through
+CIRCUIT_BREAKERS = {
+    "default": {"failure_threshold": 5, "recovery_timeout": 30, "half_open_max_calls": 1},
+    "airflow.trigger_dag_run": {"failure_threshold": 3},
+}
+
+# the reconciler and the backfills below write to the db, run them in one process only,
+# e.g. set it to False in local_config of the web workers and run one more with it on
+RUN_BACKGROUND_TASKS = True
+
+# background sync of execution_status for submitted/running tickets, set interval to 0 to disable
+EXECUTION_RECONCILE_INTERVAL_SECONDS = 60
+EXECUTION_RECONCILE_BATCH_SIZE = 200
+EXECUTION_RECONCILE_WINDOW_DAYS = 7
+
+# fill ticket.current_status of the tickets created before the column, a run updates
+# all of them in batches and finds nothing to do afterwards, set interval to 0 to disable
+TICKET_STATUS_BACKFILL_INTERVAL_SECONDS = 3600
+TICKET_STATUS_BACKFILL_BATCH_SIZE = 500
+
+# index the tickets saved before the search index, `__icontains` searches of a worker use
+# the index once its check at the same interval finds every ticket indexed,
+# set interval to 0 to disable both
+TICKET_SEARCH_BACKFILL_INTERVAL_SECONDS = 3600
+TICKET_SEARCH_BACKFILL_BATCH_SIZE = 500
+# workers check the index up to this many seconds apart
+TICKET_SEARCH_BACKFILL_JITTER_SECONDS = 60
+
+# params of tickets indexed for the exact, IN and prefix filters of the ticket list,
+# provider_object => param names, the ones of "*" are indexed for every action. e.g.
+#   {"*": ["app"], "create_database": ["department", "db_type"]}
+# tickets are reindexed in the background after a change, set interval to 0 to disable
+TICKET_INDEXED_PARAMS = {}
+TICKET_PARAM_BACKFILL_INTERVAL_SECONDS = 3600
+TICKET_PARAM_BACKFILL_BATCH_SIZE = 500
+
+# batch ticket submission, auto approved tickets of a batch are executed with this
+# many in flight and started at most this many per second
+BATCH_SUBMIT_MAX_SIZE = 500
+BATCH_TRIGGER_CONCURRENCY = 8
+BATCH_TRIGGER_RATE_PER_SECOND = 10
 
 PREPROCESS_TICKET = [{"type": "test", "actions": ["test"]}]
 
@@ -1,14 +1,36 @@
 import time
 import json
+import asyncio
 import logging
+import threading
+from urllib.parse import quote
 
+import httpx
 import requests
 from airflow_client.client import ApiClient, Configuration
 from airflow_client.client.api import DAGApi, DagRunApi, TaskInstanceApi
+from airflow_client.client.models.dag_collection_response import DAGCollectionResponse
+from airflow_client.client.models.dag_details_response import DAGDetailsResponse
+from airflow_client.client.models.dag_run_collection_response import DAGRunCollectionResponse
+from airflow_client.client.models.dag_run_response import DAGRunResponse
+from airflow_client.client.models.dag_runs_batch_body import DAGRunsBatchBody
+from airflow_client.client.models.task_instance_collection_response import (
+    TaskInstanceCollectionResponse,
+)
+from airflow_client.client.models.task_instance_history_response import (
+    TaskInstanceHistoryResponse,
+)
 from airflow_client.client.models.trigger_dag_run_post_body import TriggerDAGRunPostBody
 
 from pydantic import BaseModel
 
+from helpdesk.libs.circuit_breaker import circuit_breaker, get_circuit_breaker, is_failure
+from helpdesk.config import (
+    AIRFLOW_HTTP_MAX_CONNECTIONS,
+    AIRFLOW_HTTP_TIMEOUT_SECONDS,
+    AIRFLOW_JWT_REFRESH_MARGIN_SECONDS,
+)
+
 logger = logging.getLogger(__name__)
 
 
@@ -46,28 +68,89 @@ class AirflowClientGetUserRolesException(AirflowClientException):
     pass
 
 
+def _refresh_margin(jwt_expire_seconds):
+    return min(AIRFLOW_JWT_REFRESH_MARGIN_SECONDS, jwt_expire_seconds / 2)
+
+
+class AirflowToken:
+    """jwt of an airflow user in a worker process, with the sync api client carrying it"""
+
+    def __init__(self, lock):
+        self.lock = lock
+        self.access_token = None
+        self.expire_at_ts = 0
+        self.api_client = None
+        self.refresh_task = None
+
+
+# (server_url, username) => AirflowToken, providers are re-created and share the token of
+# the user instead of logging in again, like `_async_http_clients`
+_tokens = {}
+_async_tokens = {}
+
+
+def get_token(server_url, username):
+    return _tokens.setdefault((server_url, username), AirflowToken(threading.Lock()))
+
+
+def get_async_token(server_url, username):
+    return _async_tokens.setdefault((server_url, username), AirflowToken(asyncio.Lock()))
+
+
 class AirflowClient:
+    """
+    sync airflow client, the jwt is refreshed by a single thread, and in background once
+    it is within the refresh margin of expiry. the token is rotated in place so the
+    connection pool of the api client is kept, both are shared by the clients of the user.
+    """
+
     def __init__(self, username, passwd, server_url, jwt_expire_seconds):
         self.server_url = server_url
         self.airflow_jwt_expire_seconds = jwt_expire_seconds
-        self.expire_at_ts = self._gen_expire_at_ts(self.airflow_jwt_expire_seconds)
+        self.refresh_margin = _refresh_margin(jwt_expire_seconds)
         self.username = username
         self.password = passwd
-        self.api_client = None
+        self.token = get_token(server_url, username)
 
     def get_api_client(self):
-        if self.api_client is None or time.time() > self.expire_at_ts:
-            self.expire_at_ts = self._gen_expire_at_ts(self.airflow_jwt_expire_seconds)
-            token = self.generate_token()
+        token = self.token
+        if token.api_client is None or time.time() > token.expire_at_ts:
+            with token.lock:
+                # refreshed by another thread while waiting
+                if token.api_client is None or time.time() > token.expire_at_ts:
+                    self._refresh_token()
+        elif time.time() > token.expire_at_ts - self.refresh_margin:
+            self._refresh_token_in_background()
+        return token.api_client
+
+    def _refresh_token(self):
+        token = self.generate_token()
+        if self.token.api_client is None:
             conf = Configuration(host=self.server_url, access_token=token.access_token)
-
-            if self.api_client is not None:
-                self.api_client.__exit__(None, None, None)
-
-            self.api_client = ApiClient(configuration=conf)
-            self.expire_at_ts = token.expire_at_ts
-
-        return self.api_client
+            self.token.api_client = ApiClient(configuration=conf)
+        else:
+            # auth settings read the token on every request
+            self.token.api_client.configuration.access_token = token.access_token
+        self.token.access_token = token.access_token
+        self.token.expire_at_ts = token.expire_at_ts
+
+    def _refresh_token_in_background(self):
+        if not self.token.lock.acquire(blocking=False):
+            # being refreshed
+            return None
+
+        def refresh():
+            try:
+                if time.time() > self.token.expire_at_ts - self.refresh_margin:
+                    self._refresh_token()
+            except Exception as e:
+                logger.warning("refresh airflow token in background failed: %s", e)
+            finally:
+                self.token.lock.release()
+
+        thread = threading.Thread(target=refresh, name="airflow-token-refresh", daemon=True)
+        thread.start()
+        return thread
 
     def generate_token(self):
         expire_at_ts = self._gen_expire_at_ts(self.airflow_jwt_expire_seconds)
@@ -86,20 +169,24 @@ class AirflowClient:
     def _gen_expire_at_ts(seconds=86400):
         return time.time() + seconds
 
+    @circuit_breaker("airflow.dags")
     def get_dags(self, tags=("helpdesk",)):
         dag_api = DAGApi(self.get_api_client())
         return dag_api.get_dags(tags=list(tags), tags_match_mode="all")
 
+    @circuit_breaker("airflow.dag_details")
     def get_schema_by_dag_id(self, dag_id):
         dag_api = DAGApi(self.get_api_client())
         return dag_api.get_dag_details(dag_id)
 
+    @circuit_breaker("airflow.trigger_dag_run")
     def trigger_dag(self, dag_id, conf=None, extra_info=None):
         dag_run_api = DagRunApi(self.get_api_client())
         return dag_run_api.trigger_dag_run(
             dag_id, TriggerDAGRunPostBody(conf=conf, note=extra_info)
         )
 
+    @circuit_breaker("airflow.dag_run")
     def get_dag_result(self, dag_id: str, dag_run_id: str):
         dag_run_api = DagRunApi(self.get_api_client())
         dag_run_status = dag_run_api.get_dag_run(dag_id, dag_run_id)
@@ -109,12 +196,14 @@ class AirflowClient:
 
         return dag_run_status, dag_instances
 
+    @circuit_breaker("airflow.task_log")
     def get_task_log(self, dag_id, dag_run_id, task_id, try_number):
         task_instance_api = TaskInstanceApi(self.get_api_client())
         return task_instance_api.get_log_without_preload_content(
             dag_id, dag_run_id, task_id, try_number
         )
 
+    @circuit_breaker("airflow.dag_graph")
     def get_dag_graph(self, dag_id: str, version: int = 1):
         api_client = self.get_api_client()
         graph_def_resp = api_client.call_api(
@@ -137,3 +226,243 @@ class AirflowClient:
 
     def build_graph_url(self, dag_id, dag_run_id):
         return f"{self.server_url}/dags/{dag_id}/runs/{dag_run_id}"
+
+
+_async_http_clients = {}
+
+
+def get_async_http_client(server_url):
+    """
+    one pooled httpx client per airflow server and worker process, shared by every
+    `AsyncAirflowClient` so connections survive provider re-creation
+    """
+    client = _async_http_clients.get(server_url)
+    if client is None or client.is_closed:
+        client = httpx.AsyncClient(
+            base_url=server_url,
+            timeout=AIRFLOW_HTTP_TIMEOUT_SECONDS,
+            limits=httpx.Limits(
+                max_connections=AIRFLOW_HTTP_MAX_CONNECTIONS,
+                max_keepalive_connections=AIRFLOW_HTTP_MAX_CONNECTIONS,
+            ),
+        )
+        _async_http_clients[server_url] = client
+    return client
+
+
+async def close_async_http_clients():
+    while _async_http_clients:
+        _, client = _async_http_clients.popitem()
+        await client.aclose()
+    # the locks and refresh tasks of async tokens belong to the closing event loop
+    while _async_tokens:
+        _, token = _async_tokens.popitem()
+        if token.refresh_task is not None:
+            token.refresh_task.cancel()
+
+
+class AsyncAirflowClient:
+    """asyncio counterpart of `AirflowClient`, returns the same airflow_client models"""
+
+    def __init__(self, username, passwd, server_url, jwt_expire_seconds):
+        self.server_url = server_url
+        self.airflow_jwt_expire_seconds = jwt_expire_seconds
+        self.refresh_margin = _refresh_margin(jwt_expire_seconds)
+        self.username = username
+        self.password = passwd
+        self.token = get_async_token(server_url, username)
+
+    @property
+    def http_client(self):
+        return get_async_http_client(self.server_url)
+
+    async def get_access_token(self):
+        token = self.token
+        if token.access_token is None or time.time() > token.expire_at_ts:
+            async with token.lock:
+                # refreshed by another coroutine while waiting
+                if token.access_token is None or time.time() > token.expire_at_ts:
+                    await self._refresh_token()
+        elif time.time() > token.expire_at_ts - self.refresh_margin and (
+            token.refresh_task is None or token.refresh_task.done()
+        ):
+            token.refresh_task = asyncio.create_task(self._refresh_token_in_background())
+        return token.access_token
+
+    async def _refresh_token(self):
+        token = await self.generate_token()
+        self.token.access_token = token.access_token
+        self.token.expire_at_ts = token.expire_at_ts
+
+    async def _refresh_token_in_background(self):
+        try:
+            async with self.token.lock:
+                if time.time() > self.token.expire_at_ts - self.refresh_margin:
+                    await self._refresh_token()
+        except Exception as e:
+            logger.warning("refresh airflow token in background failed: %s", e)
+
+    async def generate_token(self):
+        expire_at_ts = AirflowClient._gen_expire_at_ts(self.airflow_jwt_expire_seconds)
+        resp = await self.http_client.post(
+            "/auth/token",
+            json={"username": self.username, "password": self.password},
+        )
+        resp.raise_for_status()
+        if resp.status_code == 201:
+            result = resp.json()
+            result["expire_at_ts"] = expire_at_ts
+            return AirflowAccessTokenResponse(**result)
+        raise Exception("get token by username/passwd error: {}".format(resp.json()))
+
+    async def _request(self, method, path, raise_for_status=True, **kwargs):
+        token = await self.get_access_token()
+        headers = kwargs.pop("headers", {})
+        headers["Authorization"] = f"Bearer {token}"
+        resp = await self.http_client.request(method, path, headers=headers, **kwargs)
+        if raise_for_status:
+            resp.raise_for_status()
+        return resp
+
+    @circuit_breaker("airflow.dags")
+    async def get_dags(self, tags=("helpdesk",)):
+        resp = await self._request(
+            "GET", "/api/v2/dags", params={"tags": list(tags), "tags_match_mode": "all"}
+        )
+        return DAGCollectionResponse.from_dict(resp.json())
+
+    @circuit_breaker("airflow.dag_details")
+    async def get_schema_by_dag_id(self, dag_id):
+        resp = await self._request("GET", f"/api/v2/dags/{dag_id}/details")
+        return DAGDetailsResponse.from_dict(resp.json())
+
+    @circuit_breaker("airflow.trigger_dag_run")
+    async def trigger_dag(self, dag_id, conf=None, extra_info=None):
+        resp = await self._request(
+            "POST",
+            f"/api/v2/dags/{dag_id}/dagRuns",
+            json=TriggerDAGRunPostBody(conf=conf, note=extra_info).to_dict(),
+        )
+        return DAGRunResponse.from_dict(resp.json())
+
+    @circuit_breaker("airflow.dag_run")
+    async def get_dag_run(self, dag_id: str, dag_run_id: str):
+        resp = await self._request(
+            "GET", f"/api/v2/dags/{dag_id}/dagRuns/{quote(dag_run_id, safe='')}"
+        )
+        return DAGRunResponse.from_dict(resp.json())
+
+    @circuit_breaker("airflow.dag_runs_batch")
+    async def get_dag_runs_batch(
+        self, dag_ids, run_after_gte=None, page_offset=0, page_limit=100
+    ):
+        """list dag runs of many dags in one request"""
+        body = DAGRunsBatchBody(
+            dag_ids=list(dag_ids),
+            run_after_gte=run_after_gte,
+            order_by="id",
+            page_offset=page_offset,
+            page_limit=page_limit,
+        )
+        resp = await self._request(
+            "POST",
+            "/api/v2/dags/~/dagRuns/list",
+            json=body.model_dump(mode="json", exclude_none=True),
+        )
+        return DAGRunCollectionResponse.from_dict(resp.json())
+
+    @circuit_breaker("airflow.task_instances")
+    async def get_task_instances(self, dag_id: str, dag_run_id: str):
+        resp = await self._request(
+            "GET",
+            f"/api/v2/dags/{dag_id}/dagRuns/{quote(dag_run_id, safe='')}/taskInstances",
+        )
+        return TaskInstanceCollectionResponse.from_dict(resp.json())
+
+    @circuit_breaker("airflow.task_instance_try")
+    async def get_task_instance_try(self, dag_id, dag_run_id, task_id, try_number):
+        resp = await self._request(
+            "GET",
+            f"/api/v2/dags/{dag_id}/dagRuns/{quote(dag_run_id, safe='')}"
+            f"/taskInstances/{task_id}/tries/{try_number}",
+        )
+        return TaskInstanceHistoryResponse.from_dict(resp.json())
+
+    async def get_dag_result(self, dag_id: str, dag_run_id: str):
+        dag_run_status, dag_instances = await asyncio.gather(
+            self.get_dag_run(dag_id, dag_run_id),
+            self.get_task_instances(dag_id, dag_run_id),
+        )
+        return dag_run_status, dag_instances
+
+    @circuit_breaker("airflow.task_log")
+    async def get_task_log(self, dag_id, dag_run_id, task_id, try_number, token=None):
+        """
+        return the decoded json log, the sync client leaves `.read()` to the caller.
+        with the `continuation_token` of a previous response only the log after it is returned
+        """
+        resp = await self._request(
+            "GET",
+            f"/api/v2/dags/{dag_id}/dagRuns/{quote(dag_run_id, safe='')}"
+            f"/taskInstances/{task_id}/logs/{try_number}",
+            params={"token": token} if token else None,
+            headers={"Accept": "application/json"},
+        )
+        return resp.json()
+
+    async def stream_task_log(self, dag_id, dag_run_id, task_id, try_number):
+        """yield decoded log events one by one, without loading the whole log in memory"""
+        # generators can not be wrapped by the circuit breaker decorator
+        breaker = get_circuit_breaker("airflow.task_log")
+        breaker.before_call()
+        try:
+            token = await self.get_access_token()
+            async with self.http_client.stream(
+                "GET",
+                f"/api/v2/dags/{dag_id}/dagRuns/{quote(dag_run_id, safe='')}"
+                f"/taskInstances/{task_id}/logs/{try_number}",
+                headers={
+                    "Authorization": f"Bearer {token}",
+                    "Accept": "application/x-ndjson",
+                },
+            ) as resp:
+                resp.raise_for_status()
+                breaker.record_success()
+                async for line in resp.aiter_lines():
+                    if line.strip():
+                        yield json.loads(line)
+        except Exception as e:
+            if is_failure(e):
+                breaker.record_failure(e)
+            else:
+                breaker.record_success()
+            raise
+        except BaseException:
+            breaker.release_probe()
+            raise
+
+    @circuit_breaker("airflow.dag_graph")
+    async def get_dag_graph(self, dag_id: str, version: int = 1):
+        graph_def_resp = await self._request(
+            "GET",
+            "/ui/structure/structure_data",
+            params={
+                "dag_id": dag_id,
+                "external_dependencies": "false",
+                "version_number": version,
+            },
+            raise_for_status=False,
+        )
+        if graph_def_resp.status_code != 200:
+            logger.error(
+                "get dag_id %s graph info version %d err: %s",
+                dag_id,
+                version,
+                graph_def_resp.text,
+            )
+            return {}
+        else:
+            return graph_def_resp.json()
+
+    def build_graph_url(self, dag_id, dag_run_id):
+        return f"{self.server_url}/dags/{dag_id}/runs/{dag_run_id}"
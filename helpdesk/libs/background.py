@@ -0,0 +1,58 @@
+# coding: utf-8
+
+import random
+import asyncio
+import logging
+
+from helpdesk.libs.sentry import report
+
+logger = logging.getLogger(__name__)
+
+
+class PeriodicTask:
+    """
+    run a coroutine function every `interval` seconds in the event loop of a worker,
+    the first run is after `initial_delay` and up to `jitter` more seconds, so the
+    workers started together do not run it in lockstep
+    """
+
+    def __init__(self, name, func, interval, initial_delay=0, jitter=0):
+        self.name = name
+        self.func = func
+        self.interval = interval
+        self.initial_delay = initial_delay
+        self.jitter = jitter
+        self._task = None
+
+    def __repr__(self):
+        return "PeriodicTask(%s, interval=%s)" % (self.name, self.interval)
+
+    async def _run(self):
+        await asyncio.sleep(self.initial_delay + random.uniform(0, self.jitter))
+        while True:
+            try:
+                await self.func()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error("periodic task %s failed: %s", self.name, e)
+                report()
+            await asyncio.sleep(self.interval)
+
+    def start(self):
+        if self.interval <= 0:
+            logger.info("%s disabled", self)
+            return
+        if self._task is None or self._task.done():
+            logger.info("start %s", self)
+            self._task = asyncio.create_task(self._run(), name=self.name)
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
@@ -0,0 +1,263 @@
+# coding: utf-8
+
+import os
+import gzip
+import json
+import hashlib
+import logging
+import time
+import tempfile
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from starlette.concurrency import run_in_threadpool
+
+logger = logging.getLogger(__name__)
+
+_missing = object()
+
+
+class DiskCache:
+    """
+    json values stored one file per key under `directory`.
+    files are written to a temp file and renamed, so several worker processes can share it.
+    with `compress` values are gzipped, with `max_bytes` least recently read files are
+    removed once the directory grows over it. the size of the directory is tracked from the
+    writes of this process and rescanned at most every `RESCAN_SECONDS`, or once over it.
+    use `get_async` and `set_async` in the event loop, they do the file io in a thread.
+    """
+
+    TMP_PREFIX = ".tmp-"
+    RESCAN_SECONDS = 60
+    # evict down to this share of max_bytes, so a full cache is not rescanned on every write
+    EVICT_TO = 0.9
+
+    def __init__(self, directory, compress=False, max_bytes=None):
+        self.directory = directory
+        self.compress = compress
+        self.max_bytes = max_bytes
+        self._total = None
+        self._scanned_at = 0
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        digest = hashlib.sha1(json.dumps(key).encode("utf-8")).hexdigest()
+        return os.path.join(self.directory, digest)
+
+    def __contains__(self, key):
+        return os.path.exists(self._path(key))
+
+    def get(self, key, default=None):
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            if self.max_bytes:
+                # mtime is the last access time for eviction
+                os.utime(path)
+            if self.compress:
+                data = gzip.decompress(data)
+            return json.loads(data)
+        except FileNotFoundError:
+            return default
+        except Exception as e:
+            logger.warning("read disk cache %s failed: %s", key, e)
+            return default
+
+    async def get_async(self, key, default=None):
+        return await run_in_threadpool(self.get, key, default)
+
+    def set(self, key, value):
+        data = json.dumps(value).encode("utf-8")
+        if self.compress:
+            data = gzip.compress(data)
+        path = self._path(key)
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, prefix=self.TMP_PREFIX)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            replaced = self._size(path)
+            os.replace(tmp_path, path)
+        except Exception as e:
+            logger.warning("write disk cache %s failed: %s", key, e)
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return
+        if self.max_bytes:
+            with self._lock:
+                if self._total is not None:
+                    self._total += len(data) - replaced
+                if (
+                    self._total is None
+                    or self._total > self.max_bytes
+                    or time.monotonic() - self._scanned_at > self.RESCAN_SECONDS
+                ):
+                    self._evict()
+
+    async def set_async(self, key, value):
+        await run_in_threadpool(self.set, key, value)
+
+    def pop(self, key):
+        path = self._path(key)
+        size = self._size(path)
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            return
+        with self._lock:
+            if self._total is not None:
+                self._total -= size
+
+    @staticmethod
+    def _size(path):
+        try:
+            return os.stat(path).st_size
+        except FileNotFoundError:
+            return 0
+
+    def _evict(self):
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.startswith(self.TMP_PREFIX):
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        if total > self.max_bytes:
+            for _, size, path in sorted(entries):
+                if total <= self.max_bytes * self.EVICT_TO:
+                    break
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    # removed by another worker
+                    pass
+                total -= size
+        self._total = total
+        self._scanned_at = time.monotonic()
+
+
+class LRUCache:
+    """
+    thread safe in-memory lru cache, keys must be json serializable if `disk` is set.
+    with a `DiskCache` as `disk`, writes go through to disk and memory misses are loaded from it.
+    """
+
+    def __init__(self, maxsize=128, disk=None):
+        self.maxsize = maxsize
+        self.disk = disk
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def get(self, key, default=None):
+        with self._lock:
+            value = self._data.get(key, _missing)
+            if value is not _missing:
+                self._data.move_to_end(key)
+                return value
+        if self.disk is not None:
+            value = self.disk.get(key, _missing)
+            if value is not _missing:
+                self._set(key, value)
+                return value
+        return default
+
+    def _set(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def set(self, key, value):
+        self._set(key, value)
+        if self.disk is not None:
+            self.disk.set(key, value)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            value = self._data.pop(key, default)
+        if self.disk is not None:
+            self.disk.pop(key)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+class StaleWhileRevalidateCache:
+    """
+    values expire after `ttl` seconds, but an expired value is still returned right away
+    while a background thread reloads it with the `loader` of that key.
+    reloads are deduped per key, and the stale value is kept if a reload fails or returns None.
+    """
+
+    def __init__(self, ttl, maxsize=1024, max_workers=4):
+        self.ttl = ttl
+        self._data = LRUCache(maxsize=maxsize)
+        self._refreshing = set()
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="swr-cache"
+        )
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def get(self, key, loader):
+        """return the cached value of key, only load it synchronously on a cold miss"""
+        entry = self._data.get(key)
+        if entry is None:
+            value = loader()
+            if value is not None:
+                self.set(key, value)
+            return value
+        loaded_at, value = entry
+        if time.monotonic() - loaded_at >= self.ttl:
+            self.refresh(key, loader)
+        return value
+
+    def set(self, key, value):
+        self._data.set(key, (time.monotonic(), value))
+
+    def pop(self, key, default=None):
+        entry = self._data.pop(key)
+        return default if entry is None else entry[1]
+
+    def clear(self):
+        self._data.clear()
+
+    def refresh(self, key, loader):
+        """schedule a background reload of key, return the future or None if one is running"""
+        with self._lock:
+            if key in self._refreshing:
+                return None
+            self._refreshing.add(key)
+        return self._executor.submit(self._reload, key, loader)
+
+    def _reload(self, key, loader):
+        try:
+            value = loader()
+            if value is None:
+                logger.warning("reload %s got nothing, keep the stale value", key)
+                return None
+            self.set(key, value)
+            return value
+        except Exception as e:
+            logger.warning("reload %s failed, keep the stale value: %s", key, e)
+            return None
+        finally:
+            with self._lock:
+                self._refreshing.discard(key)
@@ -0,0 +1,224 @@
+# coding: utf-8
+
+import time
+import asyncio
+import logging
+import threading
+from functools import wraps
+
+import httpx
+import requests
+import urllib3
+
+from helpdesk.config import CIRCUIT_BREAKERS
+
+logger = logging.getLogger(__name__)
+
+
+class CircuitOpenError(Exception):
+    def __init__(self, name, retry_after):
+        self.name = name
+        self.retry_after = retry_after
+        super().__init__(f"circuit {name} is open, retry after {retry_after:.0f}s")
+
+
+class CircuitBreaker:
+    """
+    opens after `failure_threshold` consecutive failures and fails calls fast,
+    after `recovery_timeout` seconds it is half open and lets `half_open_max_calls`
+    probes through, a successful probe closes it and a failed one opens it again.
+    a cancelled probe is released, and probes still in flight after another
+    `recovery_timeout` are given up on, so the circuit is never half open for good.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, name, failure_threshold=5, recovery_timeout=30, half_open_max_calls=1):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+        self.half_open_max_calls = half_open_max_calls
+        self._state = self.CLOSED
+        self._failures = 0
+        self._opened_at = 0
+        self._probes = 0
+        self._probed_at = 0
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return "CircuitBreaker(%s, %s)" % (self.name, self.state)
+
+    @property
+    def state(self):
+        if self._state == self.OPEN and time.monotonic() - self._opened_at >= self.recovery_timeout:
+            return self.HALF_OPEN
+        return self._state
+
+    def before_call(self):
+        """raise `CircuitOpenError` if the call should not be made"""
+        with self._lock:
+            state = self.state
+            if state == self.CLOSED:
+                return
+            now = time.monotonic()
+            if (
+                self._state == self.HALF_OPEN
+                and now - self._probed_at >= self.recovery_timeout
+            ):
+                self._probes = 0
+            if state == self.HALF_OPEN and self._probes < self.half_open_max_calls:
+                self._state = self.HALF_OPEN
+                self._probes += 1
+                self._probed_at = now
+                return
+            if state == self.HALF_OPEN:
+                retry_after = max(self.recovery_timeout - (now - self._probed_at), 0)
+            else:
+                retry_after = max(self.recovery_timeout - (now - self._opened_at), 0)
+            raise CircuitOpenError(self.name, retry_after)
+
+    def record_success(self):
+        with self._lock:
+            if self._state != self.CLOSED:
+                logger.info("circuit %s closed", self.name)
+            self._state = self.CLOSED
+            self._failures = 0
+            self._probes = 0
+
+    def release_probe(self):
+        """the call was cancelled, it says nothing about the remote, let another probe through"""
+        with self._lock:
+            if self._state == self.HALF_OPEN and self._probes > 0:
+                self._probes -= 1
+
+    def record_failure(self, error=None):
+        with self._lock:
+            self._failures += 1
+            if self._state == self.HALF_OPEN or self._failures >= self.failure_threshold:
+                if self._state != self.OPEN:
+                    logger.warning(
+                        "circuit %s opened after %s failures, last error: %s",
+                        self.name,
+                        self._failures,
+                        error,
+                    )
+                self._state = self.OPEN
+                self._opened_at = time.monotonic()
+                self._probes = 0
+
+    def reset(self):
+        self.record_success()
+
+    def to_dict(self):
+        state = self.state
+        return dict(
+            name=self.name,
+            state=state,
+            failures=self._failures,
+            failure_threshold=self.failure_threshold,
+            recovery_timeout=self.recovery_timeout,
+            retry_after=(
+                max(self.recovery_timeout - (time.monotonic() - self._opened_at), 0)
+                if state == self.OPEN
+                else 0
+            ),
+        )
+
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def get_circuit_breaker(name) -> CircuitBreaker:
+    """breakers are per process, settings of name in `CIRCUIT_BREAKERS` override the default"""
+    breaker = _breakers.get(name)
+    if breaker is None:
+        with _breakers_lock:
+            breaker = _breakers.get(name)
+            if breaker is None:
+                settings = dict(CIRCUIT_BREAKERS.get("default", {}))
+                settings.update(CIRCUIT_BREAKERS.get(name, {}))
+                breaker = _breakers[name] = CircuitBreaker(name, **settings)
+    return breaker
+
+
+def all_circuit_breakers():
+    return sorted(_breakers.values(), key=lambda b: b.name)
+
+
+# errors of a remote that is down or too slow to answer
+UNAVAILABLE_ERRORS = (
+    TimeoutError,
+    asyncio.TimeoutError,
+    ConnectionError,
+    httpx.TransportError,
+    requests.RequestException,
+    urllib3.exceptions.HTTPError,
+)
+
+
+def is_failure(error):
+    """
+    5xx responses, timeouts and transport errors count as failures, other errors
+    like 404 mean the remote is up.
+    """
+    status = getattr(error, "status", None)
+    if status is None:
+        status = getattr(getattr(error, "response", None), "status_code", None)
+    if isinstance(status, int):
+        return status >= 500
+    return isinstance(error, UNAVAILABLE_ERRORS)
+
+
+def circuit_breaker(name):
+    """guard a function or coroutine function with the circuit breaker of `name`"""
+
+    def _wrapper(func):
+        if asyncio.iscoroutinefunction(func):
+
+            @wraps(func)
+            async def _(*args, **kwargs):
+                breaker = get_circuit_breaker(name)
+                breaker.before_call()
+                try:
+                    ret = await func(*args, **kwargs)
+                except Exception as e:
+                    if is_failure(e):
+                        breaker.record_failure(e)
+                    else:
+                        breaker.record_success()
+                    raise
+                except BaseException:
+                    # cancelled, e.g. the client went away
+                    breaker.release_probe()
+                    raise
+                breaker.record_success()
+                return ret
+
+            return _
+        else:
+
+            @wraps(func)
+            def _(*args, **kwargs):
+                breaker = get_circuit_breaker(name)
+                breaker.before_call()
+                try:
+                    ret = func(*args, **kwargs)
+                except Exception as e:
+                    if is_failure(e):
+                        breaker.record_failure(e)
+                    else:
+                        breaker.record_success()
+                    raise
+                except BaseException:
+                    # cancelled, e.g. the client went away
+                    breaker.release_probe()
+                    raise
+                breaker.record_success()
+                return ret
+
+            return _
+
+    return _wrapper
@@ -66,7 +66,12 @@ def extract_filter_from_query_params(query_params=None, model=None, exclude_keys
         try:
             if key.endswith("__icontains"):
                 key = key.split("__icontains")[0]
-                filter_ = and_(filter_, model.__table__.c[key].like(f"%{value}%"))
+                like = model.__table__.c[key].like(f"%{value}%")
+                # a search index of the model narrows down the rows LIKE rechecks
+                search = None
+                if hasattr(model, "search_filter"):
+                    search = model.search_filter(key, value)
+                filter_ = and_(filter_, like if search is None else and_(search, like))
             elif key.endswith("__in"):
                 key = key.split("__in")[0]
                 value = value.split(",")
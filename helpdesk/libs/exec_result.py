@@ -0,0 +1,72 @@
+# coding: utf-8
+
+import json
+import hashlib
+
+from helpdesk.config import EXEC_RESULT_VERSIONS_CACHE_SIZE
+from helpdesk.libs.cache import LRUCache
+
+DAG_RUN_FIELDS = ("ticket_id", "status", "start_timestamp", "result_url")
+
+# version => (task versions, graph node versions) of recently served results, per process
+_result_versions = LRUCache(maxsize=EXEC_RESULT_VERSIONS_CACHE_SIZE)
+
+
+def _hash(obj):
+    return hashlib.sha1(
+        json.dumps(obj, sort_keys=True, ensure_ascii=False).encode("utf-8")
+    ).hexdigest()
+
+
+def exec_result_version(result):
+    """
+    version of a dumped exec result, changes whenever the dag run, a task or a graph node changes.
+    the per task and per node versions are kept to answer `delta_exec_result` later.
+    """
+    tasks = {t["task_id"]: _hash(t) for t in result["result"]["tasks"]}
+    nodes = {n["key"]: _hash(n) for n in result["graph"].get("nodeDataArray") or []}
+    version = _hash(
+        [
+            [result.get(f) for f in DAG_RUN_FIELDS],
+            sorted(tasks.items()),
+            sorted(nodes.items()),
+        ]
+    )[:20]
+    _result_versions.set(version, (tasks, nodes))
+    return version
+
+
+def delta_exec_result(result, since):
+    """
+    the dumped exec result with only the tasks and graph nodes changed after version `since`,
+    return None if `since` is unknown, the full result should be sent then
+    """
+    versions = _result_versions.get(since)
+    if versions is None:
+        return None
+    tasks, nodes = versions
+    current_tasks = result["result"]["tasks"]
+    current_nodes = result["graph"].get("nodeDataArray") or []
+    delta = dict(result)
+    delta["result"] = dict(
+        result["result"],
+        tasks=[t for t in current_tasks if tasks.get(t["task_id"]) != _hash(t)],
+    )
+    delta["graph"] = dict(
+        result["graph"],
+        nodeDataArray=[n for n in current_nodes if nodes.get(n["key"]) != _hash(n)],
+        linkDataArray=[],
+    )
+    current_task_ids = {t["task_id"] for t in current_tasks}
+    delta["removed_tasks"] = [task_id for task_id in tasks if task_id not in current_task_ids]
+    return delta
+
+
+def etag_matches(if_none_match, version):
+    if not if_none_match:
+        return False
+    for tag in if_none_match.split(","):
+        tag = tag.strip()
+        if tag == "*" or tag.removeprefix("W/").strip('"') == version:
+            return True
+    return False
@@ -0,0 +1,54 @@
+# coding: utf-8
+
+import re
+from collections import deque
+
+
+def compile_queries(queries, regex=False, ignore_case=False):
+    """
+    one pattern matching any of `queries`, literal strings unless `regex`,
+    raise `re.error` on a bad regex
+    """
+    if not regex:
+        queries = [re.escape(q) for q in queries]
+    return re.compile(
+        "|".join(f"(?:{q})" for q in queries), re.IGNORECASE if ignore_case else 0
+    )
+
+
+async def search_log(lines, pattern, context=0, offset=0, max_matches=1000):
+    """
+    scan log `lines` starting at line `offset` and keep only the matched lines,
+    each with its offset, the spans to highlight and up to `context` lines around it.
+    context lines are never repeated: `before` stops at the previous match or its `after`,
+    a matched line inside another one's `after` is a match of its own.
+    stop at `max_matches`, `next_offset` is where to continue the search then.
+    """
+    before = deque(maxlen=context)
+    matches = []
+    after_left = 0
+    line_no = offset
+    truncated = False
+    async for line in lines:
+        spans = [list(m.span()) for m in pattern.finditer(line) if m.end() > m.start()]
+        if spans:
+            if len(matches) >= max_matches:
+                truncated = True
+                break
+            matches.append(
+                dict(offset=line_no, line=line, spans=spans, before=list(before), after=[])
+            )
+            before.clear()
+            after_left = context
+        elif after_left > 0:
+            matches[-1]["after"].append(line)
+            after_left -= 1
+        else:
+            before.append(line)
+        line_no += 1
+    return dict(
+        matches=matches,
+        scanned_lines=line_no - offset,
+        truncated=truncated,
+        next_offset=line_no,
+    )
@@ -70,7 +70,7 @@ class ActionSchema(BaseModel):
     params_json_schema: Dict[str, Any]
     pack: str
     runner_type: RunnerType
-    highlight_queries: Optional[str] = None
+    highlight_queries: Optional[List[str]] = None
     pretty_log_formatter: Optional[Dict[str, Any]] = None
     status_filter: Optional[Tuple[str]] = None
 
@@ -116,7 +116,7 @@ class TicketExecTaskDetails(BaseModel):
     succeeded: bool
     stdout: str | Dict[str, Any]
     stderr: str | Dict[str, Any]
-    highlight_queries: str
+    highlight_queries: List[str] = []
 
 
 class TicketExecTaskInfo(BaseModel):
@@ -0,0 +1,136 @@
+# coding: utf-8
+
+import json
+import asyncio
+import logging
+
+from helpdesk.config import EXECUTION_WATCH_QUEUE_SIZE
+from helpdesk.libs.sentry import report
+from helpdesk.libs.types import TicketExecStatus
+
+logger = logging.getLogger(__name__)
+
+FINISHED_EXEC_STATUSES = (TicketExecStatus.SUCCESS, TicketExecStatus.FAILED)
+
+_watchers = {}
+
+
+def dump_exec_result(result):
+    return result.model_dump(mode="json", by_alias=True)
+
+
+def diff_exec_result(previous, current):
+    """
+    events to bring a subscriber from `previous` to `current` dumped exec result:
+    `dag_run` if status changed, one `task` per changed task and one `node` per changed graph node
+    """
+    events = []
+    dag_run_fields = ("status", "start_timestamp", "result_url")
+    if any(previous.get(f) != current.get(f) for f in dag_run_fields):
+        events.append(("dag_run", {f: current.get(f) for f in dag_run_fields}))
+
+    previous_tasks = {t["task_id"]: t for t in previous["result"]["tasks"]}
+    for task in current["result"]["tasks"]:
+        if previous_tasks.get(task["task_id"]) != task:
+            events.append(("task", task))
+
+    previous_nodes = {n["key"]: n for n in previous["graph"].get("nodeDataArray") or []}
+    for node in current["graph"].get("nodeDataArray") or []:
+        if previous_nodes.get(node["key"]) != node:
+            events.append(("node", node))
+    return events
+
+
+class ExecutionWatcher:
+    """
+    polls one execution with `poll` every `interval` seconds for all of its subscribers,
+    so N viewers cost one poll loop. the loop stops when the execution is finished or
+    the last subscriber leaves. a subscriber too slow to keep up with its bounded queue
+    has the queued events replaced by a snapshot.
+    """
+
+    def __init__(self, key, poll, interval):
+        self.key = key
+        self.poll = poll
+        self.interval = interval
+        self.snapshot = None
+        self.finished = False
+        self._subscribers = set()
+        self._task = None
+
+    def __repr__(self):
+        return "ExecutionWatcher(%s, subscribers=%s)" % (self.key, len(self._subscribers))
+
+    def subscribe(self):
+        """return a queue of (event, data), starting with a `snapshot` of the execution"""
+        queue = asyncio.Queue(maxsize=EXECUTION_WATCH_QUEUE_SIZE)
+        self._put_snapshot(queue)
+        self._subscribers.add(queue)
+        if not self.finished and (self._task is None or self._task.done()):
+            self._task = asyncio.create_task(self._run(), name=f"watch-{self.key}")
+        return queue
+
+    def unsubscribe(self, queue):
+        self._subscribers.discard(queue)
+        if not self._subscribers:
+            if self._task is not None:
+                self._task.cancel()
+            if _watchers.get(self.key) is self:
+                del _watchers[self.key]
+
+    def _put_snapshot(self, queue):
+        if self.snapshot is not None:
+            queue.put_nowait(("snapshot", self.snapshot))
+            if self.finished:
+                queue.put_nowait(("end", {"status": self.snapshot["status"]}))
+
+    def _publish(self, event, data):
+        for queue in self._subscribers:
+            try:
+                queue.put_nowait((event, data))
+            except asyncio.QueueFull:
+                # the snapshot is already the latest result, the deltas are not needed
+                while not queue.empty():
+                    queue.get_nowait()
+                self._put_snapshot(queue)
+                if queue.empty():
+                    queue.put_nowait((event, data))
+
+    async def _run(self):
+        while True:
+            try:
+                result, msg = await self.poll()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                report()
+                result, msg = None, str(e)
+
+            if result is None:
+                logger.warning("watch execution %s failed: %s", self.key, msg)
+                self._publish("error", {"msg": msg})
+            else:
+                current = dump_exec_result(result)
+                previous, self.snapshot = self.snapshot, current
+                if previous is None:
+                    self._publish("snapshot", current)
+                else:
+                    for event, data in diff_exec_result(previous, current):
+                        self._publish(event, data)
+                if result.status in FINISHED_EXEC_STATUSES:
+                    self.finished = True
+                    self._publish("end", {"status": current["status"]})
+                    return
+            await asyncio.sleep(self.interval)
+
+
+def get_execution_watcher(key, poll, interval):
+    """the shared watcher of execution `key`, created with `poll` if no one watches it yet"""
+    watcher = _watchers.get(key)
+    if watcher is None or (watcher.finished and not watcher._subscribers):
+        watcher = _watchers[key] = ExecutionWatcher(key, poll, interval)
+    return watcher
+
+
+def format_sse(event, data):
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
@@ -1,21 +1,80 @@
 # coding: utf-8
 
+import asyncio
 import logging
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from typing import Dict, Any
+from typing import Dict, Any, Iterable
 from fastapi import HTTPException
 
-from helpdesk.libs.decorators import timed_cache
+from helpdesk.libs.cache import StaleWhileRevalidateCache
 from helpdesk.libs.preprocess import get_preprocess
+from helpdesk.libs.ratelimit import RateLimiter
 from helpdesk.libs.rest import DictSerializableClassMixin
 from helpdesk.libs.types import ActionSchema
 from helpdesk.models.db.ticket import Ticket, TicketPhase
-from helpdesk.config import PARAM_FILLUP, TICKET_CALLBACK_PARAMS, PREPROCESS_TICKET
+from helpdesk.config import (
+    PARAM_FILLUP,
+    TICKET_CALLBACK_PARAMS,
+    PREPROCESS_TICKET,
+    ACTION_SCHEMA_CACHE_TTL_SECONDS,
+    ACTION_SCHEMA_CACHE_SIZE,
+    ACTION_SCHEMA_PREFETCH_CONCURRENCY,
+    BATCH_TRIGGER_CONCURRENCY,
+    BATCH_TRIGGER_RATE_PER_SECOND,
+)
 from helpdesk.views.api.schemas import ApproverType
 from helpdesk.models.provider.base import BaseProvider
 
 logger = logging.getLogger(__name__)
 
+# (provider type, target object) => ActionSchema
+action_schema_cache = StaleWhileRevalidateCache(
+    ttl=ACTION_SCHEMA_CACHE_TTL_SECONDS, maxsize=ACTION_SCHEMA_CACHE_SIZE
+)
+
+
+def prefetch_action_schemas(
+    provider: BaseProvider,
+    target_objects: Iterable[str],
+    concurrency: int = ACTION_SCHEMA_PREFETCH_CONCURRENCY,
+) -> int:
+    """
+    load schemas not in the action schema cache yet with `concurrency` threads,
+    return the number of schemas loaded
+    """
+    missing = [
+        target_object
+        for target_object in target_objects
+        if (provider.provider_type, target_object) not in action_schema_cache
+    ]
+    if concurrency <= 0 or not missing:
+        return 0
+
+    def load(target_object):
+        try:
+            return provider.get_action_schema(target_object)
+        except Exception as e:
+            logger.warning("prefetch action schema %s failed: %s", target_object, e)
+            return None
+
+    loaded = 0
+    with ThreadPoolExecutor(
+        max_workers=min(concurrency, len(missing)), thread_name_prefix="schema-prefetch"
+    ) as executor:
+        for target_object, action_schema in zip(
+            missing, executor.map(load, missing)
+        ):
+            if action_schema:
+                action_schema_cache.set(
+                    (provider.provider_type, target_object), action_schema
+                )
+                loaded += 1
+    logger.info(
+        "prefetched %s/%s action schemas of %s", loaded, len(missing), provider.provider_type
+    )
+    return loaded
+
 
 class ActionResolveError(Exception):
     pass
@@ -40,12 +99,15 @@ class Action(DictSerializableClassMixin):
 
     __str__ = __repr__
 
-    @timed_cache(seconds=60)
     def resolve_action(self, provider: BaseProvider) -> ActionSchema:
         """
-        return detailed action infos from the provider
+        return detailed action infos from the provider,
+        a stale one is returned while it is being reloaded in background
         """
-        action_info = provider.get_action_schema(self.target_object)
+        action_info = action_schema_cache.get(
+            (provider.provider_type, self.target_object),
+            lambda: provider.get_action_schema(self.target_object),
+        )
         if not action_info:
             raise ActionResolveError(f"resolve action {self.target_object} failed")
         return action_info
@@ -77,10 +139,14 @@ class Action(DictSerializableClassMixin):
             action_d["params_json_schema"] = action.params_json_schema
         return action_d
 
-    async def run(self, provider, form, user):
+    async def build_params(self, parameters, form):
+        """
+        validate the form against `parameters` and preprocess it,
+        return (params, extra_params, msg), params is None if the form is invalid
+        """
         params = {}
         extra_params = {}
-        for k, v in self.parameters(provider, user).items():
+        for k, v in parameters.items():
             if k in TICKET_CALLBACK_PARAMS:
                 extra_params[k] = "-"
             if k in PARAM_FILLUP:
@@ -96,7 +162,7 @@ class Action(DictSerializableClassMixin):
             if v.get("required") and v.get("default") is None and not live_value:
                 msg = "miss a value for a required parameter, aborting."
                 logger.error(msg)
-                return None, msg
+                return None, extra_params, msg
             if live_value is not None:
                 if v.get("type") == "boolean":
                     if live_value in ("true", "True", "TRUE", True):
@@ -113,9 +179,18 @@ class Action(DictSerializableClassMixin):
                 if not success:
                     return (
                         None,
+                        extra_params,
                         "Failed to preprocess the params, please check ticket params",
                     )
-        # create ticket
+        return params, extra_params, ""
+
+    async def prepare_ticket(
+        self, provider, params, extra_params, user, associates=None, policies=None
+    ):
+        """
+        build a ticket on its flow policy and pre approve it, without saving it,
+        see `Ticket.get_flow_policy` for `associates` and `policies`
+        """
         ticket = Ticket(
             title=self.name,
             provider_type=provider.provider_type,
@@ -126,7 +201,7 @@ class Action(DictSerializableClassMixin):
             reason=params.get("reason"),
             created_at=datetime.now(),
         )
-        policy = await ticket.get_flow_policy()
+        policy = await ticket.get_flow_policy(associates=associates, policies=policies)
         if not policy:
             return None, "Failed to get ticket flow policy"
 
@@ -149,6 +224,19 @@ class Action(DictSerializableClassMixin):
         ret, msg = await ticket.pre_approve()
         if not ret:
             return None, msg
+        return ticket, ""
+
+    async def run(self, provider, form, user):
+        params, extra_params, msg = await self.build_params(
+            self.parameters(provider, user), form
+        )
+        if params is None:
+            return None, msg
+
+        # create ticket
+        ticket, msg = await self.prepare_ticket(provider, params, extra_params, user)
+        if not ticket:
+            return None, msg
 
         id_ = await ticket.save()
         ticket_added = await Ticket.get(id_)
@@ -164,10 +252,10 @@ class Action(DictSerializableClassMixin):
             )
 
         # if this ticket is auto approved, execute it immediately
-        execution, msg = ticket_added.execute()
+        execution, msg = await ticket_added.execute()
         if execution:
             await ticket_added.notify(TicketPhase.REQUEST)
-        await ticket_added.save()
+        await ticket_added.save_execution()
 
         if not execution:
             raise HTTPException(
@@ -177,3 +265,80 @@ class Action(DictSerializableClassMixin):
             ticket_added.to_dict(),
             "Success. Your request has been approved automatically, please go to ticket page for details",
         )
+
+    async def run_batch(
+        self,
+        provider,
+        forms,
+        user,
+        concurrency=BATCH_TRIGGER_CONCURRENCY,
+        rate=BATCH_TRIGGER_RATE_PER_SECOND,
+    ):
+        """
+        submit one ticket per form, the flow policy is resolved once for the action,
+        tickets are inserted in one transaction, and auto approved ones are executed
+        with at most `concurrency` in flight and `rate` started per second.
+        return one dict(success, ticket, msg) per form
+        """
+        results = [None] * len(forms)
+        parameters = self.parameters(provider, user)
+        associates = await Ticket.get_flow_associates(self.target_object)
+        policies = {}
+
+        prepared = []
+        for index, form in enumerate(forms):
+            params, extra_params, msg = await self.build_params(parameters, form)
+            ticket = None
+            if params is not None:
+                ticket, msg = await self.prepare_ticket(
+                    provider, params, extra_params, user, associates, policies
+                )
+            if not ticket:
+                results[index] = dict(success=False, ticket=None, msg=msg)
+                continue
+            prepared.append((index, ticket))
+
+        await Ticket.bulk_insert([ticket for _, ticket in prepared])
+
+        semaphore = asyncio.Semaphore(max(concurrency, 1))
+        rate_limiter = RateLimiter(rate, burst=max(concurrency, 1))
+
+        async def submit(index, ticket):
+            async with semaphore:
+                if not ticket.is_approved:
+                    await ticket.notify(TicketPhase.REQUEST)
+                    results[index] = dict(
+                        success=True,
+                        ticket=ticket.to_dict(),
+                        msg="Success. Your request has been submitted, please wait for approval.",
+                    )
+                    return None
+
+                try:
+                    async with rate_limiter:
+                        execution, msg = await ticket.execute()
+                except Exception as e:
+                    # one broken item should not fail the batch, the ticket is kept
+                    logger.exception(e)
+                    execution, msg = None, str(e)
+                if execution:
+                    await ticket.notify(TicketPhase.REQUEST)
+                    msg = "Success. Your request has been approved automatically"
+                else:
+                    msg = f"Ticket execute failed: {msg[:100]}"
+                results[index] = dict(
+                    success=bool(execution), ticket=ticket.to_dict(), msg=msg
+                )
+                return ticket
+
+        executed = await asyncio.gather(
+            *[submit(index, ticket) for index, ticket in prepared]
+        )
+        executed = [ticket for ticket in executed if ticket]
+        updated = await Ticket.bulk_update(executed, ["annotation", "executed_at"])
+        if updated < len(executed):
+            # rows changed meanwhile were skipped, merge the execution into them one by one,
+            # it is a no-op for the tickets already updated
+            for ticket in executed:
+                await ticket.save_execution()
+        return results
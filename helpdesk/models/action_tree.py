@@ -1,59 +1,65 @@
 # coding: utf-8
 
 import logging
+import threading
+from collections import defaultdict, namedtuple
 
-from helpdesk.libs.decorators import cached_property_with_ttl
-from helpdesk.models.action import Action
+from starlette.concurrency import run_in_threadpool
+
+from helpdesk.models.action import Action, prefetch_action_schemas
 from helpdesk.models.provider import get_provider
 from helpdesk.config import ACTION_TREE_CONFIG
-from helpdesk.models.provider.errors import ResolvePackageError, InitProviderError
 from helpdesk.libs.sentry import report
 
 logger = logging.getLogger(__name__)
 
+# what a node is built into, `refresh` swaps the whole of it by one assignment
+TreeState = namedtuple("TreeState", ["name", "action", "is_leaf", "packs", "nexts"])
+
 
 class ActionTree:
-    def __init__(self, tree_config, level=0):
-        self.name = None
-        self._nexts = []
+    """
+    tree of actions built from the config, packs are left empty until `refresh` resolves them,
+    so building a tree never touches the network.
+    """
+
+    def __init__(self, tree_config, level=0, packs=None):
         self.parent = None
-        self.action = None
-        self.is_leaf = False
         self.level = level
         self.config = tree_config
-
-        self.build_from_config(tree_config)
+        self._refresh_lock = threading.Lock()
+        # packs: provider object of pack => resolved sub tree config
+        self._state = self.build_from_config(tree_config, packs if packs is not None else {})
 
     def __str__(self):
         return "ActionTree(%s, level=%s)" % (self.config, self.level)
 
     __repr__ = __str__
 
-    def build_from_config(self, config):
+    def build_from_config(self, config, packs):
         assert type(config) is list, "expect %s, got %s: %s" % (
             "list",
             type(config),
             config,
         )
         if not config:
-            return
-        self.name = config[0]
+            return TreeState(None, None, False, packs, [])
+        name = config[0]
         if any(not isinstance(c, str) for c in config):
+            nexts = []
             for subconfig in config[1]:
-                subtree = ActionTree(subconfig, level=self.level + 1)
+                subtree = ActionTree(subconfig, level=self.level + 1, packs=packs)
                 subtree.parent = self
-                self._nexts.append(subtree)
-        else:
-            # leaf
-            provider_object = config[-1]
-            if provider_object.endswith("."):
-                # pack
-                pack_sub_tree_config = self.resolve_pack(*config)
-                self.build_from_config(pack_sub_tree_config)
-            else:
-                # leaf action
-                self.action = Action(*config)
-                self.is_leaf = True
+                nexts.append(subtree)
+            return TreeState(name, None, False, packs, nexts)
+        # leaf
+        provider_object = config[-1]
+        if provider_object.endswith("."):
+            # pack
+            pack_sub_tree_config = packs.get(provider_object, [name, []])
+            return self.build_from_config(pack_sub_tree_config, packs)
+        # leaf action
+        return TreeState(name, Action(*config), True, packs, [])
 
     def resolve_pack(self, *config):
         name = config[0]
@@ -61,54 +67,112 @@ class ActionTree:
         provider_type = config[-2]
         pack = provider_object[:-1]
 
-        sub_actions = []
-        actions = []
-
-        try:
-            system_provider = get_provider(provider_type)
-            actions = system_provider.get_actions_info(pack=pack)
-        except (InitProviderError, ResolvePackageError) as e:
-            logger.error(f"Resolve pack {name} error:\n{e.tb}")
-            # insert a empty children to failed action tree
-            # so we can tolerant provider partially failed
-            # and frontend can check children empty to notify user
-            report()
+        system_provider = get_provider(provider_type)
+        actions = system_provider.get_actions_info(pack=pack)
 
+        sub_actions = []
         for action in actions:
             sub_actions.append(
                 [action.name, action.description, provider_type, action.action_id]
             )
         return [name, sub_actions]
 
-    @cached_property_with_ttl(300)
-    def nexts(self):
-        # if is pack, re-calc it
-        if all(isinstance(c, str) for c in self.config):
-            if self.config[-1].endswith("."):
-                logger.warn("recalc %s", self)
-                self._nexts = []
-                pack_sub_tree_config = self.resolve_pack(*self.config)
-                self.build_from_config(pack_sub_tree_config)
+    def iter_pack_configs(self, config=None):
+        config = self.config if config is None else config
+        if not config:
+            return
+        if any(not isinstance(c, str) for c in config):
+            for subconfig in config[1]:
+                yield from self.iter_pack_configs(subconfig)
+        elif config[-1].endswith("."):
+            yield config
 
-        return self._nexts
+    def refresh(self, prefetch=True):
+        """
+        resolve all packs into a new tree and swap its state in,
+        readers keep using the old state until the swap.
+        with `prefetch` schemas of the pack actions are warmed up after the swap,
+        so the first click on an action of a pack is not a cold miss.
+        """
+        with self._refresh_lock:
+            packs = {}
+            for pack_config in self.iter_pack_configs():
+                provider_object = pack_config[-1]
+                try:
+                    packs[provider_object] = self.resolve_pack(*pack_config)
+                except Exception as e:
+                    # InitProviderError and ResolvePackageError carry the traceback
+                    logger.error(
+                        "Resolve pack %s error:\n%s", pack_config[0], getattr(e, "tb", e)
+                    )
+                    # keep the children of last refresh, a pack never resolved stays empty
+                    # so we can tolerant provider partially failed
+                    # and frontend can check children empty to notify user
+                    report()
+                    if provider_object in self.packs:
+                        packs[provider_object] = self.packs[provider_object]
+
+            tree = ActionTree(self.config, level=self.level, packs=packs)
+            for node in tree.nexts:
+                node.parent = self
+            self._state = tree._state
+
+        if prefetch:
+            # out of the lock, the next refresh is not held up by slow schemas
+            self.prefetch_pack_schemas(packs)
+        return self
+
+    @staticmethod
+    def prefetch_pack_schemas(packs):
+        target_objects = defaultdict(list)
+        for _, sub_actions in packs.values():
+            for *_, provider_type, target_object in sub_actions:
+                target_objects[provider_type].append(target_object)
+        for provider_type, objs in target_objects.items():
+            try:
+                prefetch_action_schemas(get_provider(provider_type), objs)
+            except Exception as e:
+                logger.warning("prefetch action schemas of %s failed: %s", provider_type, e)
+
+    @property
+    def name(self):
+        return self._state.name
+
+    @property
+    def action(self):
+        return self._state.action
+
+    @property
+    def is_leaf(self):
+        return self._state.is_leaf
+
+    @property
+    def packs(self):
+        return self._state.packs
+
+    @property
+    def nexts(self):
+        return self._state.nexts
 
     @property
     def key(self):
         return "{level}-{name}".format(level=self.level, name=self.name)
 
     def first(self):
-        if self.action:
+        state = self._state
+        if state.action:
             return self
-        if not self._nexts:
+        if not state.nexts:
             return self
-        return self._nexts[0].first()
+        return state.nexts[0].first()
 
     def find(self, obj):
         if not obj:
             return None
-        if self.action:
-            return self if self.action.target_object == obj else None
-        for sub in self._nexts:
+        state = self._state
+        if state.action:
+            return self if state.action.target_object == obj else None
+        for sub in state.nexts:
             ret = sub.find(obj)
             if ret is not None:
                 return ret
@@ -117,7 +181,7 @@ class ActionTree:
         if not tree_node:
             return []
         return self.path_to(tree_node.parent, pattern) + [
-            pattern.format(**tree_node.__dict__) if pattern else tree_node
+            pattern.format(level=tree_node.level, name=tree_node.name) if pattern else tree_node
         ]
 
     def get_tree_list(self, node_formatter):
@@ -149,3 +213,7 @@ class ActionTree:
 
 
 action_tree = ActionTree(ACTION_TREE_CONFIG)
+
+
+async def refresh_action_tree():
+    await run_in_threadpool(action_tree.refresh)
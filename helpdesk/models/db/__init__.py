@@ -1,12 +1,19 @@
 # coding: utf-8
 
+import json
+import time
+import base64
 import logging
+from contextlib import asynccontextmanager
 from datetime import datetime
 
 from sqlalchemy import Column, Integer, String, JSON, Boolean, DateTime  # NOQA
-from sqlalchemy.sql import select, func
+from sqlalchemy.dialects import mysql, postgresql
+from sqlalchemy.sql import select, func, case, literal, and_, or_
 from sqlalchemy.ext.declarative import declarative_base
 
+from helpdesk.config import TICKET_COUNT_CACHE_SIZE
+from helpdesk.libs.cache import LRUCache
 from helpdesk.libs.db import metadata, get_db
 from helpdesk.libs.rest import json_unpack, DictSerializableClassMixin
 
@@ -14,6 +21,42 @@ logger = logging.getLogger(__name__)
 
 Base = declarative_base(metadata=metadata)
 
+# attempts of `save_with_retry` after the first conflict
+SAVE_RETRIES = 3
+
+
+# (count sql, params) => (counted at, count) of recent cached counts, per process
+_counts = LRUCache(maxsize=TICKET_COUNT_CACHE_SIZE)
+
+
+class InvalidCursorError(ValueError):
+    pass
+
+
+class ConcurrentUpdateError(Exception):
+    """the row was changed by others since the obj was loaded"""
+
+    def __init__(self, obj):
+        super().__init__(
+            "%s %s was changed since version %s" % (obj.__class__.__name__, obj.id, obj.version)
+        )
+        self.obj = obj
+
+
+@asynccontextmanager
+async def transaction():
+    """statements of the task in the block run in one transaction, nested ones as savepoints"""
+    database = await get_db()
+    async with database.transaction():
+        yield
+
+
+def _freeze(value):
+    """json fields are changed in place, compare their dumps"""
+    if isinstance(value, (dict, list)):
+        return json.dumps(value, sort_keys=True, default=str)
+    return value
+
 
 class Model(DictSerializableClassMixin, Base):
     __abstract__ = True
@@ -35,7 +78,7 @@ class Model(DictSerializableClassMixin, Base):
         t = cls.__table__
         query = select([t]).where(t.c.id == id_)
         rs = await cls._fetchall(query)
-        return cls(**rs[0]) if rs else None
+        return cls._load(rs[0]) if rs else None
 
     @classmethod
     async def get_all(
@@ -61,40 +104,260 @@ class Model(DictSerializableClassMixin, Base):
         if offset:
             query = query.offset(offset)
         rs = await cls._fetchall(query)
-        return [cls(**r) for r in rs] if rs else []
+        return [cls._load(r) for r in rs] if rs else []
+
+    @classmethod
+    async def get_page(cls, cursor=None, filter_=None, order_by=None, desc=False, limit=20):
+        """
+        keyset pagination on (order_by, id), a page costs the same however deep it is.
+        `cursor` is a next or prev cursor of the last page, None for the first page.
+        the order_by column must not be null.
+        :return: objs, next cursor, prev cursor, a cursor is None if there is no such page
+        """
+        t = cls.__table__
+        # invalid column name => 'id'
+        column = t.c[order_by] if order_by in t.c.keys() else t.c.id
+        backward = False
+        query = select([t])
+        if filter_ is not None:
+            query = query.where(filter_)
+        if cursor:
+            backward, value, id_ = cls._decode_cursor(cursor, column)
+            if desc == backward:
+                after = or_(column > value, and_(column == value, t.c.id > id_))
+            else:
+                after = or_(column < value, and_(column == value, t.c.id < id_))
+            query = query.where(after)
+        # scan from the cursor, a prev page is read backward and reversed
+        if desc != backward:
+            query = query.order_by(column.desc(), t.c.id.desc())
+        else:
+            query = query.order_by(column, t.c.id)
+        rs = await cls._fetchall(query.limit(limit + 1))
+        objs = [cls._load(r) for r in rs[:limit]]
+        has_more = len(rs) > limit
+        if backward:
+            objs.reverse()
+        if not objs:
+            return objs, None, None
+        has_next, has_prev = (True, has_more) if backward else (has_more, bool(cursor))
+        next_cursor = cls._encode_cursor(objs[-1], column) if has_next else None
+        prev_cursor = cls._encode_cursor(objs[0], column, backward=True) if has_prev else None
+        return objs, next_cursor, prev_cursor
+
+    @staticmethod
+    def _encode_cursor(obj, column, backward=False):
+        value = getattr(obj, column.key)
+        if isinstance(value, datetime):
+            value = value.isoformat()
+        data = json.dumps([column.key, value, obj.id, int(backward)], separators=(",", ":"))
+        return base64.urlsafe_b64encode(data.encode("utf-8")).decode("ascii").rstrip("=")
+
+    @staticmethod
+    def _decode_cursor(cursor, column):
+        """:return: backward, order_by value, id"""
+        try:
+            data = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+            key, value, id_, backward = json.loads(data)
+            if isinstance(column.type, DateTime):
+                value = datetime.fromisoformat(value)
+        except (ValueError, TypeError) as e:
+            raise InvalidCursorError(f"invalid cursor: {e}")
+        if key != column.key:
+            raise InvalidCursorError(f"cursor is ordered by {key}, not {column.key}")
+        return bool(backward), value, id_
 
     @classmethod
-    async def count(cls, filter_=None):
+    async def count(cls, filter_=None, cache_ttl=None):
+        """with `cache_ttl` a count of the same filter in the last `cache_ttl` seconds is reused"""
         query = select([func.count()]).select_from(cls.__table__)
         if filter_ is not None:
             query = query.where(filter_)
+        if cache_ttl:
+            compiled = query.compile()
+            key = (str(compiled), json.dumps(compiled.params, sort_keys=True, default=str))
+            counted_at, count = _counts.get(key, (0, None))
+            if time.monotonic() - counted_at < cache_ttl:
+                return count
         rs = await cls._fetchall(query)
-        return rs[0][0] if rs and rs[0] else None
+        count = rs[0][0] if rs and rs[0] else None
+        if cache_ttl:
+            _counts.set(key, (time.monotonic(), count))
+        return count
+
+    @classmethod
+    def _load(cls, row):
+        """obj of a db row, its fields are tracked so `save` only writes the changed ones"""
+        obj = cls(**row)
+        obj._mark_clean()
+        return obj
+
+    def _mark_clean(self, fields=None):
+        loaded = getattr(self, "_loaded", None)
+        if fields is None:
+            self._loaded = {k: _freeze(v) for k, v in self._fields().items()}
+        elif loaded is not None:
+            loaded.update({f: _freeze(getattr(self, f)) for f in fields})
+
+    def dirty_fields(self):
+        """fields changed since the obj was loaded or saved, all of them for a new obj"""
+        loaded = getattr(self, "_loaded", None)
+        fields = self._fields()
+        if loaded is None:
+            return list(fields)
+        return [k for k, v in fields.items() if _freeze(v) != loaded.get(k)]
 
     async def save(self):
+        """
+        insert a new obj, or update only the fields changed since it was loaded.
+        an obj with an id but not loaded from db is upserted, all in one round trip.
+        """
+        loaded = getattr(self, "_loaded", None)
+        if loaded is not None and self.id is not None and loaded["id"] == self.id:
+            kw = {k: getattr(self, k) for k in self.dirty_fields()}
+            if not kw:
+                return self.id
+            if "updated_at" in self.__table__.columns and "updated_at" not in kw:
+                self.updated_at = kw["updated_at"] = datetime.now()
+            logger.debug("Saving %s, changed fields: %s", self, list(kw))
+            await self.update(**kw)
+            self._mark_clean()
+            return self.id
+
+        if "created_at" in self.__table__.columns and self.created_at is None:
+            self.created_at = datetime.now()
+        if "version" in self.__table__.columns and self.version is None:
+            self.version = 0
         kw = self._fields()
-        obj = await self.get(self.id)
-        logger.debug("Saving %s, checking if obj exists: %s", self, obj)
-        if obj:
-            if "updated_at" in kw:
-                kw["updated_at"] = datetime.now()
-            return await self.update(**kw)
-
-        if "created_at" in kw and kw["created_at"] is None:
-            kw["created_at"] = datetime.now()
-        query = self.__table__.insert().values(**kw)
-        id_ = await self._execute(query)
-        self.id = id_
-        return id_
+        if self.id is None:
+            self.id = await self._execute(self.__table__.insert().values(**kw))
+        else:
+            await self._execute(await self._upsert_query(kw))
+        self._mark_clean()
+        return self.id
+
+    @classmethod
+    async def _upsert_query(cls, kw):
+        t = cls.__table__
+        values = {k: v for k, v in kw.items() if k != "id"}
+        database = await get_db()
+        if database.url.dialect == "mysql":
+            return mysql.insert(t).values(**kw).on_duplicate_key_update(**values)
+        if database.url.dialect == "postgresql":
+            return (
+                postgresql.insert(t)
+                .values(**kw)
+                .on_conflict_do_update(index_elements=[t.c.id], set_=values)
+            )
+        # sqlite, all columns are given so replacing the row is the same
+        return t.insert().values(**kw).prefix_with("OR REPLACE")
+
+    @classmethod
+    async def bulk_insert(cls, objs):
+        """insert new objs in one transaction, set and return their ids"""
+        database = await get_db()
+        async with database.transaction():
+            for obj in objs:
+                if "created_at" in cls.__table__.columns and obj.created_at is None:
+                    obj.created_at = datetime.now()
+                if "version" in cls.__table__.columns and obj.version is None:
+                    obj.version = 0
+                kw = obj._fields()
+                obj.id = await database.execute(cls.__table__.insert().values(**kw))
+                obj._mark_clean()
+        return [obj.id for obj in objs]
+
+    async def save_with_retry(self, change, retries=SAVE_RETRIES):
+        """
+        apply `change(obj)` and save, if the row was changed by others meanwhile reload it
+        and apply `change` again, so concurrent changes to other fields or other keys of a
+        json field are kept. other unsaved changes of the obj are dropped on reload.
+        `change` returning False means there is nothing to save anymore.
+        """
+        for _ in range(retries + 1):
+            if change(self) is False:
+                return self.id
+            try:
+                return await self.save()
+            except ConcurrentUpdateError:
+                fresh = await self.get(self.id)
+                if fresh is None:
+                    raise
+                logger.info(
+                    "%s %s changed concurrently, retrying", self.__class__.__name__, self.id
+                )
+                for k, v in fresh._fields().items():
+                    setattr(self, k, v)
+                self._loaded = fresh._loaded
+        raise ConcurrentUpdateError(self)
 
     async def update(self, **kw):
         """try to return last modified row id
         see also https://docs.python.org/3/library/sqlite3.html#sqlite3.Cursor.lastrowid
+
+        a model with a `version` column is only updated if the row is still at the version
+        of the obj, and bumps it, `ConcurrentUpdateError` otherwise
         """
         t = self.__table__
         kw.pop("id", None)
-        query = t.update().where(t.c.id == self.id).values(**kw)
-        return await self._execute(query) or self.id
+        if "version" not in t.columns:
+            query = t.update().where(t.c.id == self.id).values(**kw)
+            return await self._execute(query) or self.id
+        kw.pop("version", None)
+        version = (self.version or 0) + 1
+        query = (
+            t.update()
+            .where(and_(t.c.id == self.id, t.c.version == self.version))
+            .values(version=version, **kw)
+        )
+        if not await self._execute_rowcount(query):
+            raise ConcurrentUpdateError(self)
+        self.version = version
+        return self.id
+
+    @classmethod
+    async def bulk_update(cls, objs, fields, chunk_size=200):
+        """
+        update `fields` of many rows with one `UPDATE ... SET f = CASE id ...` per chunk.
+        with a `version` column rows changed since their obj was loaded are skipped,
+        objs of a chunk with skipped rows are left stale, reload them before saving.
+        return the number of rows updated.
+        """
+        t = cls.__table__
+        versioned = "version" in t.columns
+        updated = 0
+        for i in range(0, len(objs), chunk_size):
+            chunk = objs[i:i + chunk_size]
+            values = {
+                f: case(
+                    [
+                        (t.c.id == obj.id, literal(getattr(obj, f), type_=t.c[f].type))
+                        for obj in chunk
+                    ],
+                    else_=t.c[f],
+                )
+                for f in fields
+            }
+            if not versioned:
+                query = t.update().where(t.c.id.in_([obj.id for obj in chunk])).values(values)
+                await cls._execute(query)
+                updated += len(chunk)
+                for obj in chunk:
+                    obj._mark_clean(fields)
+                continue
+            query = (
+                t.update()
+                .where(or_(*[and_(t.c.id == obj.id, t.c.version == obj.version) for obj in chunk]))
+                .values(values)
+                .values(version=func.coalesce(t.c.version, 0) + 1)
+            )
+            rowcount = await cls._execute_rowcount(query)
+            updated += rowcount
+            if rowcount == len(chunk):
+                for obj in chunk:
+                    obj.version = (obj.version or 0) + 1
+                    obj._mark_clean([*fields, "version"])
+        return updated
 
     @classmethod
     async def delete(cls, id_):
@@ -120,6 +383,20 @@ class Model(DictSerializableClassMixin, Base):
         database = await get_db()
         return await database.execute(query)
 
+    @classmethod
+    async def _execute_rowcount(cls, query):
+        """number of rows matched by an UPDATE, `execute` returns the lastrowid where it can"""
+        database = await get_db()
+        if database.url.dialect == "postgresql":
+            return len(await database.fetch_all(query.returning(cls.__table__.c.id)))
+        if database.url.dialect == "sqlite":
+            # the lastrowid of sqlite is kept from the last INSERT of the connection
+            async with database.transaction():
+                await database.execute(query)
+                return await database.fetch_val("SELECT changes()")
+        # mysql, lastrowid is 0 and the rowcount is returned
+        return await database.execute(query)
+
     @classmethod
     async def _fetchall(cls, query):
         database = await get_db()
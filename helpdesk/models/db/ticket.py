@@ -2,19 +2,24 @@
 
 import logging
 import importlib
+from collections import defaultdict
 from enum import Enum
-from datetime import datetime
+from datetime import datetime, timedelta
 from urllib.parse import urlencode, quote_plus
 from authlib.jose import jwt
-from sqlalchemy.sql.expression import and_
+from starlette.concurrency import run_in_threadpool
+from sqlalchemy.sql.expression import and_, or_
 from helpdesk.libs.approver_provider import get_approver_provider
 
+from helpdesk.libs.db import get_db
 from helpdesk.libs.decorators import cached_property
 from helpdesk.libs.sentry import report
 from helpdesk.models import db
 from helpdesk.models.db.param_rule import ParamRule
 from helpdesk.models.db.policy import Policy
 from helpdesk.models.db.policy import TicketPolicy
+from helpdesk.models.db.ticket_param import TicketParam
+from helpdesk.models.db.ticket_search import SEARCH_FIELDS, TicketSearchToken
 from helpdesk.models.provider import get_provider
 from helpdesk.config import (
     SYSTEM_USER,
@@ -22,11 +27,19 @@ from helpdesk.config import (
     DEFAULT_BASE_URL,
     TICKET_CALLBACK_PARAMS,
     NOTIFICATION_METHODS,
+    EXECUTION_RECONCILE_BATCH_SIZE,
+    EXECUTION_RECONCILE_WINDOW_DAYS,
+    TICKET_STATUS_BACKFILL_BATCH_SIZE,
+    TICKET_SEARCH_BACKFILL_BATCH_SIZE,
+    TICKET_PARAM_BACKFILL_BATCH_SIZE,
 )
 from helpdesk.views.api.schemas import ApproverType, NodeType
 
 logger = logging.getLogger(__name__)
 
+# set once every ticket is in the search index, per process
+_search_index_complete = False
+
 TICKET_COLORS = {
     "approved": "#28a745",
     "rejected": "#dc3545",
@@ -41,6 +54,16 @@ TICKET_COLORS = {
     "closed": "#28a745",
 }
 
+# ticket status which execution may still move forward
+UNFINISHED_EXEC_STATUSES = ("submitted", "queued", "running")
+# annotation keys set by `Ticket.execute`
+EXECUTION_ANNOTATIONS = (
+    "execution_submitted",
+    "execution",
+    "execution_creation_success",
+    "execution_creation_msg",
+)
+
 
 class TicketPhase(Enum):
     APPROVAL = "approval"
@@ -72,9 +95,16 @@ class Ticket(db.Model):
     #   then do the rule and store the state to the annotation
 
     annotation = db.Column(db.JSON)
-    created_at = db.Column(db.DateTime)
+    created_at = db.Column(db.DateTime, index=True)
     executed_at = db.Column(db.DateTime)
 
+    # bumped on every update, a stale ticket can not overwrite others' changes
+    version = db.Column(db.Integer, nullable=False, default=0, server_default="0")
+
+    # `status` as of the last save, to filter, sort and count by status in sql,
+    # wide enough for the execution statuses marked by callbacks
+    current_status = db.Column(db.String(length=64), index=True)
+
     @classmethod
     async def get_all_by_submitter(
         cls, submitter, desc=False, limit=None, offset=None, filter_=None, **kw
@@ -87,11 +117,18 @@ class Ticket(db.Model):
         )
 
     @classmethod
-    async def count_by_submitter(cls, submitter, filter_=None):
+    async def get_page_by_submitter(cls, submitter, filter_=None, **kw):
         submitter_filter = cls.__table__.c.submitter == submitter
         if filter_ is not None:
             filter_ = and_(filter_, submitter_filter)
-        return await cls.count(filter_=filter_)
+        return await cls.get_page(filter_=filter_, **kw)
+
+    @classmethod
+    async def count_by_submitter(cls, submitter, filter_=None, **kw):
+        submitter_filter = cls.__table__.c.submitter == submitter
+        if filter_ is not None:
+            filter_ = and_(filter_, submitter_filter)
+        return await cls.count(filter_=filter_, **kw)
 
     @property
     def status(self):
@@ -121,6 +158,148 @@ class Ticket(db.Model):
         else:
             return "created"
 
+    def _sync_status(self):
+        # a longer status marked by a callback must not fail the save
+        self.current_status = self.status[:64]
+
+    async def save(self):
+        """the ticket and its indexes are written in one transaction"""
+        self._sync_status()
+        dirty_fields = self.dirty_fields()
+        state = dict(self.__dict__)
+        try:
+            async with db.transaction():
+                id_ = await super().save()
+                if any(f in SEARCH_FIELDS for f in dirty_fields):
+                    await TicketSearchToken.index_tickets([self])
+                if "params" in dirty_fields or "provider_object" in dirty_fields:
+                    await TicketParam.index_tickets([self])
+        except BaseException:
+            # rolled back, the ticket is still unsaved with its changes
+            self.__dict__.clear()
+            self.__dict__.update(state)
+            raise
+        return id_
+
+    @classmethod
+    async def bulk_insert(cls, objs):
+        """the tickets and their indexes are inserted in one transaction"""
+        for obj in objs:
+            obj._sync_status()
+        database = await get_db()
+        async with database.transaction():
+            ids = await super().bulk_insert(objs)
+            await TicketSearchToken.index_tickets(objs)
+            await TicketParam.index_tickets(objs)
+        return ids
+
+    @classmethod
+    async def bulk_update(cls, objs, fields, chunk_size=200):
+        for obj in objs:
+            obj._sync_status()
+        if "current_status" not in fields:
+            fields = [*fields, "current_status"]
+        updated = await super().bulk_update(objs, fields, chunk_size=chunk_size)
+        if any(f in SEARCH_FIELDS for f in fields):
+            await TicketSearchToken.index_tickets(objs)
+        return updated
+
+    @classmethod
+    def param_filter(cls, key, op, value):
+        """filter on an indexed param, see `TicketParam.match_filter`"""
+        return TicketParam.match_filter(cls.__table__.c.id, key, op, value)
+
+    @classmethod
+    async def backfill_param_index(cls, batch_size=TICKET_PARAM_BACKFILL_BATCH_SIZE):
+        """
+        index the params of tickets saved before their action's params were indexed,
+        run in the background
+        :return: count of indexed tickets
+        """
+        t = cls.__table__
+        indexed = 0
+        for unindexed in TicketParam.unindexed_filters(t.c.id, t.c.provider_object):
+            last_id = 0
+            while True:
+                tickets = await cls.get_all(
+                    filter_=and_(unindexed, t.c.id > last_id), order_by="id", limit=batch_size
+                )
+                if not tickets:
+                    break
+                await TicketParam.index_tickets(tickets)
+                indexed += len(tickets)
+                last_id = tickets[-1].id
+        if indexed:
+            logger.info("indexed params of %d tickets", indexed)
+        return indexed
+
+    @classmethod
+    def search_filter(cls, field, value):
+        """narrow `field__icontains` down by the search index, once every ticket is in it"""
+        if field not in SEARCH_FIELDS or not _search_index_complete:
+            return None
+        return TicketSearchToken.match_filter(cls.__table__.c.id, field, value)
+
+    @classmethod
+    async def backfill_search_index(cls, batch_size=TICKET_SEARCH_BACKFILL_BATCH_SIZE):
+        """
+        index the tickets saved before the search index, run in the background
+        :return: count of indexed tickets
+        """
+        global _search_index_complete
+        t = cls.__table__
+        last_id = 0
+        indexed = 0
+        while True:
+            tickets = await cls.get_all(
+                filter_=and_(TicketSearchToken.unindexed_filter(t.c.id), t.c.id > last_id),
+                order_by="id",
+                limit=batch_size,
+            )
+            if not tickets:
+                break
+            await TicketSearchToken.index_tickets(tickets)
+            indexed += len(tickets)
+            last_id = tickets[-1].id
+        if indexed:
+            logger.info("indexed %d tickets for search", indexed)
+        _search_index_complete = True
+        return indexed
+
+    @classmethod
+    async def check_search_index(cls):
+        """use the search index in this worker once the backfill has indexed every ticket"""
+        global _search_index_complete
+        if _search_index_complete:
+            return
+        t = cls.__table__
+        unindexed = await cls.get_all(filter_=TicketSearchToken.unindexed_filter(t.c.id), limit=1)
+        _search_index_complete = not unindexed
+
+    @classmethod
+    async def backfill_status(cls, batch_size=TICKET_STATUS_BACKFILL_BATCH_SIZE):
+        """
+        set current_status of the tickets saved before it existed, run in the background
+        :return: count of updated tickets
+        """
+        t = cls.__table__
+        last_id = 0
+        updated = 0
+        while True:
+            tickets = await cls.get_all(
+                filter_=and_(t.c.current_status.is_(None), t.c.id > last_id),
+                order_by="id",
+                limit=batch_size,
+            )
+            if not tickets:
+                break
+            # tickets changed meanwhile are skipped, saving them has set the status
+            updated += await cls.bulk_update(tickets, [])
+            last_id = tickets[-1].id
+        if updated:
+            logger.info("backfilled current_status of %d tickets", updated)
+        return updated
+
     @property
     def color(self):
         return TICKET_COLORS.get(self.status.lower(), "#6c757d")
@@ -166,15 +345,33 @@ class Ticket(db.Model):
         logger.debug("Ticket.get_rule_actions(%s): %s", rule_action, ret)
         return ret
 
-    async def get_flow_policy(self):
-        associates = await TicketPolicy.get_by_ticket_name(
-            self.provider_object, without_default=True, desc=True
+    @classmethod
+    async def get_flow_associates(cls, provider_object):
+        return await TicketPolicy.get_by_ticket_name(
+            provider_object, without_default=True, desc=True
         )
+
+    async def get_flow_policy(self, associates=None, policies=None):
+        """
+        pass `associates` from `get_flow_associates` and a `policies` dict shared by
+        tickets of the same provider object to resolve many of them with one round of queries
+        """
+        if associates is None:
+            associates = await self.get_flow_associates(self.provider_object)
+        policies = {} if policies is None else policies
         for associate in associates:
             if associate.match(self.params):
-                return await Policy.get(id_=associate.policy_id)
-        policy_id = await TicketPolicy.default_associate(self.provider_object)
-        return await Policy.get(id_=policy_id)
+                policy_id = associate.policy_id
+                break
+        else:
+            policy_id = policies.get("default")
+            if policy_id is None:
+                policy_id = policies["default"] = await TicketPolicy.default_associate(
+                    self.provider_object
+                )
+        if policy_id not in policies:
+            policies[policy_id] = await Policy.get(id_=policy_id)
+        return policies[policy_id]
 
     # 节点流转依据创建时 annotation 记录的节点信息, 若是节点变更前有未审批的工单则以原记录方式流转，否则需重提
     @property
@@ -362,7 +559,7 @@ class Ticket(db.Model):
         await self.notify(TicketPhase.APPROVAL)
         return True, "Success"
 
-    def execute(self):
+    async def execute(self):
         provider = get_provider(self.provider_type)
 
         logger.info(
@@ -370,7 +567,7 @@ class Ticket(db.Model):
             self.provider_object,
             self.handle_extra_params(),
         )
-        execution, msg = provider.exec_ticket(
+        execution, msg = await provider.exec_ticket_async(
             self.provider_object, self.handle_extra_params()
         )
         self.annotate(execution_submitted=True)
@@ -392,14 +589,48 @@ class Ticket(db.Model):
             execution.result_url,
         )
 
-    def get_result(self):
+    async def save_execution(self):
+        """save what `execute` annotated, merged with the changes made by others meanwhile"""
+        executed = {k: v for k, v in self.annotation.items() if k in EXECUTION_ANNOTATIONS}
+        executed_at = self.executed_at
+
+        def change(ticket):
+            ticket.annotate(executed)
+            ticket.executed_at = executed_at or ticket.executed_at
+
+        return await self.save_with_retry(change)
+
+    async def get_result(self):
         provider = get_provider(self.provider_type)
         exec_annotation = self.annotation.get("execution", {})
-        return provider.get_exec_result(exec_annotation)
+        execution, msg = await provider.get_exec_result_async(exec_annotation)
+        if execution:
+            highlight_queries = await self.get_highlight_queries()
+            for task in execution.result.tasks:
+                for details in (task.result or {}).values():
+                    details.highlight_queries = highlight_queries
+        return execution, msg
+
+    async def get_highlight_queries(self):
+        """regexes of interesting log lines, from the action schema of the ticket"""
+        from helpdesk.models.action import Action, ActionResolveError
+
+        provider = get_provider(self.provider_type)
+        action = Action("", "", self.provider_type, self.provider_object)
+        try:
+            action_schema = await run_in_threadpool(action.resolve_action, provider)
+        except ActionResolveError as e:
+            logger.warning("get highlight queries of ticket %s failed: %s", self.id, e)
+            return []
+        return action_schema.highlight_queries or []
+
+    async def get_result_log(self, output_id):
+        provider = get_provider(self.provider_type)
+        return await provider.get_exec_log_async(output_id)
 
-    def get_result_log(self, output_id):
+    def stream_result_log(self, output_id, offset=0):
         provider = get_provider(self.provider_type)
-        return provider.get_exec_log(output_id)
+        return provider.stream_exec_log_async(output_id, offset=offset)
 
     async def notify(self, phase):
         logger.info("Ticket notify: %s: %s", phase, self)
@@ -414,6 +645,70 @@ class Ticket(db.Model):
                 report()
                 logger.warning("notify to %s failed: %s", method, e)
 
+    @classmethod
+    async def reconcile_executions(cls, limit=EXECUTION_RECONCILE_BATCH_SIZE):
+        """
+        refresh execution_status of submitted/running tickets from providers in batch,
+        run by the background reconciler
+        :return: count of updated tickets
+        """
+        t = cls.__table__
+        since = datetime.now() - timedelta(days=EXECUTION_RECONCILE_WINDOW_DAYS)
+        filter_ = and_(
+            t.c.executed_at >= since,
+            # not backfilled yet, checked by `status` below
+            or_(
+                t.c.current_status.in_(UNFINISHED_EXEC_STATUSES),
+                t.c.current_status.is_(None),
+            ),
+        )
+        tickets = []
+        cursor = None
+        # read `limit` rows a page, more pages only if some of them are filtered out here
+        while len(tickets) < limit:
+            candidates, cursor, _ = await cls.get_page(
+                cursor=cursor, filter_=filter_, order_by="executed_at", desc=True, limit=limit
+            )
+            tickets.extend(
+                ticket
+                for ticket in candidates
+                if ticket.status in UNFINISHED_EXEC_STATUSES
+                and not ticket.annotation.get("final_exec_status")
+            )
+            if cursor is None:
+                break
+        tickets = tickets[:limit]
+
+        tickets_by_provider = defaultdict(list)
+        for ticket in tickets:
+            tickets_by_provider[ticket.provider_type].append(ticket)
+
+        changed = []
+        for provider_type, provider_tickets in tickets_by_provider.items():
+            provider = get_provider(provider_type)
+            # executed_at is local time, leave a day for timezone and clock skew
+            earliest = min(ticket.executed_at for ticket in provider_tickets)
+            statuses = await provider.get_exec_statuses_async(
+                [ticket.annotation.get("execution", {}) for ticket in provider_tickets],
+                since=(earliest - timedelta(days=1)).astimezone(),
+            )
+            for ticket, exec_status in zip(provider_tickets, statuses):
+                if exec_status and exec_status.value != ticket.annotation.get(
+                    "execution_status"
+                ):
+                    ticket.annotate(execution_status=exec_status.value)
+                    changed.append(ticket)
+
+        # tickets changed meanwhile are skipped, they are picked up by the next run
+        updated = await cls.bulk_update(changed, ["annotation"])
+        logger.info(
+            "reconciled %d tickets, %d execution status changed, %d skipped as changed meanwhile",
+            len(tickets),
+            updated,
+            len(changed) - updated,
+        )
+        return updated
+
     def generate_callback_url(self):
         """
         generate callback url for ticket mark status call back
@@ -0,0 +1,131 @@
+# coding: utf-8
+
+import json
+import hashlib
+import logging
+
+from sqlalchemy import Index
+from sqlalchemy.sql import select, and_, or_, exists
+
+from helpdesk.config import TICKET_INDEXED_PARAMS
+from helpdesk.models import db
+
+logger = logging.getLogger(__name__)
+
+FILTER_OPS = ("eq", "in", "startswith")
+# longer values are not indexed
+MAX_VALUE_LENGTH = 255
+# a row of it marks a ticket as indexed, its value is the signature of the indexed params
+INDEXED_MARK = ""
+# rows of one INSERT, 3 binds each stay well below the bind limits of sqlite and asyncpg
+INSERT_CHUNK_SIZE = 1000
+
+
+def indexed_params(provider_object):
+    """params of the action indexed for filters, the ones of "*" are for every action"""
+    params = set(TICKET_INDEXED_PARAMS.get("*", []))
+    params.update(TICKET_INDEXED_PARAMS.get(provider_object, []))
+    return sorted(params)
+
+
+def all_indexed_params():
+    return {p for params in TICKET_INDEXED_PARAMS.values() for p in params}
+
+
+def signature(provider_object):
+    data = json.dumps(indexed_params(provider_object))
+    return hashlib.sha1(data.encode("utf-8")).hexdigest()[:16]
+
+
+def param_values(value):
+    """a list param has a row per item, nested values are not indexed"""
+    values = value if isinstance(value, list) else [value]
+    for v in values:
+        if isinstance(v, (dict, list)) or v is None:
+            continue
+        v = json.dumps(v) if isinstance(v, bool) else str(v)
+        if len(v) <= MAX_VALUE_LENGTH:
+            yield v
+
+
+class TicketParam(db.Model):
+    """values of the indexed params of tickets, see `TICKET_INDEXED_PARAMS`"""
+
+    __tablename__ = "ticket_param"
+    __table_args__ = (
+        Index("idx_ticket_param_key_value", "key", "value", "ticket_id"),
+        {"mysql_charset": "utf8mb4"},
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    ticket_id = db.Column(db.Integer, index=True)
+    key = db.Column(db.String(length=64))
+    value = db.Column(db.String(length=MAX_VALUE_LENGTH))
+
+    @classmethod
+    async def index_tickets(cls, tickets):
+        """replace the indexed param values of saved tickets in one transaction"""
+        t = cls.__table__
+        ids = [ticket.id for ticket in tickets]
+        if not ids:
+            return
+        rows = []
+        for ticket in tickets:
+            mark = signature(ticket.provider_object)
+            rows.append(dict(ticket_id=ticket.id, key=INDEXED_MARK, value=mark))
+            params = ticket.params or {}
+            for key in indexed_params(ticket.provider_object):
+                if key in params:
+                    rows.extend(
+                        dict(ticket_id=ticket.id, key=key, value=v)
+                        for v in sorted(set(param_values(params[key])))
+                    )
+        async with db.transaction():
+            await cls._execute(t.delete().where(t.c.ticket_id.in_(ids)))
+            for i in range(0, len(rows), INSERT_CHUNK_SIZE):
+                await cls._execute(t.insert().values(rows[i:i + INSERT_CHUNK_SIZE]))
+
+    @classmethod
+    def match_filter(cls, ticket_id, key, op, value):
+        """
+        filter of `ticket_id` on the tickets whose param `key` equals `value`, is in the comma
+        separated `value` or starts with `value`, raise ValueError if `key` is not indexed
+        """
+        if key not in all_indexed_params():
+            raise ValueError(f"param {key} is not indexed")
+        if op not in FILTER_OPS:
+            raise ValueError(f"param filter {op} is not supported")
+        t = cls.__table__
+        if op == "in":
+            matched = t.c.value.in_(value.split(","))
+        elif op == "startswith":
+            matched = t.c.value.startswith(value, autoescape=True)
+        else:
+            matched = t.c.value == value
+        return ticket_id.in_(select([t.c.ticket_id]).where(and_(t.c.key == key, matched)))
+
+    @classmethod
+    def unindexed_filters(cls, ticket_id, provider_object):
+        """
+        filters of the tickets not indexed with the current `TICKET_INDEXED_PARAMS`,
+        one per signature
+        """
+        t = cls.__table__
+
+        def unindexed(action):
+            return ~exists().where(
+                and_(
+                    t.c.ticket_id == ticket_id,
+                    t.c.key == INDEXED_MARK,
+                    t.c.value == signature(action),
+                )
+            )
+
+        actions = [action for action in TICKET_INDEXED_PARAMS if action != "*"]
+        filters = [and_(provider_object == action, unindexed(action)) for action in actions]
+        if "*" in TICKET_INDEXED_PARAMS and actions:
+            others = or_(provider_object.notin_(actions), provider_object.is_(None))
+            filters.append(and_(others, unindexed(None)))
+        elif "*" in TICKET_INDEXED_PARAMS:
+            filters.append(unindexed(None))
+        return filters
@@ -0,0 +1,98 @@
+# coding: utf-8
+
+import logging
+
+from sqlalchemy import Index, Text
+from sqlalchemy.sql import select, func, and_, exists, distinct, type_coerce
+
+from helpdesk.libs.db import get_db
+from helpdesk.models import db
+
+logger = logging.getLogger(__name__)
+
+# searched with `__icontains`, the trigrams of their text are indexed
+SEARCH_FIELDS = ("title", "params", "reason")
+# a longer query is narrowed by this many of its trigrams, the LIKE recheck does the rest
+MAX_QUERY_GRAMS = 16
+# a row of it marks a ticket as indexed
+INDEXED_MARK = ""
+# rows of one INSERT, 3 binds each stay well below the bind limits of sqlite and asyncpg
+INSERT_CHUNK_SIZE = 1000
+
+
+def trigrams(text):
+    text = text.lower()
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+class TicketSearchToken(db.Model):
+    """trigrams of ticket text fields, `LIKE '%value%'` only rechecks tickets with all of them"""
+
+    __tablename__ = "ticket_search_token"
+    __table_args__ = (
+        Index("idx_ticket_search_token_field_gram", "field", "gram", "ticket_id"),
+        {"mysql_charset": "utf8mb4"},
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    ticket_id = db.Column(db.Integer, index=True)
+    field = db.Column(db.String(length=16))
+    gram = db.Column(db.String(length=3))
+
+    @classmethod
+    async def index_tickets(cls, tickets):
+        """
+        replace the trigrams of saved tickets in one transaction.
+        the text is read back as the database stores it, json fields are matched by LIKE
+        in the key order and escaping of the database, not of `json.dumps`. the ticket
+        rows are locked meanwhile, so concurrent indexing of a ticket can not mix up rows.
+        """
+        t = cls.__table__
+        ids = sorted(ticket.id for ticket in tickets)
+        if not ids:
+            return
+        ticket = tickets[0].__table__
+        texts = select(
+            [ticket.c.id] + [type_coerce(ticket.c[f], Text).label(f) for f in SEARCH_FIELDS]
+        )
+        texts = texts.where(ticket.c.id.in_(ids)).order_by(ticket.c.id).with_for_update()
+        database = await get_db()
+        async with database.transaction():
+            rs = await database.fetch_all(texts)
+            await database.execute(t.delete().where(t.c.ticket_id.in_(ids)))
+            rows = []
+            for r in rs:
+                rows.append(dict(ticket_id=r["id"], field=INDEXED_MARK, gram=INDEXED_MARK))
+                for field in SEARCH_FIELDS:
+                    rows.extend(
+                        dict(ticket_id=r["id"], field=field, gram=gram)
+                        for gram in sorted(trigrams(r[field] or ""))
+                    )
+            for i in range(0, len(rows), INSERT_CHUNK_SIZE):
+                await database.execute(t.insert().values(rows[i:i + INSERT_CHUNK_SIZE]))
+
+    @classmethod
+    def match_filter(cls, ticket_id, field, value):
+        """
+        filter of `ticket_id` on the tickets with all trigrams of `value` in `field`,
+        None if `value` is too short to have one
+        """
+        grams = sorted(trigrams(value))
+        if not grams:
+            return None
+        # a subset of the trigrams still finds every match
+        step = -(-len(grams) // MAX_QUERY_GRAMS)
+        grams = grams[::step]
+        t = cls.__table__
+        matched = (
+            select([t.c.ticket_id])
+            .where(and_(t.c.field == field, t.c.gram.in_(grams)))
+            .group_by(t.c.ticket_id)
+            .having(func.count(distinct(t.c.gram)) == len(grams))
+        )
+        return ticket_id.in_(matched)
+
+    @classmethod
+    def unindexed_filter(cls, ticket_id):
+        t = cls.__table__
+        return ~exists().where(and_(t.c.ticket_id == ticket_id, t.c.field == INDEXED_MARK))
@@ -1,5 +1,7 @@
 # coding: utf-8
 
+import asyncio
+import hashlib
 import logging
 import json
 import traceback
@@ -13,7 +15,7 @@ from airflow_client.client.models.task_instance_collection_response import (
 )
 from airflow_client.client.models.task_instance_state import TaskInstanceState
 from pydantic import BaseModel
-from typing import List, Dict, Optional, Any, Tuple, Self
+from typing import List, Dict, Optional, Any, Tuple, Self, AsyncIterator
 
 from helpdesk.config import (
     AIRFLOW_SERVER_URL,
@@ -21,8 +23,17 @@ from helpdesk.config import (
     AIRFLOW_USERNAME,
     AIRFLOW_PASSWORD,
     AIRFLOW_DEFAULT_DAG_TAG,
+    AIRFLOW_DAG_GRAPH_CACHE_SIZE,
+    AIRFLOW_DAG_GRAPH_CACHE_DIR,
+    AIRFLOW_RESULT_TIMEOUT_SECONDS,
+    AIRFLOW_TASK_LOG_CACHE_DIR,
+    AIRFLOW_TASK_LOG_CACHE_MAX_BYTES,
+    AIRFLOW_TASK_LOG_TAIL_CACHE_SIZE,
+    ACTION_SCHEMA_CACHE_SIZE,
 )
-from helpdesk.libs.airflow import AirflowClient
+from helpdesk.libs.airflow import AirflowClient, AsyncAirflowClient
+from helpdesk.libs.cache import LRUCache, DiskCache
+from helpdesk.libs.circuit_breaker import CircuitOpenError
 from helpdesk.libs.types import (
     StatusColor,
     TicketExecResultInfo,
@@ -48,6 +59,40 @@ from helpdesk.models.provider.base import BaseProvider
 
 logger = logging.getLogger(__name__)
 
+# (dag_id, dag_version) => airflow structure_data, lives across provider instances
+_dag_graph_cache = LRUCache(
+    maxsize=AIRFLOW_DAG_GRAPH_CACHE_SIZE,
+    disk=DiskCache(AIRFLOW_DAG_GRAPH_CACHE_DIR) if AIRFLOW_DAG_GRAPH_CACHE_DIR else None,
+)
+
+# output id => formatted log of a finished task try, never changes once the try is finished
+_task_log_cache = (
+    DiskCache(
+        AIRFLOW_TASK_LOG_CACHE_DIR,
+        compress=True,
+        max_bytes=AIRFLOW_TASK_LOG_CACHE_MAX_BYTES,
+    )
+    if AIRFLOW_TASK_LOG_CACHE_DIR
+    else None
+)
+
+# (output id, line offset) => airflow continuation token of the log after that line,
+# a tail request at that offset reads only the new log
+_task_log_tails = LRUCache(maxsize=AIRFLOW_TASK_LOG_TAIL_CACHE_SIZE)
+
+# dag id => (fingerprint of dag details, ActionSchema), skips rebuilding unchanged schemas
+_action_schema_builds = LRUCache(maxsize=ACTION_SCHEMA_CACHE_SIZE)
+# hash of dag params => converted helpdesk params, json schema and extra attrs
+_param_conversions = LRUCache(maxsize=ACTION_SCHEMA_CACHE_SIZE)
+
+TERMINAL_TASK_STATES = (
+    TaskInstanceState.SUCCESS,
+    TaskInstanceState.FAILED,
+    TaskInstanceState.SKIPPED,
+    TaskInstanceState.UPSTREAM_FAILED,
+    TaskInstanceState.REMOVED,
+)
+
 
 class AirflowExecAnnotation(BaseModel):
     dag_id: str = ""
@@ -77,6 +122,9 @@ class AirflowProvider(BaseProvider):
     provider_type = "airflow"
     EXTRA_INFO_RE = re.compile(r".*```helpdesk(.+)```.*", re.DOTALL)
     MAX_LOG_LINES = 100000
+    DAG_RUNS_BATCH_PAGE_LIMIT = 100
+    # pages of runs looked through for the wanted ones, runs missing from them are unknown
+    DAG_RUNS_BATCH_MAX_PAGES = 10
 
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
@@ -87,6 +135,12 @@ class AirflowProvider(BaseProvider):
             server_url=AIRFLOW_SERVER_URL,
             jwt_expire_seconds=AIRFLOW_JWT_EXPIRATION_SECONDS,
         )
+        self.async_airflow_client = AsyncAirflowClient(
+            username=AIRFLOW_USERNAME,
+            passwd=AIRFLOW_PASSWORD,
+            server_url=AIRFLOW_SERVER_URL,
+            jwt_expire_seconds=AIRFLOW_JWT_EXPIRATION_SECONDS,
+        )
         self.default_tag = AIRFLOW_DEFAULT_DAG_TAG
         self.default_status_filter = ()
 
@@ -95,6 +149,28 @@ class AirflowProvider(BaseProvider):
 
     @staticmethod
     def airflow_schema_to_helpdesk(airflow_param: Dict[str, Any]) -> Tuple[Any]:
+        """
+        memoized `_convert_airflow_schema` by the content hash of the params.
+        params are copied because callers fill them up in place, json schema and
+        extra attrs are shared and must be treated as read only.
+        """
+        # param order is kept in the result, so it is part of the key
+        key = hashlib.sha1(
+            json.dumps(airflow_param, default=str).encode("utf-8")
+        ).hexdigest()
+        converted = _param_conversions.get(key)
+        if converted is None:
+            converted = AirflowProvider._convert_airflow_schema(airflow_param)
+            _param_conversions.set(key, converted)
+        params_schema, json_schema, extra_attrs = converted
+        return (
+            {name: param.model_copy() for name, param in params_schema.items()},
+            json_schema,
+            extra_attrs,
+        )
+
+    @staticmethod
+    def _convert_airflow_schema(airflow_param: Dict[str, Any]) -> Tuple[Any]:
         """
         因为airflow的dag现在支持param声明，所以我们把原来的param_schema和json_schema
         分别放在param的定义内，不支持的就放在`description_md`这个字段里使用 ```helpdesk```来标识
@@ -139,21 +215,30 @@ class AirflowProvider(BaseProvider):
                 json_schema["properties"][param_name].update(
                     extra_info.get("json_schema", {})
                 )
-                logger.debug(
-                    "json schema after merge: %s", json.dumps(json_schema, indent=2)
-                )
-                if "schema" in extra_info:
-                    json_schema.update(extra_info["schema"])
+                if logger.isEnabledFor(logging.DEBUG):
                     logger.debug(
-                        "json schema after merge with schema: %s",
-                        json.dumps(json_schema, indent=2),
+                        "json schema after merge: %s", json.dumps(json_schema, indent=2)
                     )
+                if "schema" in extra_info:
+                    json_schema.update(extra_info["schema"])
+                    if logger.isEnabledFor(logging.DEBUG):
+                        logger.debug(
+                            "json schema after merge with schema: %s",
+                            json.dumps(json_schema, indent=2),
+                        )
 
                 if "pretty_task_log_formatter" in extra_info:
                     extra_attrs["pretty_task_log_formatter"] = extra_info[
                         "pretty_task_log_formatter"
                     ]
 
+                # regexes of interesting log lines, e.g. `"highlight_queries": ["ERROR", "Traceback"]`
+                if "highlight_queries" in extra_info:
+                    queries = extra_info["highlight_queries"]
+                    extra_attrs["highlight_queries"] = (
+                        [queries] if isinstance(queries, str) else list(queries)
+                    )
+
             param_desc = schema_def.get("description")
             if param_desc is None:
                 param_desc = (
@@ -218,11 +303,34 @@ class AirflowProvider(BaseProvider):
                 )
             raise e
 
+    @staticmethod
+    def _dag_details_fingerprint(dag_details):
+        # hash the fields the schema is built from, last_parsed_time changes on every
+        # parse loop of the dag processor even if the dag file is untouched
+        content = json.dumps(
+            [
+                dag_details.dag_display_name,
+                dag_details.description,
+                dag_details.params,
+            ],
+            sort_keys=True,
+            default=str,
+        )
+        return hashlib.sha1(content.encode("utf-8")).hexdigest()
+
     def get_action_schema(self, dag_id: str) -> Optional[ActionSchema]:
         try:
-            return self._build_action_from_dag_details(
-                self.airflow_client.get_schema_by_dag_id(dag_id), dag_id
-            )
+            dag_details = self.airflow_client.get_schema_by_dag_id(dag_id)
+            fingerprint = self._dag_details_fingerprint(dag_details)
+            built = _action_schema_builds.get(dag_id)
+            if built and built[0] == fingerprint:
+                return built[1]
+            action_schema = self._build_action_from_dag_details(dag_details, dag_id)
+            _action_schema_builds.set(dag_id, (fingerprint, action_schema))
+            return action_schema
+        except CircuitOpenError as e:
+            logger.warning("get dag %s schema skipped: %s", dag_id, e)
+            return None
         except Exception as e:
             logger.error("get dag(id or tag) %s schema failed", dag_id)
             logger.exception(e)
@@ -259,6 +367,21 @@ class AirflowProvider(BaseProvider):
             logger.exception(e)
             return None, f"exec ticket {ticket_name} failed, error: {str(e)}"
 
+    async def exec_ticket_async(
+        self, ticket_name: str, parameters: Dict[str, Any], extra_info: str = None
+    ) -> Tuple[TicketExecInfo, str]:
+        logger.info("exec airflow dag %s with conf: %s", ticket_name, parameters)
+        try:
+            trigger_result = await self.async_airflow_client.trigger_dag(
+                ticket_name, conf=parameters, extra_info=extra_info
+            )
+            if trigger_result:
+                return self._build_execution_from_dag(trigger_result, ticket_name), ""
+            raise Exception(f"trigger dag {ticket_name} failed")
+        except Exception as e:
+            logger.exception(e)
+            return None, f"exec ticket {ticket_name} failed, error: {str(e)}"
+
     def get_exec_annotation(self, execution: TicketExecInfo) -> Dict[str, Any]:
         return AirflowExecAnnotation(
             dag_id=execution.ticket_name,
@@ -267,10 +390,40 @@ class AirflowProvider(BaseProvider):
             dag_version=execution.annotation["dag_version"],
         ).dict()
 
+    def get_dag_graph(self, dag_id: str, dag_version: int) -> Dict[str, Any]:
+        airflow_graph = _dag_graph_cache.get((dag_id, dag_version))
+        if airflow_graph is None:
+            airflow_graph = self.airflow_client.get_dag_graph(dag_id, dag_version)
+            # empty graph means airflow returned an error, try again next time
+            if airflow_graph:
+                _dag_graph_cache.set((dag_id, dag_version), airflow_graph)
+        return airflow_graph
+
+    async def get_dag_graph_async(self, dag_id: str, dag_version: int) -> Dict[str, Any]:
+        airflow_graph = _dag_graph_cache.get((dag_id, dag_version))
+        if airflow_graph is None:
+            try:
+                airflow_graph = await self.async_airflow_client.get_dag_graph(
+                    dag_id, dag_version
+                )
+            except Exception as e:
+                # the graph is only decoration of the result, do not fail the result for it
+                logger.error("get dag_id %s graph info version %d err: %s", dag_id, dag_version, e)
+                return {}
+            if airflow_graph:
+                _dag_graph_cache.set((dag_id, dag_version), airflow_graph)
+        return airflow_graph
+
     def _dag_graph_to_gojs_flow(
         self, dag_id: str, dag_version: int, task_result: TicketExecResultInfo
     ) -> TicketGraph:
-        airflow_graph = self.airflow_client.get_dag_graph(dag_id, dag_version)
+        airflow_graph = self.get_dag_graph(dag_id, dag_version)
+        return self._build_gojs_flow(airflow_graph, task_result)
+
+    @staticmethod
+    def _build_gojs_flow(
+        airflow_graph: Dict[str, Any], task_result: TicketExecResultInfo
+    ) -> TicketGraph:
         result = TicketGraph()
         tasks_status: Dict[str, TicketExecTaskStatus] = {
             t.task_id: (
@@ -372,7 +525,6 @@ class AirflowProvider(BaseProvider):
                     return_code=1,
                     succeeded=False,
                     stdout="",
-                    highlight_queries="",  # TODO: extract hq from dag schema info
                 )
 
                 if task_instance.try_number > 0:
@@ -395,6 +547,22 @@ class AirflowProvider(BaseProvider):
 
         return TicketExecTasksResult(tasks=tasks_info, id=dag_run.dag_run_id)
 
+    def _build_exec_result(
+        self,
+        exec_annotation: AirflowExecAnnotation,
+        dag_run: DAGRunResponse,
+        result: TicketExecTasksResult,
+        graph: TicketGraph,
+    ) -> TicketExecResultInfo:
+        return TicketExecResultInfo(
+            ticket_id=exec_annotation.dag_id,
+            status=TicketExecStatus(dag_run.state.value),
+            start_timestamp=dag_run.start_date,
+            result_url=exec_annotation.result_url,
+            result=result,
+            graph=graph,
+        )
+
     def get_exec_result(self, annotation: Dict[str, Any]):
         exec_annotation = AirflowExecAnnotation().from_annotation(annotation)
         try:
@@ -406,62 +574,244 @@ class AirflowProvider(BaseProvider):
             graph = self._dag_graph_to_gojs_flow(
                 exec_annotation.dag_id, exec_annotation.dag_version, result
             )
-            return (
-                TicketExecResultInfo(
-                    ticket_id=exec_annotation.dag_id,
-                    status=TicketExecStatus(dag_run.state.value),
-                    start_timestamp=dag_run.start_date,
-                    result_url=exec_annotation.result_url,
-                    result=result,
-                    graph=graph,
+            return self._build_exec_result(exec_annotation, dag_run, result, graph), ""
+        except CircuitOpenError as e:
+            logger.warning("get execution result from %s skipped: %s", exec_annotation, e)
+            return None, str(e)
+        except Exception as e:
+            logger.error(
+                f"get execution result from {exec_annotation}, error: {traceback.format_exc()}"
+            )
+            return None, str(e)
+
+    async def get_exec_result_async(self, annotation: Dict[str, Any]):
+        exec_annotation = AirflowExecAnnotation().from_annotation(annotation)
+        try:
+            # dag run, task instances and graph are independent, fetch them in one round trip
+            dag_run, dag_instances, airflow_graph = await asyncio.wait_for(
+                asyncio.gather(
+                    self.async_airflow_client.get_dag_run(
+                        exec_annotation.dag_id, exec_annotation.dag_run_id
+                    ),
+                    self.async_airflow_client.get_task_instances(
+                        exec_annotation.dag_id, exec_annotation.dag_run_id
+                    ),
+                    self.get_dag_graph_async(
+                        exec_annotation.dag_id, exec_annotation.dag_version
+                    ),
                 ),
-                "",
+                timeout=AIRFLOW_RESULT_TIMEOUT_SECONDS,
+            )
+            logger.debug("dag_run: %s\n dag_ins: %s", dag_run, dag_instances)
+            result = self._build_result_from_dag_exec(dag_run, dag_instances)
+            graph = self._build_gojs_flow(airflow_graph, result)
+            return self._build_exec_result(exec_annotation, dag_run, result, graph), ""
+        except asyncio.TimeoutError:
+            logger.error(
+                "get execution result from %s timeout after %ss",
+                exec_annotation,
+                AIRFLOW_RESULT_TIMEOUT_SECONDS,
             )
+            return None, f"get execution result timeout after {AIRFLOW_RESULT_TIMEOUT_SECONDS}s"
+        except CircuitOpenError as e:
+            logger.warning("get execution result from %s skipped: %s", exec_annotation, e)
+            return None, str(e)
         except Exception as e:
             logger.error(
                 f"get execution result from {exec_annotation}, error: {traceback.format_exc()}"
             )
             return None, str(e)
 
+    async def get_exec_statuses_async(
+        self, execution_annotations: List[Dict[str, Any]], since: Optional[datetime.datetime] = None
+    ) -> List[Optional[TicketExecStatus]]:
+        exec_annotations = []
+        for annotation in execution_annotations:
+            try:
+                exec_annotations.append(AirflowExecAnnotation().from_annotation(annotation))
+            except (KeyError, ValueError):
+                logger.warning("invalid execution annotation: %s", annotation)
+                exec_annotations.append(None)
+
+        wanted = {(a.dag_id, a.dag_run_id) for a in exec_annotations if a}
+        found: Dict[Tuple[str, str], TicketExecStatus] = {}
+        page_offset = 0
+        try:
+            for _ in range(self.DAG_RUNS_BATCH_MAX_PAGES):
+                if not wanted or len(found) >= len(wanted):
+                    break
+                dag_runs = await self.async_airflow_client.get_dag_runs_batch(
+                    dag_ids=sorted({dag_id for dag_id, _ in wanted}),
+                    run_after_gte=since,
+                    page_offset=page_offset,
+                    page_limit=self.DAG_RUNS_BATCH_PAGE_LIMIT,
+                )
+                for dag_run in dag_runs.dag_runs:
+                    if (dag_run.dag_id, dag_run.dag_run_id) in wanted:
+                        found[(dag_run.dag_id, dag_run.dag_run_id)] = TicketExecStatus(
+                            dag_run.state.value
+                        )
+                page_offset += len(dag_runs.dag_runs)
+                if not dag_runs.dag_runs or page_offset >= dag_runs.total_entries:
+                    break
+        except Exception as e:
+            logger.error("batch get dag runs since %s failed: %s", since, e)
+        return [found.get((a.dag_id, a.dag_run_id)) if a else None for a in exec_annotations]
+
+    @staticmethod
+    def _format_log_event(e: Dict[str, Any]) -> List[str]:
+        """
+        format one airflow structured log event to lines, events without level/time are skipped.
+        this is the one definition of a log line, line offsets of all log paths count these
+        """
+        if "level" not in e or "timestamp" not in e or "event" not in e:
+            return []
+        entries = [f"level={e['level']} time={e['timestamp']} msg=\"{e['event']}\""]
+        for detail in e.get("error_detail", ()):
+            entries.append(f"    {detail.get('exc_type', '')}: {detail.get('exc_value', '')}")
+        return [line for entry in entries for line in entry.split("\n")]
+
+    @classmethod
+    def _format_log(cls, content: List[Dict[str, Any]]) -> List[str]:
+        lines = []
+        for e in content:
+            lines.extend(cls._format_log_event(e))
+        return lines
+
+    def _task_log_of_lines(self, lines: List[str]) -> TicketTaskLog:
+        """the whole log view, truncated from the head to MAX_LOG_LINES lines"""
+        m = lines[-1 * self.MAX_LOG_LINES:]
+        if len(lines) > self.MAX_LOG_LINES:
+            m.append(
+                f"level=fatal, time={datetime.datetime.now()}, "
+                f'msg="MAX LOG LINES({self.MAX_LOG_LINES}) reached, log truncated from head, like `tail -n`"'
+            )
+        return TicketTaskLog(message="\n".join(m), load_success=True)
+
+    def _build_task_log(self, execution_output_id: str, data: Dict[str, Any]) -> TicketTaskLog:
+        logger.debug("log for %s: %s", execution_output_id, data)
+        if "content" not in data:
+            return TicketTaskLog(
+                message="Load log from airflow failed, no content found, maybe rotated",
+                is_rotated=True
+            )
+        return self._task_log_of_lines(self._format_log(data["content"]))
+
     def get_exec_log(self, execution_output_id: str) -> TicketTaskLog:
         try:
             dag_id, dag_run_id, task_id, try_number = execution_output_id.split("|")
             std_out = self.airflow_client.get_task_log(
                 dag_id, dag_run_id, task_id, int(try_number)
             )
-            data = json.loads(std_out.read())
-            logger.debug("log for %s: %s", execution_output_id, data)
-            if "content" not in data:
-                return TicketTaskLog(
-                    message="Load log from airflow failed, no content found, maybe rotated",
-                    is_rotated=True
-                )
-            else:
-                m = []
-                content = data["content"]
-                is_truncated = len(content) > self.MAX_LOG_LINES
-
-                for e in content[-1 * self.MAX_LOG_LINES:]:
-                    if "level" not in e or "timestamp" not in e or "event" not in e:
-                        continue
-                    else:
-                        m.append(
-                            f"level={e['level']} time={e['timestamp']} msg=\"{e['event']}\""
-                        )
-                        if "error_detail" in e:
-                            for detail in e['error_detail']:
-                                m.append(f"    {detail.get('exc_type', '')}: {detail.get('exc_value', '')}")
-
-                if is_truncated:
-                    m.append(
-                        f"level=fatal, time={datetime.datetime.now()}, "
-                        f'msg="MAX LOG LINES({self.MAX_LOG_LINES}) reached, log truncated from head, like `tail -n`"'
-                    )
+            return self._build_task_log(execution_output_id, json.loads(std_out.read()))
+        except Exception as e:
+            logger.exception(e)
+            return TicketTaskLog(
+                message="Load log from airflow failed, contact admin for help",
+                load_success=False,
+            )
+
+    async def _get_task_try_state(self, dag_id, dag_run_id, task_id, try_number):
+        try:
+            task_try = await self.async_airflow_client.get_task_instance_try(
+                dag_id, dag_run_id, task_id, try_number
+            )
+            return task_try.state
+        except Exception as e:
+            logger.warning(
+                "get state of task %s try %s in %s failed: %s", task_id, try_number, dag_run_id, e
+            )
+            return None
+
+    @staticmethod
+    def _log_cache_key(execution_output_id):
+        # the untruncated lines are cached, not the message of a task log
+        return ["lines", execution_output_id]
 
-                return TicketTaskLog(message="\n".join(m), load_success=True)
+    async def _get_log_lines(self, execution_output_id: str) -> Optional[List[str]]:
+        """
+        all formatted lines of a task try, None if the log is rotated,
+        lines of a finished try are cached
+        """
+        if _task_log_cache is not None:
+            lines = await _task_log_cache.get_async(self._log_cache_key(execution_output_id))
+            if lines is not None:
+                return lines
+        dag_id, dag_run_id, task_id, try_number = execution_output_id.split("|")
+        if _task_log_cache is None:
+            data = await self.async_airflow_client.get_task_log(
+                dag_id, dag_run_id, task_id, int(try_number)
+            )
+            return self._format_log(data["content"]) if "content" in data else None
+
+        data, task_try_state = await asyncio.gather(
+            self.async_airflow_client.get_task_log(dag_id, dag_run_id, task_id, int(try_number)),
+            self._get_task_try_state(dag_id, dag_run_id, task_id, int(try_number)),
+        )
+        if "content" not in data:
+            return None
+        lines = self._format_log(data["content"])
+        if task_try_state in TERMINAL_TASK_STATES:
+            await _task_log_cache.set_async(self._log_cache_key(execution_output_id), lines)
+        return lines
+
+    async def get_exec_log_async(self, execution_output_id: str) -> TicketTaskLog:
+        try:
+            lines = await self._get_log_lines(execution_output_id)
         except Exception as e:
             logger.exception(e)
             return TicketTaskLog(
                 message="Load log from airflow failed, contact admin for help",
                 load_success=False,
             )
+        if lines is None:
+            return TicketTaskLog(
+                message="Load log from airflow failed, no content found, maybe rotated",
+                is_rotated=True
+            )
+        return self._task_log_of_lines(lines)
+
+    async def stream_exec_log_async(
+        self, execution_output_id: str, offset: int = 0
+    ) -> AsyncIterator[str]:
+        dag_id, dag_run_id, task_id, try_number = execution_output_id.split("|")
+        if _task_log_cache is not None and (
+            self._log_cache_key(execution_output_id) in _task_log_cache
+            or await self._get_task_try_state(dag_id, dag_run_id, task_id, int(try_number))
+            in TERMINAL_TASK_STATES
+        ):
+            # finished try, serve its untruncated lines from (and fill) the log cache
+            lines = await self._get_log_lines(execution_output_id)
+            if lines is None:
+                raise RuntimeError("log not found, maybe rotated")
+            for line in lines[offset:]:
+                yield line
+            return
+
+        if offset:
+            # a tail of a running try, continue from the token of the last tail if there is one
+            token = _task_log_tails.get((execution_output_id, offset))
+            data = await self.async_airflow_client.get_task_log(
+                dag_id, dag_run_id, task_id, int(try_number), token=token
+            )
+            line_no = offset if token else 0
+            lines = []
+            for e in data.get("content") or []:
+                for line in self._format_log_event(e):
+                    if line_no >= offset:
+                        lines.append(line)
+                    line_no += 1
+            if data.get("continuation_token"):
+                _task_log_tails.set((execution_output_id, line_no), data["continuation_token"])
+            for line in lines:
+                yield line
+            return
+
+        line_no = 0
+        async for e in self.async_airflow_client.stream_task_log(
+            dag_id, dag_run_id, task_id, int(try_number)
+        ):
+            for line in self._format_log_event(e):
+                if line_no >= offset:
+                    yield line
+                line_no += 1
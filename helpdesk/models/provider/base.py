@@ -1,12 +1,15 @@
-from typing import List, Dict, Optional, Any, Tuple
+from typing import List, Dict, Optional, Any, Tuple, AsyncIterator
 from datetime import datetime
 
+from starlette.concurrency import run_in_threadpool
+
 from helpdesk.libs.types import (
     TicketExecResultInfo,
     ActionInfo,
     ActionSchema,
     TicketExecInfo,
     TicketTaskLog,
+    TicketExecStatus,
 )
 
 
@@ -34,6 +37,11 @@ class BaseProvider:
     - Provider saves execution metadata using `get_exec_annotation`.
     - User checks the ticket result by `get_exec_result`.
     - User checks task logs using `get_exec_log`.
+    - Background reconciler refreshes running executions by `get_exec_statuses_async`.
+
+    `exec_ticket`, `get_exec_result` and `get_exec_log` are called from the api handlers through
+    their awaitable counterparts (`*_async`), which default to running the sync version in a
+    threadpool. Providers with a native asyncio client should override them.
     """
 
     provider_type = None
@@ -83,3 +91,45 @@ class BaseProvider:
     def get_exec_log(self, log_query_args: Dict[str, str]) -> TicketTaskLog:
         "get exec log by query args"
         raise NotImplementedError()
+
+    async def exec_ticket_async(
+        self, ticket_name: str, parameters: Dict[str, Any]
+    ) -> Tuple[TicketExecInfo, str]:
+        "awaitable `exec_ticket`"
+        return await run_in_threadpool(self.exec_ticket, ticket_name, parameters)
+
+    async def get_exec_result_async(
+        self, execution_annotation: Dict[str, Any]
+    ) -> (Optional[TicketExecResultInfo], str):
+        "awaitable `get_exec_result`"
+        return await run_in_threadpool(self.get_exec_result, execution_annotation)
+
+    async def get_exec_log_async(self, log_query_args: Dict[str, str]) -> TicketTaskLog:
+        "awaitable `get_exec_log`"
+        return await run_in_threadpool(self.get_exec_log, log_query_args)
+
+    async def get_exec_statuses_async(
+        self, execution_annotations: List[Dict[str, Any]], since: Optional[datetime] = None
+    ) -> List[Optional[TicketExecStatus]]:
+        """
+        batch get execution status, result is aligned with `execution_annotations`, None if unknown.
+        `since` is a hint of the earliest execution, providers with a batch api should override this.
+        """
+        statuses = []
+        for annotation in execution_annotations:
+            result, _ = await self.get_exec_result_async(annotation)
+            statuses.append(result.status if result else None)
+        return statuses
+
+    async def stream_exec_log_async(
+        self, log_query_args: Dict[str, str], offset: int = 0
+    ) -> AsyncIterator[str]:
+        """
+        yield formatted log lines from line `offset`, lets client tail a running task.
+        default implementation loads the whole log by `get_exec_log_async`
+        """
+        task_log = await self.get_exec_log_async(log_query_args)
+        if not task_log.load_success:
+            raise RuntimeError(task_log.message)
+        for line in task_log.message.splitlines()[offset:]:
+            yield line
@@ -3,6 +3,7 @@ import pytest
 from httpx import AsyncClient, ASGITransport
 from pytest import MonkeyPatch
 from helpdesk import config
+from helpdesk.libs import airflow, circuit_breaker
 from helpdesk.libs.auth import Validator
 from helpdesk.models.action import Action
 from helpdesk.models.db import Base
@@ -31,6 +32,17 @@ def test_configs():
     config.ACTION_TREE_CONFIG = ["功能导航", [SUBTREE]]
 
 
+@pytest.fixture(autouse=True)
+def reset_circuit_breakers(monkeypatch: MonkeyPatch):
+    monkeypatch.setattr(circuit_breaker, "_breakers", {})
+
+
+@pytest.fixture(autouse=True)
+def reset_airflow_tokens(monkeypatch: MonkeyPatch):
+    monkeypatch.setattr(airflow, "_tokens", {})
+    monkeypatch.setattr(airflow, "_async_tokens", {})
+
+
 @pytest.fixture
 def test_admin_user():
     return User(name="admin_user", email="admin_user@example.com", roles=["admin"])
@@ -0,0 +1,402 @@
+# coding: utf-8
+"""
+in-process stand-in of the airflow v2 rest api used by helpdesk, for load tests and benchmarks
+of the provider without a live airflow.
+
+the async client runs against it without a socket::
+
+    fake = FakeAirflow(tasks=2000, log_lines=100000, latency=0.05, error_rate=0.01)
+    fake.install(AIRFLOW_SERVER_URL)
+
+the sync client (urllib3) needs a real server::
+
+    python -m helpdesk.tests.fake_airflow --port 8081 --tasks 2000 --log-lines 100000
+
+`latency` and `error_rate` are either a number for all endpoints or a dict of
+endpoint name => value, with the `default` key for the others. endpoint names follow
+the circuit breakers in `helpdesk.libs.airflow`: token, dags, dag_details,
+trigger_dag_run, dag_run, dag_runs_batch, task_instances, task_instance_try,
+task_log and dag_graph.
+
+dag runs triggered here are running for `run_seconds`, their tasks finish one by one,
+a `failed_rate` of them fail at the last task.
+"""
+
+import json
+import time
+import random
+import asyncio
+import argparse
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+from functools import wraps
+
+import httpx
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse, StreamingResponse
+from starlette.routing import Route
+
+EPOCH = datetime(2024, 1, 1, tzinfo=timezone.utc)
+
+
+def _isoformat(dt):
+    return dt.strftime("%Y-%m-%dT%H:%M:%S.%fZ") if dt else None
+
+
+def _setting(value, endpoint):
+    if isinstance(value, dict):
+        return value.get(endpoint, value.get("default", 0))
+    return value
+
+
+class FakeAirflow:
+    def __init__(
+        self,
+        dags=10,
+        params=5,
+        tasks=5,
+        log_lines=100,
+        log_line_size=80,
+        latency=0.0,
+        jitter=0.0,
+        error_rate=0.0,
+        run_seconds=0.0,
+        failed_rate=0.0,
+        tag="helpdesk",
+        seed=None,
+    ):
+        self.dag_ids = [f"dag_{i}" for i in range(dags)]
+        self.params = params
+        self.tasks = tasks
+        self.log_lines = log_lines
+        self.log_line_size = log_line_size
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.run_seconds = run_seconds
+        self.failed_rate = failed_rate
+        self.tag = tag
+        self.random = random.Random(seed)
+        # (dag_id, dag_run_id) => (triggered at, conf)
+        self.dag_runs = {}
+        # endpoint => requests served, errors included
+        self.requests = Counter()
+
+        e = self._endpoint
+        run = "/api/v2/dags/{dag_id}/dagRuns/{dag_run_id}"
+        self.app = Starlette(
+            routes=[
+                Route("/auth/token", e("token", self.token), methods=["POST"]),
+                Route("/api/v2/dags", e("dags", self.get_dags)),
+                Route("/api/v2/dags/~/dagRuns/list", e("dag_runs_batch", self.list_dag_runs), methods=["POST"]),
+                Route("/api/v2/dags/{dag_id}/details", e("dag_details", self.get_dag_details)),
+                Route("/api/v2/dags/{dag_id}/dagRuns", e("trigger_dag_run", self.trigger_dag_run), methods=["POST"]),
+                Route(run, e("dag_run", self.get_dag_run)),
+                Route(run + "/taskInstances", e("task_instances", self.get_task_instances)),
+                Route(
+                    run + "/taskInstances/{task_id}/tries/{try_number:int}",
+                    e("task_instance_try", self.get_task_instance_try),
+                ),
+                Route(
+                    run + "/taskInstances/{task_id}/logs/{try_number:int}",
+                    e("task_log", self.get_task_log),
+                ),
+                Route("/ui/structure/structure_data", e("dag_graph", self.get_dag_graph)),
+            ]
+        )
+
+    async def __call__(self, scope, receive, send):
+        await self.app(scope, receive, send)
+
+    def install(self, server_url):
+        """serve the shared async http client of `server_url` from this app, return the client"""
+        from helpdesk.libs import airflow
+
+        client = httpx.AsyncClient(
+            transport=httpx.ASGITransport(app=self), base_url=server_url
+        )
+        airflow._async_http_clients[server_url] = client
+        return client
+
+    def _endpoint(self, name, handler):
+        @wraps(handler)
+        async def _(request):
+            self.requests[name] += 1
+            delay = _setting(self.latency, name)
+            if delay or self.jitter:
+                await asyncio.sleep(delay + self.random.uniform(0, self.jitter))
+            if self.random.random() < _setting(self.error_rate, name):
+                return JSONResponse({"detail": "fake airflow error"}, status_code=503)
+            return await handler(request)
+
+        return _
+
+    # payloads
+
+    def _dag(self, dag_id, details=False):
+        dag = {
+            "dag_id": dag_id,
+            "dag_display_name": dag_id,
+            "description": f"fake dag {dag_id}",
+            "file_token": "token",
+            "fileloc": f"/opt/airflow/dags/{dag_id}.py",
+            "has_import_errors": False,
+            "has_task_concurrency_limits": False,
+            "is_paused": False,
+            "is_stale": False,
+            "max_active_tasks": 16,
+            "max_consecutive_failed_dag_runs": 0,
+            "owners": ["helpdesk"],
+            "tags": [{"dag_id": dag_id, "name": self.tag}],
+        }
+        if details:
+            dag.update(
+                catchup=False,
+                concurrency=16,
+                render_template_as_native_obj=False,
+                params=self._dag_params(),
+            )
+        return dag
+
+    def _dag_params(self):
+        params = {}
+        for i in range(self.params):
+            extra = {"json_schema": {"minLength": 1}}
+            if i == 0:
+                extra["highlight_queries"] = ["level=error"]
+            params[f"param_{i}"] = {
+                "__class": "airflow.sdk.definitions.param.Param",
+                "description": f"param {i}",
+                "schema": {
+                    "type": ["null", "string"] if i % 2 else "string",
+                    "value": None,
+                    "description_md": f"param {i}\n```helpdesk{json.dumps(extra)}```",
+                },
+                "value": None,
+            }
+        return params
+
+    def _run_progress(self, dag_id, dag_run_id):
+        """(triggered at, number of finished tasks, failed or not)"""
+        triggered_at, _ = self.dag_runs[(dag_id, dag_run_id)]
+        elapsed = time.time() - triggered_at
+        if self.run_seconds <= 0 or elapsed >= self.run_seconds:
+            finished = self.tasks
+        else:
+            finished = int(elapsed / self.run_seconds * self.tasks)
+        failed = random.Random(dag_run_id).random() < self.failed_rate
+        return triggered_at, finished, failed
+
+    def _dag_run(self, dag_id, dag_run_id):
+        triggered_at, finished, failed = self._run_progress(dag_id, dag_run_id)
+        start = datetime.fromtimestamp(triggered_at, timezone.utc)
+        state = "running"
+        end = None
+        if finished >= self.tasks:
+            state = "failed" if failed else "success"
+            end = start + timedelta(seconds=self.run_seconds)
+        return {
+            "dag_id": dag_id,
+            "dag_run_id": dag_run_id,
+            "dag_versions": [
+                {
+                    "created_at": _isoformat(EPOCH),
+                    "dag_id": dag_id,
+                    "id": "0190a0a0-0000-0000-0000-000000000000",
+                    "version_number": 1,
+                }
+            ],
+            "run_after": _isoformat(start),
+            "run_type": "manual",
+            "start_date": _isoformat(start),
+            "end_date": _isoformat(end),
+            "state": state,
+            "conf": self.dag_runs[(dag_id, dag_run_id)][1],
+        }
+
+    def _task_state(self, index, finished, failed):
+        if index < finished:
+            return "failed" if failed and index == self.tasks - 1 else "success"
+        if index == finished:
+            return "running"
+        return None
+
+    def _task_instance(self, dag_id, dag_run_id, index, progress=None):
+        triggered_at, finished, failed = progress or self._run_progress(dag_id, dag_run_id)
+        state = self._task_state(index, finished, failed)
+        step = self.run_seconds / max(self.tasks, 1)
+        start = datetime.fromtimestamp(triggered_at + index * step, timezone.utc)
+        task_id = f"task_{index}"
+        return {
+            "id": f"{dag_run_id}-{task_id}",
+            "dag_id": dag_id,
+            "dag_run_id": dag_run_id,
+            "task_id": task_id,
+            "task_display_name": task_id,
+            "executor_config": "{}",
+            "map_index": -1,
+            "max_tries": 0,
+            "pool": "default_pool",
+            "pool_slots": 1,
+            "run_after": _isoformat(datetime.fromtimestamp(triggered_at, timezone.utc)),
+            "start_date": _isoformat(start) if state else None,
+            "end_date": (
+                _isoformat(start + timedelta(seconds=step))
+                if state in ("success", "failed")
+                else None
+            ),
+            "state": state,
+            "try_number": 1 if state else 0,
+        }
+
+    def _log_events(self, count):
+        filler = "x" * max(self.log_line_size - 40, 0)
+        for i in range(count):
+            yield {
+                "level": "error" if i % 100 == 99 else "info",
+                "timestamp": _isoformat(EPOCH + timedelta(milliseconds=i)),
+                "event": f"line {i} {filler}",
+            }
+
+    def _find_run(self, request):
+        key = (request.path_params["dag_id"], request.path_params["dag_run_id"])
+        return key if key in self.dag_runs else None
+
+    # endpoints
+
+    async def token(self, request):
+        return JSONResponse({"access_token": "fake-token", "token_type": "bearer"}, status_code=201)
+
+    async def get_dags(self, request):
+        tags = set(request.query_params.getlist("tags"))
+        dags = [self._dag(d) for d in self.dag_ids] if tags <= {self.tag} else []
+        return JSONResponse({"dags": dags, "total_entries": len(dags)})
+
+    async def get_dag_details(self, request):
+        dag_id = request.path_params["dag_id"]
+        if dag_id not in self.dag_ids:
+            return JSONResponse({"detail": f"dag {dag_id} not found"}, status_code=404)
+        return JSONResponse(self._dag(dag_id, details=True))
+
+    async def trigger_dag_run(self, request):
+        dag_id = request.path_params["dag_id"]
+        if dag_id not in self.dag_ids:
+            return JSONResponse({"detail": f"dag {dag_id} not found"}, status_code=404)
+        body = await request.json()
+        dag_run_id = f"manual__{datetime.now(timezone.utc).isoformat()}_{len(self.dag_runs)}"
+        self.dag_runs[(dag_id, dag_run_id)] = (time.time(), body.get("conf") or {})
+        return JSONResponse(dict(self._dag_run(dag_id, dag_run_id), state="queued"))
+
+    async def get_dag_run(self, request):
+        key = self._find_run(request)
+        if key is None:
+            return JSONResponse({"detail": "dag run not found"}, status_code=404)
+        return JSONResponse(self._dag_run(*key))
+
+    async def list_dag_runs(self, request):
+        body = await request.json()
+        dag_ids = set(body.get("dag_ids") or self.dag_ids)
+        runs = [self._dag_run(*key) for key in self.dag_runs if key[0] in dag_ids]
+        offset, limit = body.get("page_offset", 0), body.get("page_limit", 100)
+        return JSONResponse(
+            {"dag_runs": runs[offset:offset + limit], "total_entries": len(runs)}
+        )
+
+    async def get_task_instances(self, request):
+        key = self._find_run(request)
+        if key is None:
+            return JSONResponse({"detail": "dag run not found"}, status_code=404)
+        progress = self._run_progress(*key)
+        task_instances = [
+            self._task_instance(*key, index, progress) for index in range(self.tasks)
+        ]
+        return JSONResponse(
+            {"task_instances": task_instances, "total_entries": len(task_instances)}
+        )
+
+    def _find_try(self, request):
+        key = self._find_run(request)
+        task_id = request.path_params["task_id"]
+        if key is None or not task_id.startswith("task_"):
+            return None
+        index = int(task_id.removeprefix("task_"))
+        if index >= self.tasks or request.path_params["try_number"] != 1:
+            return None
+        return self._task_instance(*key, index)
+
+    async def get_task_instance_try(self, request):
+        task_instance = self._find_try(request)
+        if task_instance is None:
+            return JSONResponse({"detail": "task instance try not found"}, status_code=404)
+        return JSONResponse(task_instance)
+
+    async def get_task_log(self, request):
+        task_instance = self._find_try(request)
+        if task_instance is None:
+            return JSONResponse({"detail": "task instance try not found"}, status_code=404)
+        # a running task has written half of its log
+        count = self.log_lines if task_instance["end_date"] else self.log_lines // 2
+        events = [{"event": "::group::Log message source details"}]
+        if request.headers.get("Accept") == "application/x-ndjson":
+
+            async def content():
+                for e in events:
+                    yield json.dumps(e) + "\n"
+                chunk = []
+                for e in self._log_events(count):
+                    chunk.append(json.dumps(e))
+                    if len(chunk) >= 1000:
+                        yield "\n".join(chunk) + "\n"
+                        chunk = []
+                if chunk:
+                    yield "\n".join(chunk) + "\n"
+
+            return StreamingResponse(content(), media_type="application/x-ndjson")
+        events.extend(self._log_events(count))
+        return JSONResponse({"content": events, "continuation_token": None})
+
+    async def get_dag_graph(self, request):
+        if request.query_params.get("dag_id") not in self.dag_ids:
+            return JSONResponse({"detail": "dag not found"}, status_code=404)
+        nodes = [{"id": f"task_{i}", "label": f"task_{i}", "type": "task"} for i in range(self.tasks)]
+        edges = [
+            {"source_id": f"task_{i}", "target_id": f"task_{i + 1}"}
+            for i in range(self.tasks - 1)
+        ]
+        return JSONResponse({"nodes": nodes, "edges": edges})
+
+
+def main():
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--dags", type=int, default=10)
+    parser.add_argument("--params", type=int, default=5)
+    parser.add_argument("--tasks", type=int, default=5)
+    parser.add_argument("--log-lines", type=int, default=100)
+    parser.add_argument("--log-line-size", type=int, default=80)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--jitter", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--run-seconds", type=float, default=0.0)
+    parser.add_argument("--failed-rate", type=float, default=0.0)
+    args = parser.parse_args()
+    fake = FakeAirflow(
+        dags=args.dags,
+        params=args.params,
+        tasks=args.tasks,
+        log_lines=args.log_lines,
+        log_line_size=args.log_line_size,
+        latency=args.latency,
+        jitter=args.jitter,
+        error_rate=args.error_rate,
+        run_seconds=args.run_seconds,
+        failed_rate=args.failed_rate,
+    )
+    uvicorn.run(fake, host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
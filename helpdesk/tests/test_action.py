@@ -0,0 +1,296 @@
+import asyncio
+import threading
+import time
+from datetime import datetime
+from unittest.mock import Mock
+
+import pytest
+from airflow_client.client.models.dag_details_response import DAGDetailsResponse
+
+from helpdesk.libs.cache import LRUCache, StaleWhileRevalidateCache
+from helpdesk.libs.ratelimit import RateLimiter
+from helpdesk.libs.types import ActionInfo, RunnerType, TicketExecInfo
+from helpdesk.models import action as action_module
+from helpdesk.models import action_tree as action_tree_module
+from helpdesk.models.action import ActionResolveError, prefetch_action_schemas
+from helpdesk.models.action_tree import ActionTree
+from helpdesk.models.db.ticket import Ticket
+from helpdesk.models.provider import airflow as airflow_provider
+from helpdesk.models.provider.airflow import AirflowProvider
+from helpdesk.models.provider.errors import ResolvePackageError
+
+
+def dag_details(description="申请账号"):
+    return DAGDetailsResponse.model_construct(
+        dag_id="account_action",
+        dag_display_name="account_action",
+        description=description,
+        params={
+            "app": {
+                "description": "应用名称",
+                "schema": {"type": ["null", "string"], "description_md": ""},
+            }
+        },
+    )
+
+
+@pytest.fixture
+def schema_caches(monkeypatch):
+    monkeypatch.setattr(airflow_provider, "_action_schema_builds", LRUCache())
+    cache = StaleWhileRevalidateCache(ttl=60)
+    monkeypatch.setattr(action_module, "action_schema_cache", cache)
+    yield cache
+
+
+def test_stale_while_revalidate_cache():
+    cache = StaleWhileRevalidateCache(ttl=0)
+    assert cache.get("k", lambda: "v1") == "v1"
+
+    reloading, release = threading.Event(), threading.Event()
+
+    def slow_loader():
+        reloading.set()
+        release.wait(5)
+        return "v2"
+
+    # stale value is served while the reload runs, reloads of a key are deduped
+    assert cache.get("k", slow_loader) == "v1"
+    assert reloading.wait(5)
+    assert cache.get("k", slow_loader) == "v1"
+    assert cache.refresh("k", slow_loader) is None
+    release.set()
+    cache._executor.shutdown(wait=True)
+    assert cache._data.get("k")[1] == "v2"
+
+
+def test_stale_value_kept_on_reload_failure():
+    cache = StaleWhileRevalidateCache(ttl=0)
+    cache.set("k", "v1")
+
+    def broken_loader():
+        raise RuntimeError("airflow down")
+
+    assert cache.refresh("k", broken_loader).result() is None
+    assert cache.refresh("k", lambda: None).result() is None
+    assert cache.get("k", broken_loader) == "v1"
+
+
+def test_resolve_action_cached(schema_caches, test_action, monkeypatch):
+    provider = AirflowProvider()
+    get_schema = Mock(return_value=dag_details())
+    monkeypatch.setattr(provider.airflow_client, "get_schema_by_dag_id", get_schema)
+
+    schema = test_action.resolve_action(provider)
+    assert schema.description == "申请账号"
+    assert test_action.resolve_action(provider) is schema
+    assert get_schema.call_count == 1
+
+    # reloaded dag details with the same content reuse the built schema
+    reloaded = schema_caches.refresh(
+        ("airflow", "account_action"),
+        lambda: provider.get_action_schema("account_action"),
+    ).result()
+    assert reloaded is schema
+
+    get_schema.return_value = dag_details(description="申请新账号")
+    reloaded = schema_caches.refresh(
+        ("airflow", "account_action"),
+        lambda: provider.get_action_schema("account_action"),
+    ).result()
+    assert reloaded.description == "申请新账号"
+    assert test_action.resolve_action(provider) is reloaded
+
+
+def test_resolve_action_failed(schema_caches, test_action, monkeypatch):
+    provider = AirflowProvider()
+    monkeypatch.setattr(
+        provider.airflow_client,
+        "get_schema_by_dag_id",
+        Mock(side_effect=RuntimeError("airflow down")),
+    )
+    with pytest.raises(ActionResolveError):
+        test_action.resolve_action(provider)
+    assert ("airflow", "account_action") not in schema_caches
+
+
+def test_action_tree_refresh(schema_caches, monkeypatch):
+    provider = Mock(provider_type="airflow")
+    # prefetched once the new tree is swapped in and out of the refresh lock
+    provider.get_action_schema.side_effect = lambda dag_id: (
+        tree._refresh_lock.locked(),
+        tree.find(dag_id) is not None,
+    )
+    provider.get_actions_info.return_value = [
+        ActionInfo(name="申请账号", description="申请账号", action_id="account_action"),
+        ActionInfo(name="重置密码", description="重置密码", action_id="reset_password"),
+    ]
+    monkeypatch.setattr(action_tree_module, "get_provider", Mock(return_value=provider))
+    config = [
+        "功能导航",
+        [
+            ["账号", "账号", "airflow", "account."],
+            ["其他", [["申请权限", "申请权限", "airflow", "permission_action"]]],
+        ],
+    ]
+
+    tree = ActionTree(config)
+    provider.get_actions_info.assert_not_called()
+    pack = tree.nexts[0]
+    assert pack.name == "账号" and pack.nexts == []
+    assert tree.find("permission_action") is not None
+
+    state = tree._state
+    tree.refresh()
+    provider.get_actions_info.assert_called_once_with(pack="account")
+    assert schema_caches.get(("airflow", "reset_password"), Mock()) == (False, True)
+    # readers holding the old snapshot are not affected by the swap
+    assert pack.nexts == []
+    assert state.nexts[0] is pack and state.packs == {}
+    assert tree.packs is tree._state.packs and "account." in tree.packs
+    leaf = tree.find("reset_password")
+    assert tree.path_to(leaf) == ["0-功能导航", "1-账号", "2-重置密码"]
+
+    # failed resolution keeps the children of last refresh
+    provider.get_actions_info.side_effect = ResolvePackageError(
+        RuntimeError("airflow down"), "tb", "Resolve pack account error"
+    )
+    tree.refresh()
+    assert [n.name for n in tree.nexts[0].nexts] == ["申请账号", "重置密码"]
+
+
+def test_prefetch_action_schemas(schema_caches):
+    lock = threading.Lock()
+    in_flight, max_in_flight = 0, 0
+
+    def get_action_schema(dag_id):
+        nonlocal in_flight, max_in_flight
+        with lock:
+            in_flight += 1
+            max_in_flight = max(max_in_flight, in_flight)
+        time.sleep(0.02)
+        with lock:
+            in_flight -= 1
+        if dag_id == "broken":
+            raise RuntimeError("airflow down")
+        return f"schema of {dag_id}"
+
+    provider = Mock(provider_type="airflow", get_action_schema=get_action_schema)
+    schema_caches.set(("airflow", "dag_0"), "cached")
+    dag_ids = [f"dag_{i}" for i in range(12)] + ["broken"]
+
+    assert prefetch_action_schemas(provider, dag_ids, concurrency=4) == 11
+    assert max_in_flight == 4
+    assert schema_caches.get(("airflow", "dag_0"), Mock()) == "cached"
+    assert schema_caches.get(("airflow", "dag_11"), Mock()) == "schema of dag_11"
+    assert ("airflow", "broken") not in schema_caches
+
+
+def test_airflow_schema_conversion_memoized(monkeypatch):
+    monkeypatch.setattr(airflow_provider, "_param_conversions", LRUCache())
+    convert = Mock(wraps=AirflowProvider._convert_airflow_schema)
+    monkeypatch.setattr(AirflowProvider, "_convert_airflow_schema", convert)
+    params = {
+        "role": {
+            "description": "账号角色类型",
+            "schema": {
+                "type": "string",
+                "enum": ["admin", "normal"],
+                "description_md": '```helpdesk{"json_schema": {"minLength": 1}}```',
+            },
+        }
+    }
+
+    params_schema, json_schema, _ = AirflowProvider.airflow_schema_to_helpdesk(params)
+    assert params_schema["role"].enum == ["admin", "normal"]
+    assert json_schema["properties"]["role"] == {"type": "string", "minLength": 1}
+    # callers fill up params in place, that must not leak into the memoized result
+    params_schema["role"].default = "admin"
+
+    params_schema, json_schema_again, _ = AirflowProvider.airflow_schema_to_helpdesk(
+        dict(params)
+    )
+    assert params_schema["role"].default is None
+    assert json_schema_again is json_schema
+    assert convert.call_count == 1
+
+
+@pytest.mark.anyio
+async def test_run_batch(
+    schema_caches,
+    monkeypatch,
+    test_action,
+    test_user,
+    test_policy,
+    test_cc_submitter_policy,
+):
+    provider = AirflowProvider()
+    details = dag_details()
+    details.params = {
+        "app": {"description": "应用名称", "schema": {"type": "string"}},
+        "reason": {"description": "申请理由", "schema": {"type": ["null", "string"]}},
+    }
+    schema_caches.set(
+        ("airflow", "account_action"),
+        provider._build_action_from_dag_details(details, "account_action"),
+    )
+
+    in_flight, max_in_flight = 0, 0
+
+    async def exec_ticket_async(self, ticket_name, parameters, extra_info=None):
+        nonlocal in_flight, max_in_flight
+        in_flight += 1
+        max_in_flight = max(max_in_flight, in_flight)
+        await asyncio.sleep(0.02)
+        in_flight -= 1
+        if parameters["app"] == "broken":
+            return None, "trigger failed"
+        if parameters["app"] == "app_0":
+            # the tickets are changed by others meanwhile
+            t = Ticket.__table__
+            await Ticket._execute(t.update().values(version=t.c.version + 1))
+        return (
+            TicketExecInfo(
+                exec_id=f"run_{parameters['app']}",
+                execution_date=datetime.now(),
+                msg="queued",
+                ticket_name=ticket_name,
+                runner=RunnerType.AIRFLOW,
+                result_url="https://airflow.example.com",
+                annotation={"dag_version": 1},
+            ),
+            "",
+        )
+
+    monkeypatch.setattr(AirflowProvider, "exec_ticket_async", exec_ticket_async)
+    auto = "test_cc_policy_to_submitter"
+    forms = [{"app": f"app_{i}", "reason": auto} for i in range(6)]
+    forms += [{"app": "broken", "reason": auto}, {"app": "app", "reason": "pending"}, {}]
+
+    results = await test_action.run_batch(provider, forms, test_user, concurrency=2, rate=0)
+
+    assert [r["success"] for r in results] == [True] * 6 + [False, True, False]
+    assert max_in_flight == 2
+    assert "required parameter" in results[-1]["msg"]
+    assert results[-2]["ticket"]["is_approved"] is None
+    tickets = await Ticket.get_all(ids=[r["ticket"]["id"] for r in results[:-1]])
+    assert len(tickets) == 8
+    executed = [t for t in tickets if t.annotation.get("execution")]
+    assert sorted(t.annotation["execution"]["dag_run_id"] for t in executed) == [
+        f"run_app_{i}" for i in range(6)
+    ]
+    assert all(t.executed_at for t in executed)
+    broken = next(t for t in tickets if t.params["app"] == "broken")
+    assert broken.annotation["execution_creation_success"] is False
+    assert broken.annotation["policy"] == "test_cc_policy_to_submitter"
+    pending = next(t for t in tickets if t.params["app"] == "app")
+    assert pending.annotation["policy"] == "test_policy"
+
+
+@pytest.mark.anyio
+async def test_rate_limiter():
+    limiter = RateLimiter(rate=50, burst=2)
+    started = time.monotonic()
+    for _ in range(7):
+        await limiter.acquire()
+    # 2 at once, then 5 at 50/s
+    assert 0.08 <= time.monotonic() - started < 0.5
@@ -0,0 +1,755 @@
+import asyncio
+import json
+import os
+import threading
+import time
+from datetime import datetime
+
+import httpx
+import pytest
+from httpx import AsyncClient
+
+from helpdesk.config import AIRFLOW_SERVER_URL
+from helpdesk.libs import airflow
+from helpdesk.libs.cache import DiskCache, LRUCache, StaleWhileRevalidateCache
+from helpdesk.libs.log_search import compile_queries, search_log
+from helpdesk.libs import watcher as watcher_module
+from helpdesk.libs.types import (
+    ActionSchema,
+    StatusColor,
+    TicketExecStatus,
+    TicketExecTaskStatus,
+)
+from helpdesk.libs.watcher import get_execution_watcher
+from helpdesk.models import action as action_module
+from helpdesk.models.db.ticket import Ticket
+from helpdesk.models.provider import airflow as airflow_provider
+from helpdesk.models.provider.airflow import AirflowProvider
+from helpdesk.tests.fake_airflow import FakeAirflow
+
+DAG_ID = "account_action"
+DAG_RUN_ID = "manual__2024-01-01T00:00:00+00:00"
+DAG_VERSION = {
+    "created_at": "2024-01-01T00:00:00Z",
+    "dag_id": DAG_ID,
+    "id": "0190a0a0-0000-0000-0000-000000000000",
+    "version_number": 2,
+}
+
+
+def dag_run_payload(state="running"):
+    return {
+        "dag_id": DAG_ID,
+        "dag_run_id": DAG_RUN_ID,
+        "dag_versions": [DAG_VERSION],
+        "run_after": "2024-01-01T00:00:00Z",
+        "run_type": "manual",
+        "start_date": "2024-01-01T00:00:01Z",
+        "state": state,
+    }
+
+
+def task_instance_payload(task_id, state="success", try_number=1):
+    return {
+        "dag_id": DAG_ID,
+        "dag_run_id": DAG_RUN_ID,
+        "executor_config": "{}",
+        "id": f"ti-{task_id}",
+        "map_index": -1,
+        "max_tries": 0,
+        "pool": "default_pool",
+        "pool_slots": 1,
+        "run_after": "2024-01-01T00:00:00Z",
+        "start_date": "2024-01-01T00:00:01Z",
+        "end_date": "2024-01-01T00:00:02Z",
+        "state": state,
+        "task_display_name": task_id,
+        "task_id": task_id,
+        "try_number": try_number,
+    }
+
+
+GRAPH = {
+    "nodes": [{"id": "create", "label": "create"}, {"id": "notify", "label": "notify"}],
+    "edges": [{"source_id": "create", "target_id": "notify"}],
+}
+
+LOG = {
+    "content": [
+        {"event": "::group::Log message source details"},
+        {"level": "info", "timestamp": "2024-01-01T00:00:01Z", "event": "start"},
+        {
+            "level": "error",
+            "timestamp": "2024-01-01T00:00:02Z",
+            "event": "failed",
+            "error_detail": [{"exc_type": "ValueError", "exc_value": "boom"}],
+        },
+    ]
+}
+
+# the log written after LOG, read with its continuation token
+LOG_TAIL = {
+    "content": [{"level": "info", "timestamp": "2024-01-01T00:00:03Z", "event": "more"}],
+    "continuation_token": "log-end",
+}
+
+
+@pytest.fixture
+def airflow_requests(monkeypatch):
+    requests = []
+
+    def handler(request: httpx.Request):
+        requests.append(request)
+        path = request.url.path
+        if path == "/auth/token":
+            return httpx.Response(201, json={"access_token": "token"})
+        if path == f"/api/v2/dags/{DAG_ID}/dagRuns" and request.method == "POST":
+            return httpx.Response(200, json=dag_run_payload(state="queued"))
+        if path == "/api/v2/dags/~/dagRuns/list":
+            body = json.loads(request.content)
+            assert body["dag_ids"] == [DAG_ID]
+            other_run = dict(dag_run_payload(state="failed"), dag_run_id="other")
+            return httpx.Response(
+                200,
+                json={
+                    "dag_runs": [other_run, dag_run_payload(state="success")],
+                    "total_entries": 2,
+                },
+            )
+        if "/tries/" in path:
+            task_id = path.split("/")[-3]
+            try_state = "running" if task_id == "notify" else "success"
+            return httpx.Response(200, json=task_instance_payload(task_id, state=try_state))
+        if path.endswith("/taskInstances"):
+            return httpx.Response(
+                200,
+                json={
+                    "task_instances": [
+                        task_instance_payload("create"),
+                        task_instance_payload("notify", state="running"),
+                    ],
+                    "total_entries": 2,
+                },
+            )
+        if path == f"/api/v2/dags/{DAG_ID}/dagRuns/{DAG_RUN_ID}":
+            return httpx.Response(200, json=dag_run_payload())
+        if "/logs/" in path:
+            if request.headers["Accept"] == "application/x-ndjson":
+                ndjson = "\n".join(json.dumps(e) for e in LOG["content"])
+                return httpx.Response(200, content=ndjson.encode())
+            if request.url.params.get("token") == "log-end":
+                return httpx.Response(200, json=LOG_TAIL)
+            return httpx.Response(200, json=dict(LOG, continuation_token="log-end"))
+        if path == "/ui/structure/structure_data":
+            return httpx.Response(200, json=GRAPH)
+        return httpx.Response(404, json={"detail": "not found"})
+
+    client = httpx.AsyncClient(
+        transport=httpx.MockTransport(handler), base_url=AIRFLOW_SERVER_URL
+    )
+    monkeypatch.setitem(airflow._async_http_clients, AIRFLOW_SERVER_URL, client)
+    monkeypatch.setattr(airflow_provider, "_dag_graph_cache", LRUCache())
+    monkeypatch.setattr(airflow_provider, "_task_log_tails", LRUCache())
+    yield requests
+
+
+def exec_annotation():
+    return {
+        "dag_id": DAG_ID,
+        "dag_run_id": DAG_RUN_ID,
+        "dag_version": 2,
+        "result_url": f"{AIRFLOW_SERVER_URL}/dags/{DAG_ID}/runs/{DAG_RUN_ID}",
+    }
+
+
+@pytest.mark.anyio
+async def test_exec_ticket_async(airflow_requests):
+    provider = AirflowProvider()
+    execution, msg = await provider.exec_ticket_async(DAG_ID, {"app": "helpdesk"})
+    assert msg == ""
+    assert execution.exec_id == DAG_RUN_ID
+    assert execution.annotation == {"dag_version": 2}
+
+    trigger = airflow_requests[-1]
+    assert trigger.headers["Authorization"] == "Bearer token"
+    assert json.loads(trigger.content)["conf"] == {"app": "helpdesk"}
+
+
+@pytest.mark.anyio
+async def test_get_exec_result_async(airflow_requests):
+    provider = AirflowProvider()
+    result, msg = await provider.get_exec_result_async(exec_annotation())
+    assert msg == ""
+    assert result.status == TicketExecStatus.RUNNING
+    assert [t.state for t in result.result.tasks] == [
+        TicketExecTaskStatus.SUCCESS,
+        TicketExecTaskStatus.RUNNING,
+    ]
+    assert [n.key for n in result.graph.nodes] == ["create", "notify"]
+    # dag run id is quoted as a single path segment
+    assert any("manual__2024-01-01T00%3A00%3A00%2B00%3A00" in str(r.url) for r in airflow_requests)
+
+
+@pytest.mark.anyio
+async def test_get_exec_log_async(airflow_requests):
+    provider = AirflowProvider()
+    log = await provider.get_exec_log_async(f"{DAG_ID}|{DAG_RUN_ID}|create|1")
+    assert log.load_success
+    assert log.message.splitlines() == [
+        'level=info time=2024-01-01T00:00:01Z msg="start"',
+        'level=error time=2024-01-01T00:00:02Z msg="failed"',
+        "    ValueError: boom",
+    ]
+
+
+@pytest.mark.anyio
+async def test_dag_graph_cached_by_version(airflow_requests):
+    provider = AirflowProvider()
+    for _ in range(3):
+        result, _ = await provider.get_exec_result_async(exec_annotation())
+        assert len(result.graph.nodes) == 2
+    structure_requests = [
+        r for r in airflow_requests if r.url.path == "/ui/structure/structure_data"
+    ]
+    assert len(structure_requests) == 1
+    assert structure_requests[0].url.params["version_number"] == "2"
+
+
+def test_lru_cache_with_disk(tmp_path):
+    cache = LRUCache(maxsize=2, disk=DiskCache(str(tmp_path)))
+    cache.set(("a", 1), {"nodes": []})
+    cache.set(("b", 1), {"nodes": []})
+    cache.set(("c", 1), {"nodes": []})
+    assert ("a", 1) not in cache
+    assert len(cache) == 2
+
+    # evicted from memory, loaded back from disk by another worker
+    other_worker = LRUCache(maxsize=2, disk=DiskCache(str(tmp_path)))
+    assert other_worker.get(("a", 1)) == {"nodes": []}
+    assert other_worker.get(("d", 1)) is None
+
+
+@pytest.mark.anyio
+async def test_exec_result_fan_out(airflow_requests, monkeypatch):
+    sync_handler = (
+        airflow._async_http_clients[AIRFLOW_SERVER_URL]._transport.handler
+    )
+    in_flight, max_in_flight = 0, 0
+
+    async def slow_handler(request):
+        nonlocal in_flight, max_in_flight
+        in_flight += 1
+        max_in_flight = max(max_in_flight, in_flight)
+        await asyncio.sleep(0.05)
+        in_flight -= 1
+        return sync_handler(request)
+
+    client = httpx.AsyncClient(
+        transport=httpx.MockTransport(slow_handler), base_url=AIRFLOW_SERVER_URL
+    )
+    monkeypatch.setitem(airflow._async_http_clients, AIRFLOW_SERVER_URL, client)
+    provider = AirflowProvider()
+    await provider.async_airflow_client.get_access_token()
+
+    result, _ = await provider.get_exec_result_async(exec_annotation())
+    assert result.graph.nodes
+    assert max_in_flight == 3
+
+    monkeypatch.setattr(airflow_provider, "AIRFLOW_RESULT_TIMEOUT_SECONDS", 0.01)
+    result, msg = await provider.get_exec_result_async(exec_annotation())
+    assert result is None
+    assert "timeout" in msg
+
+
+@pytest.mark.anyio
+async def test_reconcile_executions(airflow_requests):
+    def ticket(**annotation):
+        return Ticket(
+            title="test",
+            provider_type="airflow",
+            provider_object=DAG_ID,
+            params={},
+            submitter="test_user",
+            is_approved=True,
+            annotation=dict(
+                execution=exec_annotation(),
+                execution_submitted=True,
+                execution_creation_success=True,
+                **annotation,
+            ),
+            created_at=datetime.now(),
+            executed_at=datetime.now(),
+        )
+
+    running_id = await ticket(execution_status="running").save()
+    submitted_id = await ticket().save()
+    marked_id = await ticket(execution_status="running", final_exec_status=True).save()
+
+    # the marked ticket is the latest one, the limit is filled from the next page
+    assert await Ticket.reconcile_executions(limit=1) == 1
+    assert (await Ticket.get(submitted_id)).status == "success"
+    assert (await Ticket.get(running_id)).status == "running"
+    assert await Ticket.reconcile_executions() == 1
+    assert (await Ticket.get(running_id)).status == "success"
+    assert (await Ticket.get(marked_id)).status == "running"
+    assert (await Ticket.get(running_id)).current_status == "success"
+    # one batch request a run
+    batch_requests = [r for r in airflow_requests if r.url.path.endswith("/dagRuns/list")]
+    assert len(batch_requests) == 2
+
+
+@pytest.mark.anyio
+async def test_exec_statuses_max_pages(monkeypatch):
+    requests = []
+
+    def handler(request: httpx.Request):
+        requests.append(request)
+        if request.url.path == "/auth/token":
+            return httpx.Response(201, json={"access_token": "token"})
+        # a long run history without the wanted run
+        body = json.loads(request.content)
+        runs = [
+            dict(dag_run_payload(state="success"), dag_run_id=f"other_{body['page_offset'] + i}")
+            for i in range(body["page_limit"])
+        ]
+        return httpx.Response(200, json={"dag_runs": runs, "total_entries": 100000})
+
+    client = httpx.AsyncClient(
+        transport=httpx.MockTransport(handler), base_url=AIRFLOW_SERVER_URL
+    )
+    monkeypatch.setitem(airflow._async_http_clients, AIRFLOW_SERVER_URL, client)
+    provider = AirflowProvider()
+
+    assert await provider.get_exec_statuses_async([exec_annotation()]) == [None]
+    batch_requests = [r for r in requests if r.url.path.endswith("/dagRuns/list")]
+    assert len(batch_requests) == AirflowProvider.DAG_RUNS_BATCH_MAX_PAGES
+
+
+@pytest.mark.anyio
+async def test_stream_exec_log(airflow_requests, test_client: AsyncClient):
+    provider = AirflowProvider()
+    output_id = f"{DAG_ID}|{DAG_RUN_ID}|create|1"
+    lines = [line async for line in provider.stream_exec_log_async(output_id, offset=1)]
+    assert lines == ['level=error time=2024-01-01T00:00:02Z msg="failed"', "    ValueError: boom"]
+
+    ticket_id = await Ticket(title="test", provider_type="airflow", annotation={}).save()
+    response = await test_client.get(
+        f"/api/ticket/{ticket_id}/result_log",
+        params={"exec_output_id": output_id, "stream": True, "offset": 2},
+    )
+    assert response.status_code == 200
+    assert response.text == "    ValueError: boom\n"
+
+    # the next tail continues from the airflow continuation token of the last one
+    lines = [line async for line in provider.stream_exec_log_async(output_id, offset=3)]
+    assert lines == ['level=info time=2024-01-01T00:00:03Z msg="more"']
+    assert airflow_requests[-1].url.params["token"] == "log-end"
+
+
+def test_disk_cache_compress_and_evict(tmp_path):
+    cache = DiskCache(str(tmp_path), compress=True, max_bytes=500)
+    cache.set("a", "a" * 1000)
+    assert cache.get("a") == "a" * 1000
+    assert next(tmp_path.iterdir()).stat().st_size < 100
+
+    cache.set("b", os.urandom(300).hex())
+    os.utime(cache._path("b"), (0, 0))
+    assert "b" in cache
+    cache.set("c", os.urandom(300).hex())
+    # least recently used one is evicted
+    assert "b" not in cache
+    assert "a" in cache and "c" in cache
+    assert sum(f.stat().st_size for f in tmp_path.iterdir()) <= 500
+    # the size is tracked, not rescanned on every write
+    cache.pop("c")
+    assert cache._total == sum(f.stat().st_size for f in tmp_path.iterdir())
+
+
+def log_requests(airflow_requests):
+    return [r for r in airflow_requests if "/logs/" in r.url.path]
+
+
+@pytest.mark.anyio
+async def test_task_log_cache(airflow_requests, monkeypatch, tmp_path):
+    monkeypatch.setattr(airflow_provider, "_task_log_cache", DiskCache(str(tmp_path), compress=True))
+    provider = AirflowProvider()
+
+    # finished try, loaded from airflow once
+    finished = f"{DAG_ID}|{DAG_RUN_ID}|create|1"
+    first = await provider.get_exec_log_async(finished)
+    second = await provider.get_exec_log_async(finished)
+    assert first.load_success and second.message == first.message
+    assert len(log_requests(airflow_requests)) == 1
+    lines = [line async for line in provider.stream_exec_log_async(finished, offset=2)]
+    assert lines == ["    ValueError: boom"]
+    assert len(log_requests(airflow_requests)) == 1
+
+    # running try is never cached
+    running = f"{DAG_ID}|{DAG_RUN_ID}|notify|1"
+    await provider.get_exec_log_async(running)
+    await provider.get_exec_log_async(running)
+    lines = [line async for line in provider.stream_exec_log_async(running)]
+    assert len(lines) == 3
+    assert airflow_provider.AirflowProvider._log_cache_key(running) not in (
+        airflow_provider._task_log_cache
+    )
+    assert len(log_requests(airflow_requests)) == 4
+
+
+@pytest.mark.anyio
+async def test_log_offsets_of_running_and_finished_try(airflow_requests, monkeypatch, tmp_path):
+    monkeypatch.setattr(airflow_provider, "_task_log_cache", DiskCache(str(tmp_path)))
+    monkeypatch.setitem(
+        LOG,
+        "content",
+        [
+            {"level": "info", "timestamp": "t1", "event": "first\nsecond"},
+            {
+                "level": "error",
+                "timestamp": "t2",
+                "event": "failed",
+                "error_detail": [{"exc_type": "ValueError", "exc_value": "a\nb"}],
+            },
+            {"level": "info", "timestamp": "t3", "event": "last\r"},
+        ],
+    )
+    expected = [
+        'level=info time=t1 msg="first',
+        'second"',
+        'level=error time=t2 msg="failed"',
+        "    ValueError: a",
+        "b",
+        'level=info time=t3 msg="last\r"',
+    ]
+    provider = AirflowProvider()
+    running = f"{DAG_ID}|{DAG_RUN_ID}|notify|1"
+    finished = f"{DAG_ID}|{DAG_RUN_ID}|create|1"
+    # a tail of the running try resumes at the same line once the try is finished
+    for output_id in (running, finished, finished):
+        for offset in range(len(expected)):
+            lines = [line async for line in provider.stream_exec_log_async(output_id, offset)]
+            assert lines == expected[offset:]
+    assert (await provider.get_exec_log_async(finished)).message == "\n".join(expected)
+
+
+def test_sync_token_refresh_single_flight(monkeypatch):
+    client = airflow.AirflowClient("user", "passwd", AIRFLOW_SERVER_URL, 3600)
+    calls = []
+
+    def generate_token():
+        calls.append(threading.current_thread().name)
+        time.sleep(0.05)
+        return airflow.AirflowAccessTokenResponse(
+            access_token=f"token-{len(calls)}", expire_at_ts=time.time() + 3600
+        )
+
+    monkeypatch.setattr(client, "generate_token", generate_token)
+    threads = [threading.Thread(target=client.get_api_client) for _ in range(10)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert len(calls) == 1
+    api_client = client.get_api_client()
+    assert api_client.configuration.access_token == "token-1"
+
+    # within the margin, the current token is returned while a thread refreshes it
+    client.token.expire_at_ts = time.time() + client.refresh_margin / 2
+    assert client.get_api_client().configuration.access_token == "token-1"
+    assert client._refresh_token_in_background() is None
+    with client.token.lock:
+        pass
+    assert len(calls) == 2
+    # token rotated in place, the connection pool is kept
+    assert client.get_api_client() is api_client
+    assert api_client.configuration.access_token == "token-2"
+    assert "Bearer token-2" in str(api_client.configuration.auth_settings())
+
+    # a client re-created for the user reuses the token and the api client
+    other = airflow.AirflowClient("user", "passwd", AIRFLOW_SERVER_URL, 3600)
+    assert other.get_api_client() is api_client
+    assert len(calls) == 2
+
+
+@pytest.mark.anyio
+async def test_async_token_refresh_single_flight(airflow_requests):
+    client = AirflowProvider().async_airflow_client
+    tokens = await asyncio.gather(*[client.get_access_token() for _ in range(10)])
+    assert tokens == ["token"] * 10
+    token_requests = [r for r in airflow_requests if r.url.path == "/auth/token"]
+    assert len(token_requests) == 1
+
+    client.token.expire_at_ts = time.time() + client.refresh_margin / 2
+    await asyncio.gather(*[client.get_access_token() for _ in range(10)])
+    await client.token.refresh_task
+    token_requests = [r for r in airflow_requests if r.url.path == "/auth/token"]
+    assert len(token_requests) == 2
+    assert client.token.expire_at_ts > time.time() + client.refresh_margin
+
+    # providers are re-created, their clients share the token of the user
+    assert await AirflowProvider().async_airflow_client.get_access_token() == "token"
+    token_requests = [r for r in airflow_requests if r.url.path == "/auth/token"]
+    assert len(token_requests) == 2
+
+
+@pytest.mark.anyio
+async def test_execution_watcher_shared(airflow_requests):
+    provider = AirflowProvider()
+    running, _ = await provider.get_exec_result_async(exec_annotation())
+    task_done = running.model_copy(deep=True)
+    task_done.result.tasks[1].state = TicketExecTaskStatus.SUCCESS
+    task_done.graph.nodes[1].color = StatusColor.SUCCESS
+    finished = task_done.model_copy(deep=True)
+    finished.status = TicketExecStatus.SUCCESS
+    results = [running, running, task_done, finished]
+    polls = []
+
+    async def poll():
+        polls.append(1)
+        return results[len(polls) - 1], ""
+
+    watcher = get_execution_watcher("run", poll, interval=0.01)
+    assert get_execution_watcher("run", poll, interval=0.01) is watcher
+    queues = [watcher.subscribe(), watcher.subscribe()]
+
+    for queue in queues:
+        events = []
+        while not events or events[-1][0] != "end":
+            events.append(await asyncio.wait_for(queue.get(), 1))
+        assert [e for e, _ in events] == ["snapshot", "task", "node", "dag_run", "end"]
+        assert events[1][1]["task_id"] == "notify" and events[1][1]["state"] == "success"
+        assert events[3][1]["status"] == "success"
+    assert len(polls) == 4
+
+    # late subscribers of a finished execution get the last snapshot only
+    late = watcher.subscribe()
+    assert (await late.get())[0] == "snapshot"
+    assert (await late.get())[0] == "end"
+    for queue in queues + [late]:
+        watcher.unsubscribe(queue)
+    assert "run" not in watcher_module._watchers
+
+
+@pytest.mark.anyio
+async def test_execution_watcher_slow_subscriber(airflow_requests, monkeypatch):
+    monkeypatch.setattr(watcher_module, "EXECUTION_WATCH_QUEUE_SIZE", 2)
+    provider = AirflowProvider()
+    running, _ = await provider.get_exec_result_async(exec_annotation())
+    task_done = running.model_copy(deep=True)
+    task_done.result.tasks[1].state = TicketExecTaskStatus.SUCCESS
+    task_done.graph.nodes[1].color = StatusColor.SUCCESS
+    finished = task_done.model_copy(deep=True)
+    finished.status = TicketExecStatus.SUCCESS
+    results = [running, task_done, finished]
+    polls = []
+
+    async def poll():
+        polls.append(1)
+        return results[len(polls) - 1], ""
+
+    watcher = get_execution_watcher("slow", poll, interval=0.01)
+    queue = watcher.subscribe()
+    await asyncio.wait_for(watcher._task, 1)
+    # the deltas did not fit, the latest snapshot replaced them
+    event, snapshot = queue.get_nowait()
+    assert event == "snapshot"
+    assert snapshot == watcher_module.dump_exec_result(finished)
+    assert queue.get_nowait() == ("end", {"status": "success"})
+    assert queue.empty()
+    watcher.unsubscribe(queue)
+
+
+@pytest.mark.anyio
+async def test_ticket_result_events(airflow_requests, monkeypatch, test_client: AsyncClient):
+    provider = AirflowProvider()
+    result, _ = await provider.get_exec_result_async(exec_annotation())
+    result.status = TicketExecStatus.SUCCESS
+
+    async def get_result(self):
+        return result, ""
+
+    monkeypatch.setattr(Ticket, "get_result", get_result)
+    ticket_id = await Ticket(
+        title="test", provider_type="airflow", annotation={"execution": exec_annotation()}
+    ).save()
+    response = await test_client.get(f"/api/ticket/{ticket_id}/result/events")
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/event-stream")
+    events = [block.split("\n") for block in response.text.strip().split("\n\n")]
+    assert [lines[0] for lines in events] == ["event: snapshot", "event: end"]
+    snapshot = json.loads(events[0][1][len("data: "):])
+    assert snapshot["status"] == "success"
+    assert [n["key"] for n in snapshot["graph"]["nodeDataArray"]] == ["create", "notify"]
+
+    not_executed = await Ticket(title="test", provider_type="airflow", annotation={}).save()
+    response = await test_client.get(f"/api/ticket/{not_executed}/result/events")
+    assert response.status_code == 404
+
+
+@pytest.mark.anyio
+async def test_ticket_result_versions(airflow_requests, monkeypatch, test_client: AsyncClient):
+    provider = AirflowProvider()
+    running, _ = await provider.get_exec_result_async(exec_annotation())
+    current = {"result": running}
+
+    async def get_result(self):
+        return current["result"], ""
+
+    monkeypatch.setattr(Ticket, "get_result", get_result)
+    ticket_id = await Ticket(
+        title="test", provider_type="airflow", annotation={"execution": exec_annotation()}
+    ).save()
+    url = f"/api/ticket/{ticket_id}/result"
+
+    response = await test_client.get(url)
+    assert response.status_code == 200
+    body = response.json()
+    etag = response.headers["ETag"]
+    assert etag == f'"{body["version"]}"' and body["delta"] is False
+    assert len(body["result"]["tasks"]) == 2
+
+    response = await test_client.get(url, headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    assert response.headers["ETag"] == etag
+
+    task_done = running.model_copy(deep=True)
+    task_done.result.tasks[1].state = TicketExecTaskStatus.SUCCESS
+    task_done.graph.nodes[1].color = StatusColor.SUCCESS
+    current["result"] = task_done
+    response = await test_client.get(url, headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.headers["ETag"] != etag
+
+    response = await test_client.get(url, params={"since": body["version"]})
+    delta = response.json()
+    assert delta["delta"] is True
+    assert [t["task_id"] for t in delta["result"]["tasks"]] == ["notify"]
+    assert [n["key"] for n in delta["graph"]["nodeDataArray"]] == ["notify"]
+    assert delta["removed_tasks"] == []
+
+    # unknown versions get the full result
+    response = await test_client.get(url, params={"since": "unknown"})
+    assert response.json()["delta"] is False
+    assert len(response.json()["result"]["tasks"]) == 2
+
+
+@pytest.mark.anyio
+async def test_search_log():
+    async def lines():
+        for line in ["a", "b", "ERROR 1", "c", "ERROR 2", "d", "e", "f", "error 3", "g"]:
+            yield line
+
+    pattern = compile_queries(["error \\d"], regex=True, ignore_case=True)
+    result = await search_log(lines(), pattern, context=2, offset=10)
+    assert [m["offset"] for m in result["matches"]] == [12, 14, 18]
+    # context lines are not repeated between matches
+    assert result["matches"][0]["before"] == ["a", "b"]
+    assert result["matches"][0]["after"] == ["c"]
+    assert result["matches"][1]["before"] == []
+    assert result["matches"][1]["after"] == ["d", "e"]
+    assert result["matches"][2]["before"] == ["f"]
+    assert result["matches"][2]["spans"] == [[0, 7]]
+    assert result["scanned_lines"] == 10 and not result["truncated"]
+
+    result = await search_log(lines(), compile_queries(["ERROR"]), max_matches=1)
+    assert [m["line"] for m in result["matches"]] == ["ERROR 1"]
+    assert result["truncated"] and result["next_offset"] == 4
+
+
+@pytest.mark.anyio
+async def test_search_result_log(airflow_requests, monkeypatch, test_client: AsyncClient):
+    cache = StaleWhileRevalidateCache(ttl=60)
+    monkeypatch.setattr(action_module, "action_schema_cache", cache)
+    output_id = f"{DAG_ID}|{DAG_RUN_ID}|create|1"
+    ticket_id = await Ticket(
+        title="test", provider_type="airflow", provider_object=DAG_ID, annotation={}
+    ).save()
+    url = f"/api/ticket/{ticket_id}/result_log"
+
+    response = await test_client.get(
+        url,
+        params={"exec_output_id": output_id, "search": True, "q": ["boom", "nothing"], "context": 1},
+    )
+    assert response.status_code == 200
+    result = response.json()
+    assert result["queries"] == ["boom", "nothing"] and result["regex"] is False
+    assert [(m["offset"], m["before"]) for m in result["matches"]] == [
+        (2, ['level=error time=2024-01-01T00:00:02Z msg="failed"'])
+    ]
+
+    # highlight queries of the dag by default
+    params = {
+        "reason": {
+            "schema": {
+                "type": ["null", "string"],
+                "description_md": '```helpdesk{"highlight_queries": ["level=(error|fatal)"]}```',
+            }
+        }
+    }
+    _, _, extra_attrs = AirflowProvider.airflow_schema_to_helpdesk(params)
+    assert extra_attrs["highlight_queries"] == ["level=(error|fatal)"]
+    cache.set(
+        ("airflow", DAG_ID),
+        ActionSchema(
+            id=DAG_ID,
+            name=DAG_ID,
+            parameters={},
+            tags=[],
+            description="",
+            params_json_schema={},
+            pack="",
+            runner_type="airflow",
+            highlight_queries=extra_attrs["highlight_queries"],
+        ),
+    )
+    response = await test_client.get(url, params={"exec_output_id": output_id, "search": True})
+    result = response.json()
+    assert result["regex"] is True
+    assert [m["offset"] for m in result["matches"]] == [1]
+
+    # queries of users are literal, regex is not taken from them
+    response = await test_client.get(
+        url,
+        params={"exec_output_id": output_id, "search": True, "q": "(a+)+$", "regex": True},
+    )
+    assert response.status_code == 200
+    assert response.json()["regex"] is False
+    assert response.json()["matches"] == []
+
+
+@pytest.mark.anyio
+async def test_provider_against_fake_airflow(monkeypatch):
+    fake = FakeAirflow(dags=2, tasks=50, log_lines=3000, run_seconds=60)
+    client = httpx.AsyncClient(transport=httpx.ASGITransport(app=fake), base_url=AIRFLOW_SERVER_URL)
+    monkeypatch.setitem(airflow._async_http_clients, AIRFLOW_SERVER_URL, client)
+    monkeypatch.setattr(airflow_provider, "_dag_graph_cache", LRUCache())
+    provider = AirflowProvider()
+
+    dags = await provider.async_airflow_client.get_dags()
+    assert [d.dag_id for d in dags.dags] == ["dag_0", "dag_1"]
+    details = await provider.async_airflow_client.get_schema_by_dag_id("dag_0")
+    action_schema = provider._build_action_from_dag_details(details, "dag_0")
+    assert action_schema.highlight_queries == ["level=error"]
+
+    execution, msg = await provider.exec_ticket_async("dag_0", {"param_0": "x"})
+    assert msg == ""
+    annotation = provider.get_exec_annotation(execution)
+    result, msg = await provider.get_exec_result_async(annotation)
+    assert result.status == TicketExecStatus.RUNNING
+    assert len(result.result.tasks) == len(result.graph.nodes) == 50
+    assert result.result.tasks[0].state == TicketExecTaskStatus.RUNNING
+
+    output_id = f"dag_0|{execution.exec_id}|task_0|1"
+    lines = [line async for line in provider.stream_exec_log_async(output_id)]
+    assert len(lines) == 1500
+
+    fake.run_seconds = 0
+    result, _ = await provider.get_exec_result_async(annotation)
+    assert result.status == TicketExecStatus.SUCCESS
+    log = await provider.get_exec_log_async(output_id)
+    assert len(log.message.splitlines()) == 3000
+
+    fake.error_rate = {"dag_run": 1}
+    result, msg = await provider.get_exec_result_async(annotation)
+    assert result is None and msg
+    assert fake.requests["dag_run"] == 3 and fake.requests["token"] == 1
@@ -0,0 +1,172 @@
+import time
+import asyncio
+from types import SimpleNamespace
+
+import httpx
+import pytest
+from httpx import AsyncClient
+
+from helpdesk.config import AIRFLOW_SERVER_URL
+from helpdesk.libs import airflow
+from helpdesk.libs import circuit_breaker as circuit_breaker_module
+from helpdesk.libs.circuit_breaker import (
+    CircuitBreaker,
+    CircuitOpenError,
+    circuit_breaker,
+    get_circuit_breaker,
+)
+from helpdesk.models.provider.airflow import AirflowProvider
+
+
+def test_circuit_breaker_states(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(time, "monotonic", lambda: now[0])
+    breaker = CircuitBreaker("test", failure_threshold=2, recovery_timeout=10)
+
+    breaker.before_call()
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.CLOSED
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.OPEN
+    with pytest.raises(CircuitOpenError) as e:
+        breaker.before_call()
+    assert e.value.retry_after == 10
+
+    # one probe after the recovery timeout, failing it opens the circuit again
+    now[0] += 10
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    breaker.before_call()
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.OPEN
+
+    now[0] += 10
+    breaker.before_call()
+    breaker.record_success()
+    assert breaker.state == CircuitBreaker.CLOSED
+    assert breaker.to_dict()["failures"] == 0
+
+
+def test_circuit_breaker_decorator():
+    calls = []
+
+    @circuit_breaker("test.not_found")
+    def not_found():
+        calls.append(1)
+        error = Exception("not found")
+        error.status = 404
+        raise error
+
+    @circuit_breaker("test.down")
+    def down():
+        calls.append(1)
+        raise ConnectionError("down")
+
+    for _ in range(10):
+        with pytest.raises(Exception, match="not found"):
+            not_found()
+    assert get_circuit_breaker("test.not_found").state == CircuitBreaker.CLOSED
+
+    calls.clear()
+    for _ in range(10):
+        with pytest.raises((ConnectionError, CircuitOpenError)):
+            down()
+    # the default threshold
+    assert len(calls) == 5
+    assert get_circuit_breaker("test.down").state == CircuitBreaker.OPEN
+
+
+@pytest.mark.anyio
+async def test_circuit_breaker_cancelled_probe(monkeypatch):
+    now = [1000.0]
+    # only the breaker's clock, asyncio.wait_for needs the real one
+    monkeypatch.setattr(
+        circuit_breaker_module, "time", SimpleNamespace(monotonic=lambda: now[0])
+    )
+    breaker = get_circuit_breaker("test.cancelled")
+    for _ in range(breaker.failure_threshold):
+        breaker.record_failure()
+    now[0] += breaker.recovery_timeout
+
+    @circuit_breaker("test.cancelled")
+    async def slow():
+        await asyncio.sleep(10)
+
+    # the cancelled probe is released for the next call
+    with pytest.raises(asyncio.TimeoutError):
+        await asyncio.wait_for(slow(), 0.01)
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    breaker.before_call()
+    breaker.record_success()
+    assert breaker.state == CircuitBreaker.CLOSED
+
+
+@pytest.mark.anyio
+async def test_circuit_breaker_cancelled_calls():
+    @circuit_breaker("test.cancelled_calls")
+    async def slow():
+        await asyncio.sleep(10)
+
+    breaker = get_circuit_breaker("test.cancelled_calls")
+    # e.g. viewers leaving, the remote is healthy
+    for _ in range(breaker.failure_threshold):
+        task = asyncio.create_task(slow())
+        await asyncio.sleep(0)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+    assert breaker.state == CircuitBreaker.CLOSED
+    assert breaker.to_dict()["failures"] == 0
+
+
+def test_circuit_breaker_stale_probe(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(time, "monotonic", lambda: now[0])
+    breaker = CircuitBreaker("test", failure_threshold=1, recovery_timeout=10)
+    breaker.record_failure()
+    now[0] += 10
+    # a probe which never reports back
+    breaker.before_call()
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+    now[0] += 10
+    breaker.before_call()
+    breaker.record_success()
+    assert breaker.state == CircuitBreaker.CLOSED
+
+
+@pytest.mark.anyio
+async def test_airflow_circuit_breaker(monkeypatch, test_client: AsyncClient):
+    requests = []
+
+    def handler(request: httpx.Request):
+        requests.append(request)
+        if request.url.path == "/auth/token":
+            return httpx.Response(201, json={"access_token": "token"})
+        return httpx.Response(503, json={"detail": "unavailable"})
+
+    client = httpx.AsyncClient(
+        transport=httpx.MockTransport(handler), base_url=AIRFLOW_SERVER_URL
+    )
+    monkeypatch.setitem(airflow._async_http_clients, AIRFLOW_SERVER_URL, client)
+    airflow_client = AirflowProvider().async_airflow_client
+
+    for _ in range(5):
+        with pytest.raises(httpx.HTTPStatusError):
+            await airflow_client.get_schema_by_dag_id("account_action")
+    dag_requests = len(requests)
+    # open, fail fast without calling airflow
+    with pytest.raises(CircuitOpenError):
+        await airflow_client.get_schema_by_dag_id("account_action")
+    assert len(requests) == dag_requests
+    # other endpoints have their own breakers
+    with pytest.raises(httpx.HTTPStatusError):
+        await airflow_client.get_dags()
+
+    response = await test_client.get("/api/circuit_breakers")
+    assert response.status_code == 200
+    breakers = {b["name"]: b for b in response.json()}
+    assert breakers["airflow.dag_details"]["state"] == "open"
+    assert breakers["airflow.dag_details"]["retry_after"] > 0
+    assert breakers["airflow.dags"]["state"] == "closed"
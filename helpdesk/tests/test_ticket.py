@@ -1,6 +1,12 @@
+from datetime import datetime, timedelta
+
 import pytest
 from httpx import AsyncClient
 
+from helpdesk.models.db import ConcurrentUpdateError, ticket_param, ticket_search
+from helpdesk.models.db import ticket as ticket_module
+from helpdesk.models.db.ticket import Ticket
+
 
 def test_admin_panel():
     """
@@ -26,3 +32,320 @@ async def test_ticket(test_client: AsyncClient, test_action, test_policy):
     # create ticket
     create_ticket = await test_client.post(f"/api/action/{test_action.target_object}")
     assert create_ticket.status_code == 404
+
+
+@pytest.fixture
+def ticket_queries(monkeypatch):
+    queries = []
+    execute, fetchall = Ticket._execute.__func__, Ticket._fetchall.__func__
+    execute_rowcount = Ticket._execute_rowcount.__func__
+
+    async def _execute(cls, query):
+        queries.append(str(query))
+        return await execute(cls, query)
+
+    async def _execute_rowcount(cls, query):
+        queries.append(str(query))
+        return await execute_rowcount(cls, query)
+
+    async def _fetchall(cls, query):
+        queries.append(str(query))
+        return await fetchall(cls, query)
+
+    monkeypatch.setattr(Ticket, "_execute", classmethod(_execute))
+    monkeypatch.setattr(Ticket, "_fetchall", classmethod(_fetchall))
+    monkeypatch.setattr(Ticket, "_execute_rowcount", classmethod(_execute_rowcount))
+    yield queries
+
+
+@pytest.mark.anyio
+async def test_save_dirty_fields(ticket_queries):
+    ticket = Ticket(title="test", provider_type="airflow", params={"app": "x"}, annotation={})
+    ticket_id = await ticket.save()
+    assert ticket.id == ticket_id and ticket.created_at
+    assert len(ticket_queries) == 1 and ticket_queries[0].startswith("INSERT")
+
+    ticket = await Ticket.get(ticket_id)
+    ticket_queries.clear()
+    assert await ticket.save() == ticket_id
+    assert ticket_queries == []
+
+    ticket.confirmed_by = "admin_user"
+    ticket.annotation["policy"] = "test_policy"
+    await ticket.save()
+    assert len(ticket_queries) == 1
+    set_clause = ticket_queries[0].split(" SET ")[1].split(" WHERE ")[0]
+    assert sorted(c.split("=")[0] for c in set_clause.split(", ")) == [
+        "annotation",
+        "confirmed_by",
+        "version",
+    ]
+
+    ticket = await Ticket.get(ticket_id)
+    assert ticket.confirmed_by == "admin_user"
+    assert ticket.annotation == {"policy": "test_policy"} and ticket.params == {"app": "x"}
+
+    # not loaded but with an id, upserted without a read
+    ticket_queries.clear()
+    await Ticket(id=ticket_id, title="replaced", annotation={}).save()
+    await Ticket(id=ticket_id + 100, title="new", annotation={}).save()
+    assert len(ticket_queries) == 2
+    assert (await Ticket.get(ticket_id)).title == "replaced"
+    assert (await Ticket.get(ticket_id + 100)).title == "new"
+
+
+@pytest.mark.anyio
+async def test_save_concurrent_update():
+    ticket_id = await Ticket(title="test", provider_type="airflow", annotation={}).save()
+    first, second = await Ticket.get(ticket_id), await Ticket.get(ticket_id)
+    assert first.version == 0
+
+    first.annotate(approval_log=[{"approver": "admin_user"}])
+    await first.save()
+    assert first.version == 1
+    # a stale copy can not overwrite the approval
+    second.annotate(execution_status="running")
+    with pytest.raises(ConcurrentUpdateError):
+        await second.save()
+
+    # merged into the reloaded ticket instead
+    await second.save_with_retry(lambda t: t.annotate(execution_status="running"))
+    assert second.version == 2
+    ticket = await Ticket.get(ticket_id)
+    assert ticket.annotation == {
+        "approval_log": [{"approver": "admin_user"}],
+        "execution_status": "running",
+    }
+
+    # nothing to save on the reloaded ticket
+    def refresh_status(ticket):
+        if ticket.annotation.get("execution_status"):
+            return False
+        ticket.annotate(execution_status="success")
+
+    assert await first.save_with_retry(refresh_status) == ticket_id
+    assert (await Ticket.get(ticket_id)).version == 2
+
+    # rows changed meanwhile are skipped by bulk_update
+    stale, fresh = await Ticket.get(ticket_id), await Ticket.get(ticket_id)
+    fresh.annotate(closed=True)
+    await fresh.save()
+    stale.annotate(execution_status="failed")
+    assert await Ticket.bulk_update([stale], ["annotation"]) == 0
+    assert await Ticket.bulk_update([fresh], ["annotation"]) == 1
+    ticket = await Ticket.get(ticket_id)
+    assert ticket.annotation["closed"] and ticket.annotation["execution_status"] == "running"
+    assert ticket.version == fresh.version == 4
+
+
+@pytest.mark.anyio
+async def test_current_status(test_client: AsyncClient):
+    ticket = Ticket(title="test", provider_type="airflow", params={}, annotation={})
+    ticket_id = await ticket.save()
+    assert (await Ticket.get(ticket_id)).current_status == "pending"
+    # any status a callback marks fits the column
+    ticket.annotate(execution_status="waiting_for_an_external_approval_system_" * 2)
+    await ticket.save()
+    assert len((await Ticket.get(ticket_id)).current_status) == 64
+    ticket.annotate(closed=True)
+    await ticket.save()
+    assert (await Ticket.get(ticket_id)).current_status == "closed"
+
+    # saved before the column existed
+    t = Ticket.__table__
+    old_id = await Ticket._execute(
+        t.insert().values(title="old", annotation={}, is_approved=False, version=0)
+    )
+    assert (await Ticket.get(old_id)).current_status is None
+    assert await Ticket.backfill_status(batch_size=1) >= 1
+    assert (await Ticket.get(old_id)).current_status == "rejected"
+    assert await Ticket.backfill_status() == 0
+
+    resp = await test_client.get(
+        "/api/ticket", params={"status": "closed,rejected", "show_all": True}
+    )
+    assert resp.status_code == 200
+    tickets = resp.json()["tickets"]
+    assert {ticket_id, old_id} <= {t["id"] for t in tickets}
+    assert {t["status"] for t in tickets} == {"closed", "rejected"}
+
+
+@pytest.mark.anyio
+async def test_list_ticket_by_cursor(test_client: AsyncClient):
+    created_at = datetime(2024, 1, 1)
+    ids = []
+    for i in range(5):
+        ticket = Ticket(
+            title="cursor_test",
+            submitter="admin_user",
+            annotation={},
+            # ties are ordered by id
+            created_at=created_at + timedelta(hours=i // 2),
+        )
+        ids.append(await ticket.save())
+    params = dict(
+        query_key="title__icontains",
+        query_value="cursor_test",
+        order_by="created_at",
+        pagesize="2",
+    )
+
+    async def get_page(cursor, **kw):
+        resp = await test_client.get("/api/ticket", params=dict(params, cursor=cursor, **kw))
+        assert resp.status_code == 200
+        data = resp.json()
+        return [t["id"] for t in data["tickets"]], data
+
+    pages, cursor = [], ""
+    while cursor is not None:
+        page, data = await get_page(cursor, with_total=True)
+        pages.append(page)
+        cursor = data["next_cursor"]
+        assert data["total"] == 5 and data["exact_total"]
+    assert pages == [ids[4:2:-1], ids[2:0:-1], ids[:1]]
+
+    # back from the last page
+    page, data = await get_page(data["prev_cursor"])
+    assert page == ids[2:0:-1]
+    page, data = await get_page(data["prev_cursor"])
+    assert page == ids[4:2:-1] and data["prev_cursor"] is None
+
+    # the cached total is kept until it expires
+    await Ticket(title="cursor_test", submitter="admin_user", annotation={}).save()
+    assert (await get_page(""))[1]["total"] == 5
+    assert (await get_page("", with_total=True))[1]["total"] == 6
+
+    resp = await test_client.get("/api/ticket", params=dict(params, cursor="bad"))
+    assert resp.status_code == 400
+    resp = await test_client.get("/api/ticket", params=dict(params, cursor="", order_by="title"))
+    assert resp.status_code == 400
+
+
+@pytest.mark.anyio
+async def test_search_index(test_client: AsyncClient, monkeypatch):
+    monkeypatch.setattr(ticket_module, "_search_index_complete", False)
+    new = Ticket(title="search needle", params={"app": "helpdesk"}, annotation={})
+    new_id = await new.save()
+    other_id = await Ticket(title="search haystack", annotation={}).save()
+    # saved before the search index
+    old_id = await Ticket._execute(
+        Ticket.__table__.insert().values(title="old NEEDLE", annotation={}, version=0)
+    )
+
+    async def search(key, value):
+        resp = await test_client.get(
+            "/api/ticket",
+            params=dict(query_key=f"{key}__icontains", query_value=value, show_all=True),
+        )
+        assert resp.status_code == 200
+        return {t["id"] for t in resp.json()["tickets"]}
+
+    assert {new_id, old_id} <= await search("title", "needle")
+    assert "ticket_search_token" not in str(Ticket.search_filter("title", "needle"))
+
+    await Ticket.check_search_index()
+    assert Ticket.search_filter("title", "needle") is None
+    assert await Ticket.backfill_search_index(batch_size=1) >= 1
+    assert await Ticket.backfill_search_index() == 0
+    assert "ticket_search_token" in str(Ticket.search_filter("title", "needle"))
+    # other workers find the index complete on their next check
+    monkeypatch.setattr(ticket_module, "_search_index_complete", False)
+    await Ticket.check_search_index()
+    assert "ticket_search_token" in str(Ticket.search_filter("title", "needle"))
+    found = await search("title", "needle")
+    assert {new_id, old_id} <= found and other_id not in found
+    assert new_id in await search("params", "helpdesk")
+    # too short for a trigram, LIKE only
+    assert Ticket.search_filter("title", "ne") is None
+    assert new_id in await search("title", "ne")
+
+    new.title = "search pin"
+    await new.save()
+    assert new_id not in await search("title", "needle")
+    assert new_id in await search("title", "pin")
+
+    # duplicate rows of a gram do not hide a ticket
+    await ticket_search.TicketSearchToken.index_tickets([new])
+    t = ticket_search.TicketSearchToken.__table__
+    await Ticket._execute(t.insert().values(ticket_id=new_id, field="title", gram="pin"))
+    assert new_id in await search("title", "pin")
+
+    # more rows than one INSERT takes, json is matched as the database stores it
+    monkeypatch.setattr(ticket_search, "INSERT_CHUNK_SIZE", 10)
+    new.params = {"app": "helpdesk", "中文": "参数"}
+    await new.save()
+    assert new_id in await search("params", "helpdesk")
+    assert new_id in await search("title", "pin")
+
+    # the ticket is not written without its index
+    async def fail(tickets):
+        raise RuntimeError("index failed")
+
+    monkeypatch.setattr(ticket_search.TicketSearchToken, "index_tickets", fail)
+    broken = Ticket(title="search broken", annotation={})
+    with pytest.raises(RuntimeError):
+        await broken.save()
+    assert broken.id is None
+    assert not await Ticket.get_all(filter_=Ticket.__table__.c.title == "search broken")
+    new.title = "search broken"
+    with pytest.raises(RuntimeError):
+        await new.save()
+    assert (await Ticket.get(new_id)).title == "search pin"
+    assert "title" in new.dirty_fields()
+
+
+@pytest.mark.anyio
+async def test_param_filters(test_client: AsyncClient, monkeypatch):
+    def ticket(provider_object, **params):
+        return Ticket(
+            title="param_test", provider_object=provider_object, params=params, annotation={}
+        )
+
+    foo_id = await ticket("create_db", app="foo", department="infra", tags=["a", "b"]).save()
+    old_id = await ticket("restart", app="foo_bar").save()
+    monkeypatch.setattr(ticket_param, "TICKET_INDEXED_PARAMS", {"*": ["app"]})
+    # indexed when its action's params are declared
+    assert await Ticket.backfill_param_index() >= 2
+    monkeypatch.setattr(
+        ticket_param, "TICKET_INDEXED_PARAMS", {"*": ["app"], "create_db": ["department", "tags"]}
+    )
+    assert await Ticket.backfill_param_index() >= 1
+    assert await Ticket.backfill_param_index() == 0
+    bar_id = await ticket("create_db", app="bar", department="dba", tags=["b"]).save()
+
+    async def filter_tickets(**params):
+        resp = await test_client.get(
+            "/api/ticket",
+            params=dict(
+                {f"param.{k}": v for k, v in params.items()},
+                query_key="title__icontains",
+                query_value="param_test",
+                show_all=True,
+            ),
+        )
+        assert resp.status_code == 200
+        return {t["id"] for t in resp.json()["tickets"]}
+
+    assert await filter_tickets(app="foo") == {foo_id}
+    assert await filter_tickets(app__startswith="foo") == {foo_id, old_id}
+    assert await filter_tickets(app__startswith="fo%") == set()
+    assert await filter_tickets(app__in="foo,bar") == {foo_id, bar_id}
+    assert await filter_tickets(tags="b") == {foo_id, bar_id}
+    assert await filter_tickets(tags="a", app="foo") == {foo_id}
+    assert await filter_tickets(department="dba") == {bar_id}
+
+    ticket = await Ticket.get(bar_id)
+    ticket.params = dict(ticket.params, department="infra")
+    await ticket.save()
+    assert await filter_tickets(department="infra") == {foo_id, bar_id}
+
+    # more rows than one INSERT takes
+    monkeypatch.setattr(ticket_param, "INSERT_CHUNK_SIZE", 2)
+    ticket.params = dict(ticket.params, tags=[f"tag_{i}" for i in range(5)])
+    await ticket.save()
+    assert await filter_tickets(tags="tag_4", department="infra") == {bar_id}
+
+    resp = await test_client.get("/api/ticket", params={"param.reason": "x"})
+    assert resp.status_code == 400
+    resp = await test_client.get("/api/ticket", params={"param.app__contains": "x"})
+    assert resp.status_code == 400
@@ -1,17 +1,32 @@
 # coding: utf-8
 
+import re
+import json
+import asyncio
 import logging
+from contextlib import aclosing
 from datetime import datetime
-from typing import Optional
+from typing import List, Optional
 
 from authlib.jose import jwt, errors as jwterrors
-from starlette.responses import RedirectResponse  # NOQA
+from starlette.responses import (  # NOQA
+    JSONResponse,
+    RedirectResponse,
+    Response,
+    StreamingResponse,
+)
 from starlette.authentication import requires, has_required_scope  # NOQA
 from fastapi import Query, HTTPException, Depends, Request
+from sqlalchemy import and_
 
 from helpdesk import config
+from helpdesk.libs.circuit_breaker import all_circuit_breakers
 from helpdesk.libs.db import extract_filter_from_query_params
+from helpdesk.libs.exec_result import delta_exec_result, etag_matches, exec_result_version
+from helpdesk.libs.log_search import compile_queries, search_log
+from helpdesk.libs.watcher import get_execution_watcher, format_sse, dump_exec_result
 from helpdesk.models.provider import get_provider
+from helpdesk.models.db import ConcurrentUpdateError, InvalidCursorError
 from helpdesk.models.db.ticket import Ticket, TicketPhase
 from helpdesk.models.db.param_rule import ParamRule
 from helpdesk.models.action_tree import action_tree
@@ -19,7 +34,13 @@ from helpdesk.models.user import User
 from helpdesk.libs.dependency import get_current_user, require_admin
 
 from . import router
-from .schemas import MarkTickets, ParamRule as ParamRuleSchema, OperateTicket, QeuryKey
+from .schemas import (
+    BatchSubmitTickets,
+    MarkTickets,
+    ParamRule as ParamRuleSchema,
+    OperateTicket,
+    QeuryKey,
+)
 
 logger = logging.getLogger(__name__)
 
@@ -93,6 +114,11 @@ async def admin_panel(
             return await ParamRule.delete(param_rule.id) == param_rule.id
 
 
+@router.get("/circuit_breakers")
+async def circuit_breakers(_: User = Depends(require_admin)):
+    return [breaker.to_dict() for breaker in all_circuit_breakers()]
+
+
 @router.get("/action_tree")
 async def action_tree_list(_: User = Depends(get_current_user)):
     def node_formatter(node, children):
@@ -140,6 +166,33 @@ async def action(
         return dict(ticket=ticket, msg=msg, msg_level=msg_level, debug=config.DEBUG)
 
 
+@router.post("/action/{target_object}/batch")
+async def batch_action(
+    target_object: str,
+    batch: BatchSubmitTickets,
+    current_user: User = Depends(get_current_user),
+):
+    action = action_tree.get_action_by_target_obj(target_object)
+    if not action:
+        raise HTTPException(status_code=404, detail="Target object not found")
+    if not batch.params:
+        raise HTTPException(status_code=400, detail="Params are required")
+    if len(batch.params) > config.BATCH_SUBMIT_MAX_SIZE:
+        raise HTTPException(
+            status_code=400,
+            detail=f"At most {config.BATCH_SUBMIT_MAX_SIZE} tickets in a batch",
+        )
+
+    provider = get_provider(action.provider_type)
+    results = await action.run_batch(provider, batch.params, current_user)
+    succeeded = sum(1 for r in results if r["success"])
+    return dict(
+        results=results,
+        msg=f"{succeeded}/{len(results)} tickets submitted",
+        msg_level="success" if succeeded == len(results) else "error",
+    )
+
+
 @router.post("/ticket/mark/{ticket_id}")
 async def mark_ticket(ticket_id: int, mark: MarkTickets, token: Optional[str] = None):
     """call helpdesk_ticket op to handle this handler only make authenticate disappear for provider"""
@@ -154,19 +207,30 @@ async def mark_ticket(ticket_id: int, mark: MarkTickets, token: Optional[str] =
     if not helpdesk_ticket:
         raise HTTPException(status_code=404, detail="Ticket not found")
 
+    def mark_status(ticket):
+        ticket.annotate(execution_status=mark.execution_status, final_exec_status=True)
+
     try:
-        helpdesk_ticket.annotate(
-            execution_status=mark.execution_status, final_exec_status=True
-        )
+        mark_status(helpdesk_ticket)
         logger.debug(f"helpdesk_ticket annotation: {helpdesk_ticket.annotation}")
         # add notification to helpdesk_ticket mark action
         await helpdesk_ticket.notify(TicketPhase.MARK)
-        await helpdesk_ticket.save()
+        await helpdesk_ticket.save_with_retry(mark_status)
     except (RuntimeError, AssertionError) as e:
         raise HTTPException(status_code=400, detail=f"decode mark body error: {str(e)}")
     return dict(msg="Success")
 
 
+async def save_operated_ticket(ticket):
+    """save a ticket operated by a user, 409 if others changed it since it was loaded"""
+    try:
+        return await ticket.save()
+    except ConcurrentUpdateError:
+        raise HTTPException(
+            status_code=409, detail="Ticket was changed by others, please reload and retry"
+        )
+
+
 @router.post("/ticket/{ticket_id}/{op}")
 async def ticket_op(
     ticket_id: int,
@@ -195,7 +259,7 @@ async def ticket_op(
         ticket.confirmed_by = current_user.name
         ticket.confirmed_at = datetime.now()
         ticket.reason = operate_data.reason
-        id_ = await ticket.save()
+        id_ = await save_operated_ticket(ticket)
         if not id_:
             raise HTTPException(
                 status_code=500,
@@ -212,15 +276,18 @@ async def ticket_op(
         if not ret:
             raise HTTPException(status_code=400, detail=msg)
         if ret and "Success" not in msg:
+            ticket_id = await save_operated_ticket(ticket)
             await ticket.notify(TicketPhase.REQUEST)
-            ticket_id = await ticket.save()
             if not ticket_id:
                 raise HTTPException(
                     status_code=500,
                     detail="Failed to save ticket info when has next approval",
                 )
             return dict(msg="Waiting for the approval of the next level")
-        execution, msg = ticket.execute()
+        # save the approval before executing, a concurrent approval can not execute twice
+        await save_operated_ticket(ticket)
+        execution, msg = await ticket.execute()
+        id_ = await ticket.save_execution()
         if not execution:
             raise HTTPException(status_code=400, detail=msg)
     elif op == "reject":
@@ -229,8 +296,8 @@ async def ticket_op(
         ret, msg = await ticket.reject(by_user=current_user.name)
         if not ret:
             raise HTTPException(status_code=400, detail=msg)
+        id_ = await save_operated_ticket(ticket)
 
-    id_ = await ticket.save()
     if not id_:
         msg = (
             "ticket executed but failed to save state"
@@ -241,6 +308,62 @@ async def ticket_op(
     return dict(msg="Success")
 
 
+async def stream_result_log(ticket, exec_output_id, offset):
+    lines = ticket.stream_result_log(exec_output_id, offset=offset)
+    # load the first line before responding, so a broken log is still a http error
+    try:
+        first_line = await anext(lines)
+    except StopAsyncIteration:
+        first_line = None
+    except Exception as e:
+        logger.error("stream log %s of ticket %s failed: %s", exec_output_id, ticket.id, e)
+        raise HTTPException(
+            status_code=500,
+            detail="Load log from airflow failed, contact admin for help",
+        )
+
+    async def content():
+        if first_line is None:
+            return
+        yield first_line + "\n"
+        try:
+            async for line in lines:
+                yield line + "\n"
+        except Exception as e:
+            logger.error("stream log %s of ticket %s broken: %s", exec_output_id, ticket.id, e)
+
+    return StreamingResponse(content(), media_type="text/plain; charset=utf-8")
+
+
+async def search_result_log(
+    ticket, exec_output_id, offset, queries, ignore_case, context, max_matches
+):
+    # queries of users are literal, a regex could take the worker down with backtracking,
+    # only the highlight queries configured in the dag are regexes
+    queries, regex = [query for query in queries or [] if query], False
+    if not queries:
+        queries, regex = await ticket.get_highlight_queries(), True
+        if not queries:
+            raise HTTPException(status_code=400, detail="no query to search")
+    try:
+        pattern = compile_queries(queries, regex=regex, ignore_case=ignore_case)
+    except re.error as e:
+        raise HTTPException(status_code=400, detail=f"invalid regex: {e}")
+
+    try:
+        async with aclosing(ticket.stream_result_log(exec_output_id, offset=offset)) as lines:
+            result = await search_log(
+                lines, pattern, context=context, offset=offset, max_matches=max_matches
+            )
+    except Exception as e:
+        logger.error("search log %s of ticket %s failed: %s", exec_output_id, ticket.id, e)
+        raise HTTPException(
+            status_code=500,
+            detail="Load log from airflow failed, contact admin for help",
+        )
+    return dict(queries=queries, regex=regex, **result)
+
+
 def extra_dict(d):
     id_ = d["id"]
     return dict(
@@ -254,6 +377,7 @@ def extra_dict(d):
 
 @router.get("/ticket")
 async def list_ticket(
+    request: Request,
     page: Optional[str] = None,
     pagesize: Optional[str] = None,
     order_by: Optional[str] = None,
@@ -262,7 +386,20 @@ async def list_ticket(
     query_key: Optional[QeuryKey] = None,
     query_value: Optional[str] = None,
     show_all: Optional[bool] = False,
+    status: Optional[str] = None,
+    cursor: Optional[str] = None,
+    with_total: bool = False,
 ):
+    """
+    paged by `page`, or by keyset with `cursor`: empty for the first page, then the
+    next_cursor or prev_cursor of the last response. cursor pages cost the same at any
+    depth, their total is counted at most every TICKET_COUNT_CACHE_SECONDS unless `with_total`.
+    params in TICKET_INDEXED_PARAMS are filtered by `param.<name>=value`,
+    `param.<name>__in=a,b` and `param.<name>__startswith=prefix`.
+    """
+    # status is materialized as the indexed current_status column
+    if order_by == "status":
+        order_by = "current_status"
     query_params = {
         "page": page,
         "page_size": pagesize,
@@ -271,7 +408,11 @@ async def list_ticket(
     }
     if query_key and query_value:
         query_params[query_key] = query_value
+    if status:
+        # comma separated statuses
+        query_params["current_status__in"] = status
     filter_ = extract_filter_from_query_params(query_params=query_params, model=Ticket)
+    filter_ = and_(filter_, *get_param_filters(request.query_params))
     if page and page.isdigit():
         page = max(1, int(page))
     else:
@@ -285,6 +426,10 @@ async def list_ticket(
         desc = False
     else:
         desc = True
+    if cursor is not None:
+        return await list_ticket_by_cursor(
+            current_user, show_all, filter_, cursor, order_by, desc, pagesize, with_total
+        )
     kw = dict(
         filter_=filter_,
         order_by=order_by,
@@ -311,6 +456,53 @@ async def list_ticket(
     )
 
 
+def get_param_filters(query_params):
+    filters = []
+    for name, value in query_params.multi_items():
+        if not name.startswith("param."):
+            continue
+        key, _, op = name[len("param."):].partition("__")
+        try:
+            filters.append(Ticket.param_filter(key, op or "eq", value))
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+    return filters
+
+
+async def list_ticket_by_cursor(
+    current_user, show_all, filter_, cursor, order_by, desc, pagesize, with_total
+):
+    if order_by not in (None, "id", "created_at"):
+        raise HTTPException(
+            status_code=400, detail="cursor pages can only be ordered by id or created_at"
+        )
+    kw = dict(filter_=filter_, cursor=cursor, order_by=order_by, desc=desc, limit=pagesize)
+    count_kw = dict(filter_=filter_)
+    if not with_total:
+        count_kw["cache_ttl"] = config.TICKET_COUNT_CACHE_SECONDS
+    try:
+        if current_user.is_admin and show_all:
+            tickets, next_cursor, prev_cursor = await Ticket.get_page(**kw)
+            total = await Ticket.count(**count_kw)
+        else:
+            # only show self tickets if not admin or admin without show_all
+            tickets, next_cursor, prev_cursor = await Ticket.get_page_by_submitter(
+                submitter=current_user.name, **kw
+            )
+            total = await Ticket.count_by_submitter(submitter=current_user.name, **count_kw)
+    except InvalidCursorError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    return dict(
+        tickets=[extra_dict(t.to_dict(show=True)) for t in tickets],
+        page_size=pagesize,
+        next_cursor=next_cursor,
+        prev_cursor=prev_cursor,
+        total=total,
+        exact_total=with_total,
+    )
+
+
 @router.get("/ticket/{ticket_id}")
 @router.post("/ticket/{ticket_id}")
 async def get_ticket(ticket_id: int, current_user: User = Depends(get_current_user)):
@@ -328,41 +520,135 @@ async def get_ticket(ticket_id: int, current_user: User = Depends(get_current_us
 
 
 @router.get("/ticket/{ticket_id}/result")
-async def ticket_result(ticket_id: int, _: User = Depends(get_current_user)):
+async def ticket_result(
+    ticket_id: int,
+    request: Request,
+    since: Optional[str] = None,
+    _: User = Depends(get_current_user),
+):
+    """
+    the result carries its version in `ETag`, `If-None-Match` with it gets a 304 if nothing changed.
+    with `since` set to a version, only tasks and graph nodes changed after it are returned,
+    with `delta` true and the ids of tasks gone in `removed_tasks`.
+    """
     ticket = await Ticket.get(ticket_id)
     if not ticket:
         raise HTTPException(status_code=404, detail="ticket not found")
 
-    execution, msg = ticket.get_result()
+    execution, msg = await ticket.get_result()
     if not execution:
         raise HTTPException(status_code=404, detail=msg)
 
     # update ticket status by result
-    annotation_execution_status = ticket.annotation.get("execution_status")
-    final_exec_status = ticket.annotation.get("final_exec_status")
-    try:
-        exec_status = execution.status.value
+    def refresh_status(ticket):
+        # checked again on the reloaded ticket, a status marked by the provider is final
         if (
-            exec_status
-            and annotation_execution_status != exec_status
-            and not final_exec_status
+            not exec_status
+            or ticket.annotation.get("execution_status") == exec_status
+            or ticket.annotation.get("final_exec_status")
         ):
-            ticket.annotate(execution_status=exec_status)
-            await ticket.save()
+            return False
+        ticket.annotate(execution_status=exec_status)
+
+    try:
+        exec_status = execution.status.value
+        await ticket.save_with_retry(refresh_status)
     except AttributeError as e:
         logger.warning(f"can not get status from execution, error: {str(e)}")
-    return execution
+
+    result = dump_exec_result(execution)
+    version = exec_result_version(result)
+    headers = {"ETag": f'"{version}"', "Cache-Control": "no-cache"}
+    if etag_matches(request.headers.get("If-None-Match"), version):
+        return Response(status_code=304, headers=headers)
+    if since:
+        delta = delta_exec_result(result, since)
+        if delta is not None:
+            return JSONResponse(dict(delta, version=version, delta=True), headers=headers)
+    return JSONResponse(dict(result, version=version, delta=False), headers=headers)
+
+
+@router.get("/ticket/{ticket_id}/result/events")
+async def ticket_result_events(ticket_id: int, _: User = Depends(get_current_user)):
+    """
+    server sent events of the ticket execution: a `snapshot` of the result first,
+    then `dag_run`, `task` and `node` deltas, and `end` once the execution is finished.
+    viewers of the same execution share one poll loop.
+    """
+    ticket = await Ticket.get(ticket_id)
+    if not ticket:
+        raise HTTPException(status_code=404, detail="ticket not found")
+    exec_annotation = (ticket.annotation or {}).get("execution")
+    if not exec_annotation:
+        raise HTTPException(status_code=404, detail="ticket is not executed yet")
+
+    watcher = get_execution_watcher(
+        (ticket.provider_type, json.dumps(exec_annotation, sort_keys=True)),
+        ticket.get_result,
+        config.EXECUTION_WATCH_INTERVAL_SECONDS,
+    )
+
+    async def events():
+        queue = watcher.subscribe()
+        try:
+            while True:
+                try:
+                    event, data = await asyncio.wait_for(
+                        queue.get(), timeout=config.EXECUTION_WATCH_KEEPALIVE_SECONDS
+                    )
+                except asyncio.TimeoutError:
+                    yield ": keepalive\n\n"
+                    continue
+                yield format_sse(event, data)
+                if event == "end":
+                    break
+        finally:
+            watcher.unsubscribe(queue)
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
 
 
 @router.get("/ticket/{ticket_id}/result_log")
 async def ticket_result_log(
-    ticket_id: int, exec_output_id: str, _: User = Depends(get_current_user)
+    ticket_id: int,
+    exec_output_id: str,
+    stream: bool = False,
+    offset: int = Query(default=0, ge=0),
+    search: bool = False,
+    q: Optional[List[str]] = Query(default=None),
+    ignore_case: bool = False,
+    context: int = Query(default=0, ge=0, le=config.LOG_SEARCH_MAX_CONTEXT),
+    max_matches: int = Query(
+        default=config.LOG_SEARCH_MAX_MATCHES, ge=1, le=config.LOG_SEARCH_MAX_MATCHES
+    ),
+    _: User = Depends(get_current_user),
 ):
+    """
+    with `stream`, formatted log lines are sent as chunked text/plain from line `offset`,
+    client tails a running task by requesting again with offset += lines received,
+    the offset to resume from is only known once the response is read.
+
+    with `search`, only lines matching any of queries `q` are returned with `context` lines
+    around them and their offsets, queries are literal,
+    the highlight queries of the action (regexes) are used if `q` is not given.
+    """
     ticket = await Ticket.get(ticket_id)
     if not ticket:
         raise HTTPException(status_code=404, detail="ticket not found")
 
-    ticket_log = ticket.get_result_log(exec_output_id)
+    if search:
+        return await search_result_log(
+            ticket, exec_output_id, offset, q, ignore_case, context, max_matches
+        )
+
+    if stream:
+        return await stream_result_log(ticket, exec_output_id, offset)
+
+    ticket_log = await ticket.get_result_log(exec_output_id)
 
     if ticket_log.is_rotated:
         ticket_log.message = "ticket log expired, contact admin for help"
@@ -4,7 +4,7 @@
 
 from enum import Enum
 from datetime import datetime
-from typing import List, Optional
+from typing import Any, Dict, List, Optional
 from pydantic import BaseModel
 
 
@@ -16,6 +16,14 @@ class MarkTickets(BaseModel):
     execution_status: str
 
 
+class BatchSubmitTickets(BaseModel):
+    """
+    批量提交工单的请求体, 每组参数一个工单
+    """
+
+    params: List[Dict[str, Any]]
+
+
 class QeuryKey(str, Enum):
     """
     ticket支持模糊匹配的key